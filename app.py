@@ -1,23 +1,28 @@
-import base64
+import time
+import uuid
 from datetime import date
-from io import BytesIO
-from typing import List, Dict, Any, Optional
+from typing import Dict, Any, TYPE_CHECKING
 
 import streamlit as st
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import (
-    Mail,
-    Email,
-    To,
-    Cc,
-    Attachment,
-    FileContent,
-    FileName,
-    FileType,
-    Disposition,
-)
 
-from excel_generator import generate_excel
+import metrics
+from draft_store import DraftStore, draft_owner
+from duplicate_index import DuplicateIndex
+from expense_store import ExpenseStore, receipt_size
+from fx_rates import BASE_CURRENCY, FxError, FxRates, apply_fx, load_rates, original_amount
+from memory_governor import MemoryGovernor, SubmitTicket, submit_cost
+from policy import Policy, PolicyError, load_policy
+from receipt_store import ReceiptStore
+from report_archive import ReportArchive
+from report_utils import calc_totals
+
+# openpyxl, Pillow and the mail transports load with the pipeline on the
+# first submit, see load_pipeline()
+if TYPE_CHECKING:
+    from columnar_export import ColumnarExport
+    from finance_digest import FinanceDigest
+    from receipt_optimizer import ReceiptCache
+    from submission_queue import SubmissionQueue
 
 
 # -----------------------------
@@ -25,8 +30,35 @@ from excel_generator import generate_excel
 # -----------------------------
 st.set_page_config(page_title="Performa Expense Report", layout="wide")
 
+# Per diem where the policy rules have no rate for the trip
 PER_DIEM_RATE = float(st.secrets.get("PER_DIEM_RATE", 100))
+POLICY_RULES_PATH = st.secrets.get("POLICY_RULES_PATH", "policy_rules.csv")
+# Share of a full day paid for the departure and return days
+PARTIAL_DAY_FACTOR = float(st.secrets.get("PARTIAL_DAY_FACTOR", 1.0))
 MAX_ATTACHMENT_MB = float(st.secrets.get("MAX_ATTACHMENT_MB", 18))
+SPLIT_LARGE_REPORTS = bool(st.secrets.get("SPLIT_LARGE_REPORTS", True))
+# Finance gets reports batched in a scheduled digest, the employee's copy still goes out at submit
+FINANCE_DIGEST = bool(st.secrets.get("FINANCE_DIGEST", False))
+ASYNC_SUBMIT = bool(st.secrets.get("ASYNC_SUBMIT", True))
+OPTIMIZE_RECEIPTS = bool(st.secrets.get("OPTIMIZE_RECEIPTS", True))
+MERGE_RECEIPTS_PDF = bool(st.secrets.get("MERGE_RECEIPTS_PDF", False))
+FX_RATES_PATH = st.secrets.get("FX_RATES_PATH", "fx_rates.csv")
+FX_MAX_AGE_DAYS = int(st.secrets.get("FX_MAX_AGE_DAYS", 7))
+# Month partitioned Parquet/CSV copy of every submitted report for BI tools, off when blank
+COLUMNAR_EXPORT_DIR = st.secrets.get("COLUMNAR_EXPORT_DIR", "")
+# How long a submit waits for a slot when MAX_CONCURRENT_SUBMITS are running
+SUBMIT_QUEUE_TIMEOUT_S = float(st.secrets.get("SUBMIT_QUEUE_TIMEOUT_S", 120))
+
+metrics.configure(
+    enabled=bool(st.secrets.get("METRICS_ENABLED", True)),
+    prom_path=st.secrets.get("METRICS_FILE", ".spool/metrics.prom"),
+    log_spans=bool(st.secrets.get("METRICS_LOG_SPANS", False)),
+    profile=bool(st.secrets.get("PROFILE_SUBMIT", False)),
+    profile_dir=st.secrets.get("PROFILE_DIR", ".spool/profiles"),
+)
+# Reruns cut short by st.stop() or st.rerun() are not counted here, the
+# submit span still covers the ones that stop inside the submit block
+rerun_timer = metrics.timer("rerun")
 
 CATEGORIES = [
     "Airfare",
@@ -37,193 +69,322 @@ CATEGORIES = [
     "Gas for Rental Car",
     "Other",
 ]
+PAYERS = ["Employee", "Performa"]
 
 
 # -----------------------------
 # Helpers
 # -----------------------------
-def bytes_from_uploaded_file(uploaded_file) -> bytes:
-    if uploaded_file is None:
-        return b""
-    return uploaded_file.getvalue()
-
-
-def total_receipt_bytes(expenses: List[Dict[str, Any]]) -> int:
-    total = 0
-    for e in expenses:
-        f = e.get("receipt_file")
-        if f is not None:
-            total += len(bytes_from_uploaded_file(f))
-    return total
-
-
-def calc_trip_days(departure: date, ret: date) -> int:
-    if not departure or not ret:
-        return 0
-    if ret < departure:
-        return 0
-    return (ret - departure).days + 1
-
-
-def calc_totals(expenses: List[Dict[str, Any]]) -> Dict[str, float]:
-    total_spend = 0.0
-    company_paid = 0.0
-    employee_paid = 0.0
-
-    for e in expenses:
-        amt = float(e.get("amount") or 0)
-        total_spend += amt
-        if e.get("paid_by") == "Performa":
-            company_paid += amt
-        else:
-            employee_paid += amt
+@st.cache_resource
+def load_pipeline():
+    """The submit_pipeline module, imported and warmed once per process."""
+    import submit_pipeline
 
-    return {
-        "total_spend": total_spend,
-        "company_paid": company_paid,
-        "employee_paid": employee_paid,
-    }
+    submit_pipeline.warm_up()
+    return submit_pipeline
 
 
-def build_email_html(
-    employee_name: str,
-    employee_email: str,
-    location: str,
-    purpose: str,
-    departure_date: date,
-    return_date: date,
-    per_diem_total: float,
-    total_spend: float,
-    company_paid: float,
-    employee_paid: float,
-    reimbursement_due: float,
-    expenses: List[Dict[str, Any]],
-) -> str:
-    # Simple, clean HTML that reads well in Outlook and Gmail
-    # No em dashes used
-    def esc(x: Optional[str]) -> str:
-        if x is None:
-            return ""
-        return (
-            str(x)
-            .replace("&", "&amp;")
-            .replace("<", "&lt;")
-            .replace(">", "&gt;")
-        )
+@st.cache_resource
+def get_submission_queue() -> "SubmissionQueue":
+    from submission_queue import SubmissionQueue
 
-    lines_html = ""
-    if expenses:
-        rows = []
-        for i, e in enumerate(expenses, start=1):
-            rows.append(
-                f"""
-                <tr>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;">{i}</td>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;">{esc(e.get("category",""))}</td>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;">{esc(e.get("expense_date",""))}</td>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;">{esc(e.get("description",""))}</td>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;">{esc(e.get("paid_by",""))}</td>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;text-align:right;">${float(e.get("amount") or 0):,.2f}</td>
-                  <td style="padding:6px 8px;border-bottom:1px solid #eee;">{"Yes" if e.get("receipt_file") else "No"}</td>
-                </tr>
-                """
-            )
-        lines_html = f"""
-        <p><strong>Line items:</strong></p>
-        <table style="border-collapse:collapse;width:100%;font-family:Arial, sans-serif;font-size:13px;">
-          <thead>
-            <tr>
-              <th style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;">#</th>
-              <th style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;">Category</th>
-              <th style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;">Date</th>
-              <th style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;">Description</th>
-              <th style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;">Paid By</th>
-              <th style="text-align:right;padding:6px 8px;border-bottom:2px solid #ddd;">Amount</th>
-              <th style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;">Receipt</th>
-            </tr>
-          </thead>
-          <tbody>
-            {''.join(rows)}
-          </tbody>
-        </table>
-        """
-
-    html = f"""
-    <div style="font-family:Arial, sans-serif;font-size:14px;color:#111;">
-      <p>Dear Performa Finance,</p>
-
-      <p>Please find attached the submitted expense report for <strong>{esc(employee_name)}</strong> and accompanying receipts.</p>
-
-      <p><strong>Details below:</strong></p>
-
-      <table style="border-collapse:collapse;font-family:Arial, sans-serif;font-size:13px;">
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Employee Name:</strong></td><td style="padding:4px 0;">{esc(employee_name)}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Employee Email:</strong></td><td style="padding:4px 0;">{esc(employee_email)}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Trip Location:</strong></td><td style="padding:4px 0;">{esc(location)}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Business Purpose:</strong></td><td style="padding:4px 0;">{esc(purpose)}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Departure Date:</strong></td><td style="padding:4px 0;">{esc(departure_date)}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Return Date:</strong></td><td style="padding:4px 0;">{esc(return_date)}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Per Diem Total:</strong></td><td style="padding:4px 0;">${per_diem_total:,.2f}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Total Spend:</strong></td><td style="padding:4px 0;">${total_spend:,.2f}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Company Paid:</strong></td><td style="padding:4px 0;">${company_paid:,.2f}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Employee Paid:</strong></td><td style="padding:4px 0;">${employee_paid:,.2f}</td></tr>
-        <tr><td style="padding:4px 10px 4px 0;"><strong>Reimbursement Due:</strong></td><td style="padding:4px 0;">${reimbursement_due:,.2f}</td></tr>
-      </table>
-
-      {lines_html}
-
-      <p>Please let me know if any additional information is required.</p>
-
-      <p>Best regards,<br>{esc(employee_name)}</p>
-    </div>
-    """
-    return html
+    return SubmissionQueue(
+        spool_dir=st.secrets.get("SUBMISSION_SPOOL_DIR", ".spool/submissions"),
+        workers=int(st.secrets.get("SUBMISSION_WORKERS", 2)),
+        max_attempts=int(st.secrets.get("SUBMISSION_MAX_ATTEMPTS", 5)),
+        # Days a sent job's spool folder, attachments included, is kept. 0 keeps them all
+        retention_s=float(st.secrets.get("SUBMISSION_RETENTION_DAYS", 7)) * 86400 or None,
+    )
 
 
-def send_email_with_attachments(
-    subject: str,
-    html_body: str,
-    employee_email: str,
-    attachments: List[Dict[str, Any]],
-) -> int:
-    """
-    attachments = [{ "filename": str, "content_bytes": bytes, "mime_type": str }]
-    """
-    sg = SendGridAPIClient(st.secrets["SENDGRID_API_KEY"])
+@st.cache_resource
+def get_finance_digest() -> "FinanceDigest":
+    from finance_digest import FinanceDigest
 
-    msg = Mail(
-        from_email=Email(st.secrets["SENDER_EMAIL"]),
-        to_emails=To(st.secrets["FINANCE_EMAIL"]),
-        subject=subject,
-        html_content=html_body,
+    return FinanceDigest(
+        spool_dir=st.secrets.get("DIGEST_SPOOL_DIR", ".spool/digest"),
+        interval_s=float(st.secrets.get("DIGEST_INTERVAL_MINUTES", 60)) * 60,
+        max_reports=int(st.secrets.get("DIGEST_MAX_REPORTS", 50)),
+        max_bytes=int(MAX_ATTACHMENT_MB * 1024 * 1024),
+        max_attempts=int(st.secrets.get("DIGEST_MAX_ATTEMPTS", 5)),
     )
 
-    # CC approver and employee (employee is dynamic from the form)
-    msg.add_cc(Cc(st.secrets["APPROVER_EMAIL"]))
-    msg.add_cc(Cc(employee_email))
-
-    # Add attachments
-    for a in attachments:
-        b = a["content_bytes"]
-        encoded = base64.b64encode(b).decode("utf-8")
-        msg.add_attachment(
-            Attachment(
-                FileContent(encoded),
-                FileName(a["filename"]),
-                FileType(a["mime_type"]),
-                Disposition("attachment"),
-            )
-        )
 
-    resp = sg.send(msg)
-    return resp.status_code
+@st.cache_resource
+def get_receipt_store() -> ReceiptStore:
+    max_mb = st.secrets.get("RECEIPT_STORE_MAX_MB")
+    return ReceiptStore(
+        root=st.secrets.get("RECEIPT_STORE_DIR", ".spool/receipts"),
+        max_bytes=int(float(max_mb) * 1024 * 1024) if max_mb else None,
+        # A saved draft may be restored after every session holding its receipts is gone
+        keep=get_draft_store().has_receipt,
+    )
+
+
+@st.cache_resource
+def get_draft_store() -> DraftStore:
+    return DraftStore(st.secrets.get("DRAFT_DB_PATH", ".spool/drafts.sqlite3"))
+
+
+@st.cache_resource
+def get_report_archive() -> ReportArchive:
+    return ReportArchive(st.secrets.get("ARCHIVE_DB_PATH", ".spool/archive.sqlite3"))
+
+
+@st.cache_resource
+def get_columnar_export() -> "ColumnarExport":
+    from columnar_export import ColumnarExport
+
+    return ColumnarExport(COLUMNAR_EXPORT_DIR, st.secrets.get("COLUMNAR_EXPORT_FORMAT"))
+
+
+@st.cache_resource
+def get_duplicate_index() -> DuplicateIndex:
+    return DuplicateIndex(st.secrets.get("DUPLICATE_INDEX_PATH", ".spool/duplicates.sqlite3"))
+
+
+def _secret_bytes(key: str, default_mb):
+    value = st.secrets.get(key, default_mb)
+    return int(float(value) * 1024 * 1024) if value else None
+
+
+@st.cache_resource
+def get_memory_governor() -> MemoryGovernor:
+    return MemoryGovernor(
+        max_session_bytes=_secret_bytes("MAX_SESSION_RECEIPT_MB", 100),
+        max_total_bytes=_secret_bytes("MAX_TOTAL_RECEIPT_MB", 2048),
+        idle_s=float(st.secrets.get("SESSION_IDLE_MINUTES", 30)) * 60,
+        max_concurrent_submits=int(st.secrets.get("MAX_CONCURRENT_SUBMITS", 2)),
+        max_submit_bytes=_secret_bytes("MAX_SUBMIT_MEMORY_MB", 512),
+        # Only sessions whose every line is in the draft are evicted, the user restores them from it
+        can_evict=lambda owner, lines: get_draft_store().count(owner) >= lines,
+    )
+
+
+def fx_rates() -> FxRates:
+    # Cached by file mtime in fx_rates, a new rates file is picked up on the next rerun
+    return load_rates(FX_RATES_PATH, FX_MAX_AGE_DAYS)
+
+
+def travel_policy() -> Policy:
+    # Compiled once per rules file version in policy, like the FX rates. A bad file
+    # is parsed once too, its PolicyError is cached until the file changes
+    try:
+        return load_policy(POLICY_RULES_PATH, PER_DIEM_RATE)
+    except PolicyError as ex:
+        st.error(f"Policy rules not loaded, using ${PER_DIEM_RATE:,.0f} per day and no caps: {ex}")
+        return load_policy(None, PER_DIEM_RATE)
+
+
+def add_to_finance_digest(pipeline, trip_info: Dict[str, Any], package: Dict[str, Any]) -> bool:
+    """Spools the report for the Finance digest. False, with the error shown, if it could not be."""
+    try:
+        pipeline.add_to_digest(get_finance_digest(), trip_info, st.session_state.expenses, package)
+    except Exception as ex:
+        metrics.incr("submissions_total", result="digest_failed")
+        st.error(f"Your copy was sent, but the report could not be added to the Finance digest: {ex}")
+        return False
+    return True
+
+
+def archive_report(trip_info: Dict[str, Any], expenses, job_id=None) -> None:
+    # The report is already on its way, a failed archive write must not undo that
+    try:
+        report_id = get_report_archive().archive(trip_info, expenses, job_id=job_id)
+        get_duplicate_index().record(trip_info["employee_email"], expenses, report_id=report_id)
+    except Exception as ex:
+        st.warning(f"Report sent but could not be archived: {ex}")
+        return
+    if COLUMNAR_EXPORT_DIR:
+        try:
+            with metrics.span("submit.export"):
+                get_columnar_export().append(trip_info, expenses, report_id=report_id)
+        except Exception as ex:
+            st.warning(f"Report sent but could not be added to the analytics export: {ex}")
+
+
+def draft_token() -> str:
+    """
+    This browser's draft token. Kept in the page address, so a reload or a
+    bookmark finds the draft again and nobody else's browser can.
+    """
+    token = st.query_params.get("draft", "")
+    if len(token) != 32 or not all(c in "0123456789abcdef" for c in token):
+        token = uuid.uuid4().hex
+        st.query_params["draft"] = token
+    return token
+
+
+def wait_for_submit_slot(ticket: SubmitTicket) -> None:
+    """Shows the report's place in line until it is admitted, stops the run if that takes too long."""
+    if ticket.admitted:
+        return
+    metrics.incr("submits_queued_total")
+    notice = st.empty()
+    deadline = time.monotonic() + SUBMIT_QUEUE_TIMEOUT_S
+    with metrics.span("submit.queue"):
+        while not ticket.wait(timeout=0.5):
+            if time.monotonic() >= deadline:
+                notice.empty()
+                metrics.incr("submissions_total", result="busy")
+                st.error("Too many reports are being submitted right now. Please try again in a minute.")
+                st.stop()
+            notice.info(f"Other reports are being submitted, yours is number {ticket.position()} in line.")
+    notice.empty()
+
+
+@st.cache_resource
+def get_receipt_cache() -> "ReceiptCache":
+    from receipt_optimizer import ReceiptCache
+
+    return ReceiptCache(st.secrets.get("RECEIPT_CACHE_DIR", ".spool/receipt_cache"))
+
+
+# -----------------------------
+# Line item table
+# -----------------------------
+def line_item_columns(expenses) -> Dict[str, list]:
+    cols: Dict[str, list] = {
+        "Line": [],
+        "Category": [],
+        "Date": [],
+        "Paid By": [],
+        "Description": [],
+        "Currency": [],
+        "Amount": [],
+        CONVERTED: [],
+        "Receipt": [],
+    }
+    for idx, e in enumerate(expenses, start=1):
+        receipt = e.get("receipt_file")
+        cols["Line"].append(idx)
+        cols["Category"].append(e["category"])
+        cols["Date"].append(e["expense_date"])
+        cols["Paid By"].append(e["paid_by"])
+        cols["Description"].append(e["description"] or "")
+        cols["Currency"].append(e.get("currency") or BASE_CURRENCY)
+        cols["Amount"].append(original_amount(e))
+        cols[CONVERTED].append(float(e["amount"]))
+        cols["Receipt"].append(receipt.name if receipt else "")
+    return cols
+
+
+# Amount is as entered, in the line's currency, the converted column is read-only
+CONVERTED = f"In {BASE_CURRENCY}"
+# Table column to expense key, for the editable columns
+EDITABLE = {
+    "Category": "category",
+    "Date": "expense_date",
+    "Paid By": "paid_by",
+    "Description": "description",
+    "Currency": "currency",
+    "Amount": "original_amount",
+}
+
+
+def apply_line_item_changes(editor_key: str, owner: str) -> None:
+    """on_change of the line item table, writes edits and deletions back to the store and the draft."""
+    changes = st.session_state[editor_key]
+    store = st.session_state.expenses
+    drafts = get_draft_store() if owner else None
+    moved = False
+
+    edited = []
+    for idx, edits in changes.get("edited_rows", {}).items():
+        expense = dict(store[int(idx)])
+        for column, value in edits.items():
+            if column == "Date":
+                value = date.fromisoformat(str(value)[:10]) if value else expense["expense_date"]
+            elif column == "Amount":
+                value = float(value or 0)
+            expense[EDITABLE[column]] = value
+        edited.append((int(idx), expense, edits))
+    try:
+        # One batch for all edited lines, a new date or currency gets its own rate
+        apply_fx([expense for _idx, expense, _edits in edited], fx_rates())
+    except FxError as ex:
+        st.session_state.line_items_error = f"Edit not saved: {ex}"
+        edited = []
+
+    for idx, expense, edits in edited:
+        store.replace(idx, expense)
+        # A description edit changes nothing the rest of the page shows
+        moved = moved or any(column != "Description" for column in edits)
+        if drafts:
+            drafts.update(owner, expense)
+
+    deleted = changes.get("deleted_rows", [])
+    if deleted:
+        removed = store.pop_many(deleted)
+        moved = True
+        if drafts:
+            drafts.remove_many(owner, [e.get("draft_id") for e in removed])
+
+    st.session_state.line_items_moved = moved
+
+
+@st.fragment
+def line_items_table(owner: str) -> None:
+    """
+    Editable table of the line items. Edits rerun only this fragment, the
+    whole page reruns when one changes the totals or the duplicate check.
+    """
+    expenses = st.session_state.expenses
+    if st.session_state.pop("line_items_moved", False):
+        st.rerun()
+    if "line_items_error" in st.session_state:
+        st.error(st.session_state.pop("line_items_error"))
+    if not expenses:
+        st.write("No expenses added yet.")
+        return
+
+    # Keyed by version, so a new table state starts from the updated list
+    editor_key = f"line_items_{expenses.version}"
+    currencies = fx_rates().currencies()
+    columns = list(line_item_columns([]))
+    if len(currencies) == 1:
+        columns = [c for c in columns if c not in ("Currency", CONVERTED)]
+    st.data_editor(
+        expenses.cached("table", lambda: line_item_columns(expenses)),
+        key=editor_key,
+        num_rows="delete",
+        hide_index=True,
+        column_order=columns,
+        column_config={
+            "Category": st.column_config.SelectboxColumn(options=CATEGORIES, required=True),
+            "Date": st.column_config.DateColumn(required=True),
+            "Paid By": st.column_config.SelectboxColumn(options=PAYERS, required=True),
+            "Currency": st.column_config.SelectboxColumn(options=currencies, required=True),
+            "Amount": st.column_config.NumberColumn(min_value=0.0, format="%.2f", required=True),
+            CONVERTED: st.column_config.NumberColumn(format="$%.2f"),
+        },
+        disabled=["Line", CONVERTED, "Receipt"],
+        on_change=apply_line_item_changes,
+        args=(editor_key, owner),
+    )
+    st.caption("Edit cells in place. To remove lines, select their rows and press Delete.")
 
 
 # -----------------------------
 # App state
 # -----------------------------
 if "expenses" not in st.session_state:
-    st.session_state.expenses = []
+    st.session_state.expenses = ExpenseStore()
+elif not isinstance(st.session_state.expenses, ExpenseStore):
+    st.session_state.expenses = ExpenseStore(st.session_state.expenses)
+
+if "submission_jobs" not in st.session_state:
+    st.session_state.submission_jobs = []
+
+# Started on the first rerun, not the first submit, so jobs spooled before a restart are sent straight away
+get_submission_queue()
+if FINANCE_DIGEST:
+    # Likewise, reports spooled for the digest before a restart are flushed on schedule
+    get_finance_digest()
+
+# Names this session to the memory governor
+if "session_key" not in st.session_state:
+    st.session_state.session_key = uuid.uuid4().hex
 
 
 # -----------------------------
@@ -248,43 +409,97 @@ with col3:
 with col4:
     return_date = st.date_input("Return Date", value=date.today())
 
-trip_days = calc_trip_days(departure_date, return_date)
-per_diem_total = PER_DIEM_RATE * trip_days
-st.info(f"Per diem is ${PER_DIEM_RATE:,.0f} per day, {trip_days} day(s), total ${per_diem_total:,.2f}")
+# Drafts are keyed by the email and this page's draft token, every add and
+# remove below is saved as it happens
+owner = draft_owner(employee_email, draft_token()) if employee_email.strip() else ""
+
+# Receipt bytes held by this session, an idle one can be evicted while the host is short of memory
+if get_memory_governor().touch(st.session_state.session_key, st.session_state.expenses, owner):
+    st.info("Your line items were unloaded while this page was idle. Restore them from your saved draft.")
+
+if owner and not st.session_state.expenses:
+    saved_count = get_draft_store().count(owner)
+    if saved_count:
+        st.info(f"You have {saved_count} saved line item(s) from an earlier session.")
+        if st.button("Restore saved draft"):
+            restored = get_draft_store().load(owner, get_receipt_store())
+            try:
+                # Converted again as one batch, the rates file may have changed since
+                apply_fx(restored, fx_rates())
+            except FxError as ex:
+                st.session_state.line_items_error = f"Restored with the amounts as saved, could not convert: {ex}"
+            st.session_state.expenses = ExpenseStore(restored)
+            st.rerun()
+
+per_diem = travel_policy().per_diem(location, departure_date, return_date, PARTIAL_DAY_FACTOR)
+trip_days = per_diem["trip_days"]
+per_diem_rate = per_diem["per_diem_rate"]
+per_diem_total = per_diem["per_diem_total"]
+st.info(f"Per diem is ${per_diem_rate:,.2f} per day, {trip_days:g} day(s), total ${per_diem_total:,.2f}")
 
 st.subheader("Expenses")
 
-with st.expander("Add an expense", expanded=True):
-    c1, c2, c3 = st.columns([2, 2, 2])
-    with c1:
-        category = st.selectbox("Category", CATEGORIES)
-    with c2:
-        expense_date = st.date_input("Expense Date", value=date.today())
-    with c3:
-        paid_by = st.radio("Paid By", ["Employee", "Performa"], horizontal=True)
-
-    description = st.text_input("Description (optional)")
-    amount = st.number_input("Amount", min_value=0.0, value=0.0, step=1.0, format="%.2f")
-
-    receipt_file = st.file_uploader(
-        "Receipt (optional)",
-        type=["pdf", "png", "jpg", "jpeg"],
-        accept_multiple_files=False,
-        help="Accepted: PDF, JPG, JPEG, PNG",
-    )
+currencies = fx_rates().currencies()
 
-    if st.button("Add Expense"):
-        st.session_state.expenses.append(
-            {
-                "category": category,
-                "expense_date": expense_date,
-                "paid_by": paid_by,
-                "description": description,
-                "amount": float(amount),
-                "receipt_file": receipt_file,
-            }
+with st.expander("Add an expense", expanded=True):
+    # A form, so filling in the fields does not rerun the script, only Add Expense does
+    with st.form("add_expense", clear_on_submit=True, border=False):
+        c1, c2, c3 = st.columns([2, 2, 2])
+        with c1:
+            category = st.selectbox("Category", CATEGORIES)
+        with c2:
+            expense_date = st.date_input("Expense Date", value=date.today())
+        with c3:
+            paid_by = st.radio("Paid By", PAYERS, horizontal=True)
+
+        description = st.text_input("Description (optional)")
+        if len(currencies) > 1:
+            a1, a2 = st.columns([4, 1])
+            with a1:
+                amount = st.number_input("Amount", min_value=0.0, value=0.0, step=1.0, format="%.2f")
+            with a2:
+                currency = st.selectbox("Currency", currencies)
+        else:
+            amount = st.number_input("Amount", min_value=0.0, value=0.0, step=1.0, format="%.2f")
+            currency = BASE_CURRENCY
+
+        receipt_file = st.file_uploader(
+            "Receipt (optional)",
+            type=["pdf", "png", "jpg", "jpeg"],
+            accept_multiple_files=False,
+            help="Accepted: PDF, JPG, JPEG, PNG",
         )
-        st.success("Expense added.")
+        add_expense = st.form_submit_button("Add Expense")
+
+    if add_expense and not get_memory_governor().fits_session(st.session_state.expenses, receipt_size(receipt_file)):
+        limit_mb = get_memory_governor().max_session_bytes / 1024 / 1024
+        st.error(f"Expense not added: the receipts of one report are limited to {limit_mb:,.0f} MB.")
+    elif add_expense:
+        expense = {
+            "category": category,
+            "expense_date": expense_date,
+            "paid_by": paid_by,
+            "description": description,
+            "amount": float(amount),
+            "currency": currency,
+        }
+        try:
+            apply_fx([expense], fx_rates())
+        except FxError as ex:
+            st.error(f"Expense not added: {ex}")
+        else:
+            # Only a hash and size stay in session state, bytes go to the store
+            expense["receipt_file"] = get_receipt_store().put_upload(receipt_file)
+            if owner:
+                get_draft_store().add(owner, expense)
+            st.session_state.expenses.append(expense)
+            st.success(
+                "Expense added. Bookmark this page to come back to your draft."
+                if owner
+                else "Expense added. Enter your email to save a draft."
+            )
+    if len(currencies) > 1:
+        st.caption(f"Amounts in other currencies are converted to {BASE_CURRENCY} at the rate of the expense date.")
 
 
 st.subheader("Summary")
@@ -303,153 +518,223 @@ s3.metric("Employee Paid", f"${employee_paid:,.2f}")
 s4.metric("Reimbursement Due", f"${reimbursement_due:,.2f}")
 
 st.subheader("Current Line Items")
-if not st.session_state.expenses:
-    st.write("No expenses added yet.")
-else:
-    for idx, e in enumerate(st.session_state.expenses, start=1):
-        receipt_note = "Receipt attached" if e.get("receipt_file") else "No receipt"
-        st.write(
-            f"{idx}. {e['category']} on {e['expense_date']}, {e['description'] or '$0'}, "
-            f"${float(e['amount']):,.2f}, Paid by {e['paid_by']}, {receipt_note}"
-        )
-
-    remove_idx = st.number_input(
-        "Remove line item number",
-        min_value=0,
-        max_value=len(st.session_state.expenses),
-        value=0,
-        step=1,
-        help="Enter the line number to remove, 0 means do nothing.",
-    )
-    if st.button("Remove Selected Line Item"):
-        if remove_idx == 0:
-            st.info("No line item selected.")
-        else:
-            st.session_state.expenses.pop(int(remove_idx) - 1)
-            st.success("Removed.")
+line_items_table(owner)
 
 
 # Attachment sizing and submit
 st.divider()
 
-st.caption(
-    f"Attachment limit enforced at {MAX_ATTACHMENT_MB:,.0f} MB total for receipts plus the Excel file."
+if SPLIT_LARGE_REPORTS:
+    st.caption(
+        f"Attachment limit is {MAX_ATTACHMENT_MB:,.0f} MB per email. "
+        "Larger reports are sent in several numbered emails."
+    )
+else:
+    st.caption(
+        f"Attachment limit enforced at {MAX_ATTACHMENT_MB:,.0f} MB total for receipts plus the Excel file."
+    )
+
+# Checked against the caps of the trip's location, again only when the list or the trip changes
+policy_issues = (
+    st.session_state.expenses.cached(
+        f"policy {location.strip().casefold()} {departure_date} {return_date}",
+        lambda: travel_policy().check(
+            {"location": location, "departure_date": departure_date, "return_date": return_date},
+            st.session_state.expenses,
+        ),
+    )
+    if st.session_state.expenses
+    else []
+)
+if policy_issues:
+    st.warning("Over policy:\n" + "\n".join(f"- {v['message']}" for v in policy_issues))
+
+# Checked whenever the list or the index changes, so a repeat shows up as soon
+# as it is added and a report shows up as a duplicate of itself once submitted
+duplicate_issues = (
+    st.session_state.expenses.cached(
+        f"duplicates {get_duplicate_index().generation()}",
+        lambda: get_duplicate_index().scan(st.session_state.expenses),
+    )
+    if st.session_state.expenses
+    else []
 )
+confirm_duplicates = True
+if duplicate_issues:
+    st.warning(
+        "Possible duplicates:\n"
+        + "\n".join(f"- Line {i}: {reason}" for i, reason in duplicate_issues)
+    )
+    # Keyed by the issues, so a confirmation does not carry over to new ones
+    confirm_duplicates = st.checkbox(
+        "These are not duplicates, submit anyway", key=f"confirm_duplicates {hash(tuple(duplicate_issues))}"
+    )
 
 submit = st.button("Submit Expense Report", type="primary")
 
 if submit:
-    # Basic validation
-    missing = []
-    if not employee_name.strip():
-        missing.append("Employee Name")
-    if not employee_email.strip():
-        missing.append("Employee Email")
-    if not location.strip():
-        missing.append("Trip Location")
-    if not purpose.strip():
-        missing.append("Business Purpose")
-
-    if return_date < departure_date:
-        missing.append("Return Date must be on or after Departure Date")
-
-    if missing:
-        st.error("Please complete the following fields: " + ", ".join(missing))
-        st.stop()
-
-    # Build Excel
-    trip_info = {
-        "employee_name": employee_name,
-        "employee_email": employee_email,
-        "location": location,
-        "purpose": purpose,
-        "departure_date": departure_date,
-        "return_date": return_date,
-        "trip_days": trip_days,
-        "per_diem_rate": PER_DIEM_RATE,
-        "per_diem_total": per_diem_total,
-        "total_spend": total_spend,
-        "company_paid": company_paid,
-        "employee_paid": employee_paid,
-        "reimbursement_due": reimbursement_due,
-    }
-
-    # generate_excel should return bytes
-    excel_bytes = generate_excel(trip_info, st.session_state.expenses)
-
-    # Prepare attachments: Excel + receipts
-    attachments: List[Dict[str, Any]] = []
-    attachments.append(
-        {
-            "filename": f"Expense_Report_{employee_name.replace(' ', '_')}.xlsx",
-            "content_bytes": excel_bytes,
-            "mime_type": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    with metrics.span("submit"), metrics.profile("submit"):
+        # Basic validation
+        missing = []
+        if not employee_name.strip():
+            missing.append("Employee Name")
+        if not employee_email.strip():
+            missing.append("Employee Email")
+        if not location.strip():
+            missing.append("Trip Location")
+        if not purpose.strip():
+            missing.append("Business Purpose")
+
+        if return_date < departure_date:
+            missing.append("Return Date must be on or after Departure Date")
+
+        if missing:
+            st.error("Please complete the following fields: " + ", ".join(missing))
+            st.stop()
+
+        if not confirm_duplicates:
+            st.error("Please review the possible duplicates above before submitting.")
+            st.stop()
+
+        # Workbook, receipts and email body
+        trip_info = {
+            "employee_name": employee_name,
+            "employee_email": employee_email,
+            "location": location,
+            "purpose": purpose,
+            "departure_date": departure_date,
+            "return_date": return_date,
+            "trip_days": trip_days,
+            "per_diem_rate": per_diem_rate,
+            "per_diem_total": per_diem_total,
+            "total_spend": total_spend,
+            "company_paid": company_paid,
+            "employee_paid": employee_paid,
+            "reimbursement_due": reimbursement_due,
         }
-    )
-
-    # Receipts
-    for i, e in enumerate(st.session_state.expenses, start=1):
-        f = e.get("receipt_file")
-        if f is None:
-            continue
-        b = bytes_from_uploaded_file(f)
-        ext = (f.name.split(".")[-1] or "").lower()
-        if ext in ["jpg", "jpeg"]:
-            mime = "image/jpeg"
-        elif ext == "png":
-            mime = "image/png"
-        else:
-            mime = "application/pdf"
-
-        safe_cat = str(e.get("category", "Receipt")).replace(" ", "_")
-        filename = f"{i:02d}_{safe_cat}_{employee_name.replace(' ', '_')}.{ext if ext else 'pdf'}"
 
-        attachments.append(
-            {"filename": filename, "content_bytes": b, "mime_type": mime}
+        # A bounded number of submits at once, each holds several copies of the receipts
+        ticket = get_memory_governor().request_submit(
+            st.session_state.session_key, submit_cost(st.session_state.expenses.receipt_bytes)
         )
-
-    # Enforce max total size
-    total_bytes = sum(len(a["content_bytes"]) for a in attachments)
-    max_bytes = int(MAX_ATTACHMENT_MB * 1024 * 1024)
-    if total_bytes > max_bytes:
-        st.error(
-            f"Attachments are too large: {total_bytes/1024/1024:,.2f} MB. "
-            f"Limit is {MAX_ATTACHMENT_MB:,.0f} MB. Remove some receipts or compress them."
-        )
-        st.stop()
-
-    # Email content
-    subject = (
-        f"Expense Report Submitted, {employee_name}, {location}, "
-        f"{departure_date} to {return_date}"
-    )
-
-    html_body = build_email_html(
-        employee_name=employee_name,
-        employee_email=employee_email,
-        location=location,
-        purpose=purpose,
-        departure_date=departure_date,
-        return_date=return_date,
-        per_diem_total=per_diem_total,
-        total_spend=total_spend,
-        company_paid=company_paid,
-        employee_paid=employee_paid,
-        reimbursement_due=reimbursement_due,
-        expenses=st.session_state.expenses,
-    )
-
-    try:
-        status_code = send_email_with_attachments(
-            subject=subject,
-            html_body=html_body,
-            employee_email=employee_email,
-            attachments=attachments,
-        )
-
-        if 200 <= int(status_code) < 300:
-            st.success("Submitted successfully. Check your email for the package.")
+        with ticket:
+            wait_for_submit_slot(ticket)
+
+            pipeline = load_pipeline()
+            max_bytes = int(MAX_ATTACHMENT_MB * 1024 * 1024)
+            try:
+                package = pipeline.build_package(
+                    trip_info,
+                    st.session_state.expenses,
+                    optimize=OPTIMIZE_RECEIPTS,
+                    cache=get_receipt_cache(),
+                    merge_pdf=MERGE_RECEIPTS_PDF,
+                    max_bytes=max_bytes,
+                    split=SPLIT_LARGE_REPORTS,
+                )
+            except pipeline.AttachmentsTooLarge as ex:
+                # Stopped as soon as the receipts could no longer fit
+                metrics.incr("submissions_total", result="too_large")
+                if SPLIT_LARGE_REPORTS:
+                    st.error(
+                        f"An attachment is too large to email: {ex.total_bytes/1024/1024:,.2f} MB. "
+                        f"Limit is {MAX_ATTACHMENT_MB:,.0f} MB per email. Compress or split that receipt."
+                    )
+                else:
+                    st.error(
+                        f"Attachments are too large: at least {ex.total_bytes/1024/1024:,.2f} MB. "
+                        f"Limit is {MAX_ATTACHMENT_MB:,.0f} MB. Remove some receipts or compress them."
+                    )
+                st.stop()
+            receipt_stats = package["receipt_stats"]
+            metrics.incr("receipt_bytes_saved_total", receipt_stats["bytes_saved"])
+            if receipt_stats["bytes_saved"] > 0:
+                st.caption(
+                    f"Receipts compressed from {receipt_stats['bytes_in']/1024/1024:,.2f} MB "
+                    f"to {receipt_stats['bytes_out']/1024/1024:,.2f} MB."
+                )
+
+            # Enforce max total size
+            total_bytes = package["total_bytes"]
+            n_parts = len(package["parts"])
+            if n_parts == 1 and total_bytes > max_bytes:
+                metrics.incr("submissions_total", result="too_large")
+                st.error(
+                    f"Attachments are too large: {total_bytes/1024/1024:,.2f} MB. "
+                    f"Limit is {MAX_ATTACHMENT_MB:,.0f} MB. Remove some receipts or compress them."
+                )
+                st.stop()
+
+            metrics.incr("line_items_total", len(st.session_state.expenses))
+            metrics.incr("policy_violations_total", len(policy_issues))
+            metrics.incr("receipts_total", receipt_stats["receipts"])
+            metrics.incr("attachment_bytes_total", total_bytes)
+            if n_parts > 1:
+                metrics.incr("split_reports_total")
+                metrics.incr("split_parts_total", n_parts)
+                st.info(
+                    f"The attachments are over {MAX_ATTACHMENT_MB:,.0f} MB, the report goes out in {n_parts} emails."
+                )
+
+            if ASYNC_SUBMIT:
+                try:
+                    job_ids = pipeline.enqueue(
+                        get_submission_queue(), package, employee_email, employee_only=FINANCE_DIGEST
+                    )
+                except Exception as ex:
+                    metrics.incr("submissions_total", result="failed")
+                    st.error(f"Could not queue the report: {ex}")
+                    st.stop()
+                st.session_state.submission_jobs.extend(job_ids)
+                if FINANCE_DIGEST and not add_to_finance_digest(pipeline, trip_info, package):
+                    st.stop()
+                metrics.incr("submissions_total", result="queued")
+                # The spool owns the report now, the draft is no longer needed
+                get_draft_store().clear(owner)
+                archive_report(trip_info, st.session_state.expenses, job_id=job_ids[0])
+                st.success(
+                    f"Report queued for delivery, reference {', '.join(j[:8] for j in job_ids)}. "
+                    "Delivery status is shown below."
+                )
+            else:
+                try:
+                    status_codes = pipeline.send(package, employee_email, employee_only=FINANCE_DIGEST)
+                    failed = [c for c in status_codes if not 200 <= int(c) < 300]
+
+                    if failed:
+                        metrics.incr("submissions_total", result="failed")
+                        st.error(f"SendGrid returned status code: {failed[0]}")
+                    elif not FINANCE_DIGEST or add_to_finance_digest(pipeline, trip_info, package):
+                        metrics.incr("submissions_total", result="sent")
+                        get_draft_store().clear(owner)
+                        archive_report(trip_info, st.session_state.expenses)
+                        if FINANCE_DIGEST:
+                            st.success("Submitted successfully. Finance gets the report in the next digest.")
+                        else:
+                            st.success("Submitted successfully. Check your email for the package.")
+                except Exception as ex:
+                    metrics.incr("submissions_total", result="failed")
+                    st.error(f"Email failed: {ex}")
+
+
+# Delivery status for reports queued from this session
+if st.session_state.submission_jobs:
+    from submission_queue import SENT, FAILED
+
+    st.subheader("Submission Status")
+    queue = get_submission_queue()
+    for job_id in reversed(st.session_state.submission_jobs):
+        job = queue.status(job_id)
+        if job is None:
+            st.write(f"{job_id[:8]}: unknown")
+        elif job["status"] == SENT:
+            st.success(f"{job_id[:8]}: sent. Check your email for the package.")
+        elif job["status"] == FAILED:
+            st.error(f"{job_id[:8]}: failed after {job['attempts']} attempt(s), {job['last_error']}")
         else:
-            st.error(f"SendGrid returned status code: {status_code}")
-    except Exception as ex:
-        st.error(f"Email failed: {ex}")
+            note = f", last error: {job['last_error']}" if job["last_error"] else ""
+            st.info(f"{job_id[:8]}: {job['status']}, attempt(s) {job['attempts']}{note}")
+    st.button("Refresh status")
+
+rerun_timer.stop()
+metrics.maybe_flush()
@@ -0,0 +1,198 @@
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+import metrics
+from bin_packing import first_fit_decreasing
+from expense_store import receipt_size
+from receipt_optimizer import ReceiptCache, merge_receipts_pdf, mime_for_ext, optimize_receipts
+from receipt_store import IMAGE_EXTS
+from report_utils import bytes_from_uploaded_file
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+class AttachmentsTooLarge(ValueError):
+    """The attachments cannot fit under the size limit."""
+
+    def __init__(self, total_bytes: int, max_bytes: int):
+        super().__init__(f"attachments need at least {total_bytes} bytes, limit is {max_bytes}")
+        self.total_bytes = total_bytes
+        self.max_bytes = max_bytes
+
+
+def _receipt_ext(f) -> str:
+    name = f.name or ""
+    return (name.rsplit(".", 1)[-1].lower() if "." in name else "") or "pdf"
+
+
+class SizeBudget:
+    """
+    Running lower bound of the attachment total, checked against the limit
+    every time it grows. Stages running on different threads share one
+    budget. Receipts that optimization cannot shrink count at full size
+    from the start, so a report that can never fit fails before any work.
+    """
+
+    def __init__(self, max_bytes: Optional[int]):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._final = 0
+        self._floor = 0
+
+    @property
+    def total(self) -> int:
+        return self._final + self._floor
+
+    def reserve(self, nbytes: int) -> None:
+        """Bytes that will be attached, final size not known yet."""
+        with self._lock:
+            self._floor += nbytes
+            self._check()
+
+    def settle(self, reserved: int, nbytes: int) -> None:
+        """Replace a reservation with the final size."""
+        with self._lock:
+            self._floor -= reserved
+            self._final += nbytes
+            self._check()
+
+    def _check(self) -> None:
+        if self.max_bytes is not None and self._final + self._floor > self.max_bytes:
+            raise AttachmentsTooLarge(self._final + self._floor, self.max_bytes)
+
+
+def fixed_receipt_sizes(expenses, optimize: bool = True) -> List[int]:
+    """Sizes of the receipts that optimization leaves as they are, nothing read."""
+    return [
+        receipt_size(e["receipt_file"])
+        for e in expenses
+        if e.get("receipt_file") is not None and (not optimize or _receipt_ext(e["receipt_file"]) not in IMAGE_EXTS)
+    ]
+
+
+def fixed_receipt_bytes(expenses, optimize: bool = True) -> int:
+    return sum(fixed_receipt_sizes(expenses, optimize))
+
+
+def collect_receipts(employee_name: str, expenses) -> List[Dict[str, Any]]:
+    """
+    Receipts of the line items that have one, in line order, as
+    { "stem", "content_bytes", "ext" } with the stem numbered by line.
+    """
+    safe_name = employee_name.replace(" ", "_")
+    receipts: List[Dict[str, Any]] = []
+    for i, e in enumerate(expenses, start=1):
+        f = e.get("receipt_file")
+        if f is None:
+            continue
+        safe_cat = str(e.get("category", "Receipt")).replace(" ", "_")
+        receipts.append(
+            {
+                "stem": f"{i:02d}_{safe_cat}_{safe_name}",
+                "content_bytes": bytes_from_uploaded_file(f),
+                "ext": _receipt_ext(f),
+            }
+        )
+    return receipts
+
+
+def workbook_attachment(employee_name: str, excel_bytes: bytes) -> Dict[str, Any]:
+    safe_name = employee_name.replace(" ", "_")
+    return {"filename": f"Expense_Report_{safe_name}.xlsx", "content_bytes": excel_bytes, "mime_type": XLSX_MIME}
+
+
+def assemble_receipts(
+    employee_name: str,
+    expenses,
+    optimize: bool = True,
+    cache: Optional[ReceiptCache] = None,
+    merge_pdf: bool = False,
+    budget: Optional[SizeBudget] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Receipt attachments, optimized and merged as configured, with the
+    stats of assemble_attachments. With a budget every receipt is counted
+    as soon as it is final, raising AttachmentsTooLarge part way through.
+    """
+    safe_name = employee_name.replace(" ", "_")
+    with metrics.span("submit.receipts"):
+        receipts = collect_receipts(employee_name, expenses)
+    stats = {"receipts": len(receipts), "bytes_in": 0, "bytes_out": 0, "bytes_saved": 0, "cache_hits": 0, "optimized": 0}
+
+    # What each receipt still holds in the budget until its final size is known
+    floors = [0 if optimize and r["ext"] in IMAGE_EXTS else len(r["content_bytes"]) for r in receipts]
+    if budget is not None and not merge_pdf:
+        budget.reserve(sum(floors))
+
+        def on_result(i: int, result: Dict[str, Any]) -> None:
+            budget.settle(floors[i], len(result["content_bytes"]))
+
+    else:
+        on_result = None
+
+    if optimize and receipts:
+        with metrics.span("submit.optimize"):
+            optimized, receipt_stats = optimize_receipts(receipts, cache=cache, on_result=on_result)
+        stats.update(receipt_stats)
+        for r, o in zip(receipts, optimized):
+            r.update(o)
+    elif on_result is not None:
+        for i, r in enumerate(receipts):
+            on_result(i, r)
+
+    attachments: List[Dict[str, Any]] = []
+    if merge_pdf and receipts:
+        with metrics.span("submit.merge"):
+            merged, receipts = merge_receipts_pdf(receipts)
+        if merged:
+            attachments.append(
+                {"filename": f"Receipts_{safe_name}.pdf", "content_bytes": merged, "mime_type": "application/pdf"}
+            )
+
+    for r in receipts:
+        attachments.append(
+            {
+                "filename": f"{r['stem']}.{r['ext']}",
+                "content_bytes": r["content_bytes"],
+                "mime_type": mime_for_ext(r["ext"]),
+            }
+        )
+    if budget is not None and merge_pdf:
+        # Merged output size is only known now
+        budget.settle(0, sum(len(a["content_bytes"]) for a in attachments))
+    return attachments, stats
+
+
+def assemble_attachments(
+    employee_name: str,
+    excel_bytes: bytes,
+    expenses,
+    optimize: bool = True,
+    cache: Optional[ReceiptCache] = None,
+    merge_pdf: bool = False,
+    budget: Optional[SizeBudget] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    The workbook plus every receipt, optimized and merged as configured.
+    Returns (attachments, stats), stats holding the receipt count and the
+    optimize_receipts byte counts.
+    """
+    if budget is not None:
+        budget.settle(0, len(excel_bytes))
+    receipts, stats = assemble_receipts(employee_name, expenses, optimize, cache, merge_pdf, budget)
+    return [workbook_attachment(employee_name, excel_bytes)] + receipts, stats
+
+
+def pack_attachments(attachments: List[Dict[str, Any]], max_bytes: int) -> List[List[Dict[str, Any]]]:
+    """
+    The attachments split over the fewest groups of at most max_bytes each,
+    first fit decreasing. The first attachment, the workbook, is always in
+    the first group. Raises AttachmentsTooLarge if a single attachment is
+    over the limit.
+    """
+    sizes = [len(a["content_bytes"]) for a in attachments]
+    try:
+        groups = first_fit_decreasing(sizes, max_bytes, first=0 if attachments else None)
+    except ValueError:
+        raise AttachmentsTooLarge(max(sizes), max_bytes) from None
+    return [[attachments[i] for i in g] for g in groups]
@@ -0,0 +1,495 @@
+"""
+Headless batch processing of expense reports, no browser needed.
+
+Reads trips from CSV or JSON, builds each report exactly as the app does
+(trip days, totals, Excel workbook, email body) on all cores, and writes:
+  <out>/xlsx/<nnnnn>_<employee>.xlsx
+  <out>/outbox/new/*.eml   complete messages with the workbook and receipts
+
+Input formats:
+  .json    a list of trips
+  .jsonl   one trip per line, streamed
+    trip = { employee_name, employee_email, location, purpose,
+             departure_date, return_date, expenses: [
+               { category, expense_date, description, paid_by, amount,
+                 currency (optional, USD), receipt_path (optional) } ] }
+  .csv     one line item per row with the trip columns repeated, plus
+           trip_id. Rows of a trip must be consecutive. A trip with no
+           line items is a single row with empty line item columns.
+
+Foreign currency amounts are converted with the rates in --fx-rates (see
+fx_rates for the file format), one batch per report.
+
+A trip that cannot be read or processed, a bad date or a currency with
+no rate for example, is reported on stderr and the others carry on. The
+exit status is 1 when any trip failed.
+
+Per diem comes from the rates in --policy-rules by location and date (see
+policy for the file format), --per-diem-rate where the rules have none.
+Lines over the rules' category caps are reported as warnings. With
+--audit only the caps are checked, in one vectorized pass per
+--audit-chunk reports, and the violations are written to
+<out>/policy_audit.csv. No workbooks or messages are built.
+
+With --export the reports and line items are also appended to month
+partitioned Parquet or CSV datasets under that folder, --export-chunk
+reports per part file (see columnar_export).
+
+Example:
+  python batch_cli.py trips.csv --out month_end --per-diem-rate 100 \\
+      --sender expenses@performa.com --finance finance@performa.com \\
+      --approver approver@performa.com --fx-rates fx_rates.csv
+  python batch_cli.py trips_2024.jsonl --out audit --audit \\
+      --policy-rules policy_rules.csv --fx-rates fx_rates.csv
+  python batch_cli.py trips.jsonl --out month_end --export analytics
+"""
+import argparse
+import csv
+import json
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import date
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+from columnar_export import FORMATS, ColumnarExport
+from excel_generator import generate_excel
+from fx_rates import BASE_CURRENCY, DEFAULT_MAX_AGE_DAYS, FxError, apply_fx, load_rates
+from mail_transport import FileSinkTransport
+from policy import load_policy
+from receipt_optimizer import mime_for_ext
+from report_utils import build_email_html, build_email_text, calc_totals
+
+TRIP_FIELDS = ["employee_name", "employee_email", "location", "purpose", "departure_date", "return_date"]
+ITEM_FIELDS = ["category", "expense_date", "description", "paid_by", "amount", "currency", "receipt_path"]
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+# -----------------------------
+# Input
+# -----------------------------
+def _to_date(v) -> Optional[date]:
+    if v in (None, ""):
+        return None
+    if isinstance(v, date):
+        return v
+    return date.fromisoformat(str(v)[:10])
+
+
+def _normalize_expense(e: Dict[str, Any]) -> Dict[str, Any]:
+    receipt = e.get("receipt_path") or None
+    return {
+        "category": e.get("category") or "Other",
+        "expense_date": _to_date(e.get("expense_date")) or "",
+        "description": e.get("description") or "",
+        "paid_by": e.get("paid_by") or "Employee",
+        "amount": float(e.get("amount") or 0),
+        "currency": (e.get("currency") or BASE_CURRENCY).strip().upper(),
+        # Truthy path marks the receipt as attached, like the UploadedFile in the app
+        "receipt_file": receipt,
+    }
+
+
+def _normalize_trip(t: Dict[str, Any]) -> Dict[str, Any]:
+    trip = {k: t.get(k) or "" for k in TRIP_FIELDS}
+    trip["departure_date"] = _to_date(trip["departure_date"])
+    trip["return_date"] = _to_date(trip["return_date"])
+    trip["expenses"] = [_normalize_expense(e) for e in t.get("expenses") or []]
+    return trip
+
+
+def _checked_trip(t) -> Dict[str, Any]:
+    """A normalized trip, or { "employee_name", "error" } for one that cannot be read."""
+    try:
+        return _normalize_trip(t)
+    except (AttributeError, TypeError, ValueError) as ex:
+        name = t.get("employee_name") if isinstance(t, dict) else None
+        return {"employee_name": str(name or ""), "error": f"bad input: {ex}"}
+
+
+def iter_trips(path: str) -> Iterator[Dict[str, Any]]:
+    """
+    Stream trips from a .csv, .json or .jsonl file. A trip that cannot be
+    read comes through as { "employee_name", "error" }, so one bad trip
+    does not end the batch.
+    """
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".jsonl":
+        with open(path, encoding="utf-8") as fh:
+            for line in fh:
+                if not line.strip():
+                    continue
+                try:
+                    trip = json.loads(line)
+                except ValueError as ex:
+                    yield {"employee_name": "", "error": f"bad input: {ex}"}
+                    continue
+                yield _checked_trip(trip)
+    elif ext == ".json":
+        with open(path, encoding="utf-8") as fh:
+            for t in json.load(fh):
+                yield _checked_trip(t)
+    elif ext == ".csv":
+        with open(path, newline="", encoding="utf-8") as fh:
+            current_id = None
+            current: Optional[Dict[str, Any]] = None
+            for row in csv.DictReader(fh):
+                trip_id = row.get("trip_id") or "|".join(row.get(k, "") for k in TRIP_FIELDS)
+                if trip_id != current_id:
+                    if current is not None:
+                        yield _checked_trip(current)
+                    current_id = trip_id
+                    current = {k: row.get(k, "") for k in TRIP_FIELDS}
+                    current["expenses"] = []
+                if row.get("category") or row.get("amount"):
+                    current["expenses"].append({k: row.get(k, "") for k in ITEM_FIELDS})
+            if current is not None:
+                yield _checked_trip(current)
+    else:
+        raise ValueError(f"Unsupported input format: {path}")
+
+
+# -----------------------------
+# Per report work, runs in worker processes
+# -----------------------------
+def process_trip(
+    seq: int,
+    trip: Dict[str, Any],
+    per_diem_rate: float,
+    out_dir: str,
+    mail: Dict[str, str],
+    fx_path: Optional[str] = None,
+    fx_max_age_days: int = DEFAULT_MAX_AGE_DAYS,
+    policy_path: Optional[str] = None,
+    partial_day_factor: float = 1.0,
+    export: bool = False,
+) -> Dict[str, Any]:
+    expenses = trip["expenses"]
+    employee_name = trip["employee_name"]
+    # An FxError names the currency, run_batch adds which report it was
+    apply_fx(expenses, load_rates(fx_path, fx_max_age_days))
+    # A receipt that is not on disk is reported, not shown as attached in the workbook and email
+    missing = []
+    for e in expenses:
+        receipt = e.get("receipt_file")
+        if receipt and not os.path.exists(receipt):
+            missing.append(receipt)
+            e["receipt_file"] = None
+
+    policy = load_policy(policy_path, per_diem_rate)
+    per_diem = policy.per_diem(trip["location"], trip["departure_date"], trip["return_date"], partial_day_factor)
+    per_diem_total = per_diem["per_diem_total"]
+    totals = calc_totals(expenses)
+    reimbursement_due = per_diem_total + totals["employee_paid"]
+
+    trip_info = {
+        "employee_name": employee_name,
+        "employee_email": trip["employee_email"],
+        "location": trip["location"],
+        "purpose": trip["purpose"],
+        "departure_date": trip["departure_date"],
+        "return_date": trip["return_date"],
+        "trip_days": per_diem["trip_days"],
+        "per_diem_rate": per_diem["per_diem_rate"],
+        "per_diem_total": per_diem_total,
+        "total_spend": totals["total_spend"],
+        "company_paid": totals["company_paid"],
+        "employee_paid": totals["employee_paid"],
+        "reimbursement_due": reimbursement_due,
+    }
+
+    safe_name = employee_name.replace(" ", "_") or "report"
+    xlsx_name = f"Expense_Report_{safe_name}.xlsx"
+    xlsx_path = os.path.join(out_dir, "xlsx", f"{seq:05d}_{xlsx_name}")
+    with open(xlsx_path, "wb") as fh:
+        fh.write(generate_excel(trip_info, expenses, engine="streaming"))
+
+    attachments = [{"filename": xlsx_name, "path": xlsx_path, "mime_type": XLSX_MIME}]
+    for i, e in enumerate(expenses, start=1):
+        receipt = e.get("receipt_file")
+        if not receipt:
+            continue
+        ext = (receipt.rsplit(".", 1)[-1] if "." in receipt else "pdf").lower()
+        safe_cat = str(e.get("category", "Receipt")).replace(" ", "_")
+        attachments.append(
+            {"filename": f"{i:02d}_{safe_cat}_{safe_name}.{ext}", "path": receipt, "mime_type": mime_for_ext(ext)}
+        )
+
+    email_fields = dict(
+        employee_name=employee_name,
+        employee_email=trip["employee_email"],
+        location=trip["location"],
+        purpose=trip["purpose"],
+        departure_date=trip["departure_date"],
+        return_date=trip["return_date"],
+        per_diem_total=per_diem_total,
+        total_spend=totals["total_spend"],
+        company_paid=totals["company_paid"],
+        employee_paid=totals["employee_paid"],
+        reimbursement_due=reimbursement_due,
+        expenses=expenses,
+    )
+    html_body = build_email_html(**email_fields)
+    text_body = build_email_text(**email_fields)
+
+    subject = (
+        f"Expense Report Submitted, {employee_name}, {trip['location']}, "
+        f"{trip['departure_date']} to {trip['return_date']}"
+    )
+    FileSinkTransport(os.path.join(out_dir, "outbox")).send(
+        {
+            "sender": mail["sender"],
+            "to": [mail["finance"]],
+            "cc": [a for a in (mail["approver"], trip["employee_email"]) if a],
+            "subject": subject,
+            "html_body": html_body,
+            "text_body": text_body,
+            "attachments": attachments,
+        }
+    )
+    return {
+        "seq": seq,
+        "employee_name": employee_name,
+        "line_items": len(expenses),
+        "reimbursement_due": reimbursement_due,
+        "missing_receipts": missing,
+        "policy_violations": [v["message"] for v in policy.check(trip_info, expenses)],
+        # Handed back for the columnar export, which the parent process writes
+        "report": (trip_info, expenses) if export else None,
+    }
+
+
+# -----------------------------
+# Driver
+# -----------------------------
+def run_batch(
+    trips: Iterator[Dict[str, Any]],
+    out_dir: str,
+    per_diem_rate: float,
+    mail: Dict[str, str],
+    workers: Optional[int] = None,
+    fx_path: Optional[str] = None,
+    fx_max_age_days: int = DEFAULT_MAX_AGE_DAYS,
+    policy_path: Optional[str] = None,
+    partial_day_factor: float = 1.0,
+    export: Optional[ColumnarExport] = None,
+    export_chunk: int = 1000,
+) -> List[Dict[str, Any]]:
+    """
+    Process trips on a process pool. At most 4 trips per worker are in
+    flight, so a large input is never loaded whole. With export, finished
+    reports are appended to it export_chunk at a time.
+
+    A trip that fails, unreadable or raising in its worker, does not stop
+    the others. It comes back as { "seq", "employee_name", "error" }.
+    """
+    os.makedirs(os.path.join(out_dir, "xlsx"), exist_ok=True)
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = workers * 4
+    results: List[Dict[str, Any]] = []
+    to_export: List[Dict[str, Any]] = []
+
+    def export_done() -> None:
+        to_export.sort(key=lambda r: r["seq"])
+        export.append_many([r["report"] for r in to_export])
+        for r in to_export:
+            r["report"] = None
+        to_export.clear()
+
+    def failed(seq: int, employee_name: str, error: str) -> Dict[str, Any]:
+        return {"seq": seq, "employee_name": employee_name, "error": error}
+
+    # future -> (seq, employee_name), to name a trip whose worker raised
+    submitted: Dict[Any, Tuple[int, str]] = {}
+
+    def collect(done) -> None:
+        for f in done:
+            seq, employee_name = submitted.pop(f)
+            try:
+                result = f.result()
+            except Exception as ex:
+                results.append(failed(seq, employee_name, f"{type(ex).__name__}: {ex}"))
+                continue
+            results.append(result)
+            if export is not None:
+                to_export.append(result)
+        if export is not None and len(to_export) >= export_chunk:
+            export_done()
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = set()
+        for seq, trip in enumerate(trips, start=1):
+            if "error" in trip:
+                results.append(failed(seq, trip["employee_name"], trip["error"]))
+                continue
+            future = pool.submit(
+                process_trip,
+                seq,
+                trip,
+                per_diem_rate,
+                out_dir,
+                mail,
+                fx_path,
+                fx_max_age_days,
+                policy_path,
+                partial_day_factor,
+                export is not None,
+            )
+            submitted[future] = (seq, trip["employee_name"])
+            pending.add(future)
+            if len(pending) >= max_in_flight:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+        collect(wait(pending).done)
+    if to_export:
+        export_done()
+
+    results.sort(key=lambda r: r["seq"])
+    return results
+
+
+AUDIT_FIELDS = ["seq", "employee_name", "location", "line", "category", "amount", "cap", "per", "message"]
+
+
+def run_audit(
+    trips: Iterator[Dict[str, Any]],
+    out_dir: str,
+    per_diem_rate: float,
+    fx_path: Optional[str] = None,
+    fx_max_age_days: int = DEFAULT_MAX_AGE_DAYS,
+    policy_path: Optional[str] = None,
+    chunk_size: int = 5000,
+) -> Tuple[Dict[str, int], List[Dict[str, Any]]]:
+    """
+    Check every trip against the policy caps, chunk_size trips per
+    vectorized pass, and write the violations to <out>/policy_audit.csv.
+    Returns the counts and the trips that could not be checked, as
+    { "seq", "employee_name", "error" }.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    policy = load_policy(policy_path, per_diem_rate)
+    rates = load_rates(fx_path, fx_max_age_days)
+    counts = {"reports": 0, "line_items": 0, "violations": 0, "reports_over": 0}
+    failures: List[Dict[str, Any]] = []
+
+    with open(os.path.join(out_dir, "policy_audit.csv"), "w", newline="", encoding="utf-8") as fh:
+        writer = csv.DictWriter(fh, fieldnames=AUDIT_FIELDS)
+        writer.writeheader()
+
+        def flush(chunk: List[Tuple[int, Dict[str, Any]]]) -> None:
+            found = policy.audit((trip, trip["expenses"]) for _seq, trip in chunk)
+            for (seq, trip), violations in zip(chunk, found):
+                counts["violations"] += len(violations)
+                counts["reports_over"] += bool(violations)
+                for v in violations:
+                    writer.writerow(
+                        dict(v, seq=seq, employee_name=trip["employee_name"], location=trip["location"])
+                    )
+
+        chunk: List[Tuple[int, Dict[str, Any]]] = []
+        for seq, trip in enumerate(trips, start=1):
+            error = trip.get("error")
+            if error is None:
+                try:
+                    apply_fx(trip["expenses"], rates)
+                except FxError as ex:
+                    error = f"FxError: {ex}"
+            if error is not None:
+                failures.append({"seq": seq, "employee_name": trip["employee_name"], "error": error})
+                continue
+            counts["reports"] += 1
+            counts["line_items"] += len(trip["expenses"])
+            chunk.append((seq, trip))
+            if len(chunk) >= chunk_size:
+                flush(chunk)
+                chunk = []
+        if chunk:
+            flush(chunk)
+    return counts, failures
+
+
+def report_failures(failures: List[Dict[str, Any]]) -> int:
+    """Prints the trips that failed, returns the exit status: 1 if any did."""
+    for f in failures:
+        print(f"error: report {f['seq']} ({f['employee_name']}), not processed: {f['error']}", file=sys.stderr)
+    if failures:
+        print(f"{len(failures)} report(s) failed, see the errors above", file=sys.stderr)
+    return 1 if failures else 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="trips file, .csv, .json or .jsonl")
+    parser.add_argument("--out", required=True, help="output directory")
+    parser.add_argument("--per-diem-rate", type=float, default=100.0)
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, default all cores")
+    parser.add_argument("--sender", default="expenses@performa.local")
+    parser.add_argument("--finance", default="finance@performa.local")
+    parser.add_argument("--approver", default="")
+    parser.add_argument("--fx-rates", help="FX rates CSV, needed for amounts not in USD")
+    parser.add_argument("--fx-max-age-days", type=int, default=DEFAULT_MAX_AGE_DAYS)
+    parser.add_argument("--policy-rules", help="per diem rates and category caps CSV")
+    parser.add_argument(
+        "--partial-day-factor", type=float, default=1.0, help="share of the per diem paid for travel days"
+    )
+    parser.add_argument("--audit", action="store_true", help="only check the policy caps")
+    parser.add_argument("--audit-chunk", type=int, default=5000, help="reports per vectorized audit pass")
+    parser.add_argument("--export", help="folder of the month partitioned reports and line items datasets")
+    parser.add_argument("--export-format", choices=FORMATS, help="default parquet when pyarrow is installed, else csv")
+    parser.add_argument("--export-chunk", type=int, default=1000, help="reports per export part file")
+    args = parser.parse_args(argv)
+
+    t0 = time.perf_counter()
+    if args.audit:
+        counts, failures = run_audit(
+            iter_trips(args.input),
+            args.out,
+            args.per_diem_rate,
+            args.fx_rates,
+            args.fx_max_age_days,
+            args.policy_rules,
+            args.audit_chunk,
+        )
+        elapsed = time.perf_counter() - t0
+        print(
+            f"{counts['reports']} reports, {counts['line_items']} line items audited in {elapsed:.2f}s, "
+            f"{counts['violations']} violations in {counts['reports_over']} reports, "
+            f"output in {os.path.join(args.out, 'policy_audit.csv')}"
+        )
+        return report_failures(failures)
+
+    mail = {"sender": args.sender, "finance": args.finance, "approver": args.approver}
+    results = run_batch(
+        iter_trips(args.input),
+        args.out,
+        args.per_diem_rate,
+        mail,
+        args.workers,
+        args.fx_rates,
+        args.fx_max_age_days,
+        args.policy_rules,
+        args.partial_day_factor,
+        ColumnarExport(args.export, args.export_format) if args.export else None,
+        args.export_chunk,
+    )
+    elapsed = time.perf_counter() - t0
+
+    failures = [r for r in results if "error" in r]
+    results = [r for r in results if "error" not in r]
+    items = sum(r["line_items"] for r in results)
+    for r in results:
+        for path in r["missing_receipts"]:
+            print(f"warning: report {r['seq']} ({r['employee_name']}), receipt not found: {path}", file=sys.stderr)
+        for message in r["policy_violations"]:
+            print(f"warning: report {r['seq']} ({r['employee_name']}), over policy: {message}", file=sys.stderr)
+    rate = len(results) / elapsed if elapsed > 0 else 0.0
+    print(
+        f"{len(results)} reports, {items} line items in {elapsed:.2f}s, "
+        f"{rate:,.1f} reports/s, output in {args.out}"
+    )
+    return report_failures(failures)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,176 @@
+"""
+Measurement helpers shared by suite.py and load_test.py: timing with
+percentiles, traced peak memory, and baseline JSON save and compare.
+
+A results file looks like:
+  { "meta": { "python": ..., "platform": ..., "created": ..., "args": ... },
+    "results": { "<case>": { "n", "min", "mean", "p50", "p90", "p99", "max",
+                             "throughput", "unit", "peak_mb" } } }
+Times are in seconds.
+"""
+import json
+import math
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Any, List, Optional
+
+# Differences smaller than these are noise, never reported as regressions
+MIN_TIME_DELTA_S = 0.001
+MIN_MEMORY_DELTA_MB = 1.0
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Linear interpolation between closest ranks, q in [0, 100]."""
+    if not sorted_values:
+        return float("nan")
+    k = (len(sorted_values) - 1) * q / 100
+    lo, hi = math.floor(k), math.ceil(k)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(times: List[float], units: Optional[float] = None, unit: str = "") -> Dict[str, Any]:
+    """
+    Percentiles of a list of durations. units is the work done per run
+    (line items, MB), throughput is units per second at the median.
+    """
+    s = sorted(times)
+    p50 = percentile(s, 50)
+    return {
+        "n": len(s),
+        "min": s[0],
+        "mean": sum(s) / len(s),
+        "p50": p50,
+        "p90": percentile(s, 90),
+        "p99": percentile(s, 99),
+        "max": s[-1],
+        "throughput": (units / p50) if units and p50 > 0 else None,
+        "unit": unit,
+    }
+
+
+def measure(fn: Callable[[], Any], repeat: int, budget_s: float = 10.0, warmup: int = 1) -> List[float]:
+    """
+    Time fn up to repeat times, stopping early once budget_s is spent.
+    At least one timed run always happens.
+    """
+    for _ in range(warmup):
+        fn()
+    times: List[float] = []
+    spent = 0.0
+    while len(times) < repeat and (not times or spent < budget_s):
+        t0 = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - t0
+        times.append(elapsed)
+        spent += elapsed
+    return times
+
+
+def traced_peak_mb(fn: Callable[[], Any]) -> float:
+    """Peak Python heap allocated during one call of fn, in MB."""
+    tracemalloc.start()
+    try:
+        fn()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak / 1024 / 1024
+
+
+def rss_peak_mb() -> float:
+    """Peak resident set size of this process so far, in MB."""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # KB on Linux, bytes on macOS
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+# -----------------------------
+# Baselines
+# -----------------------------
+def meta(args: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "args": args,
+    }
+
+
+def save(path: str, results: Dict[str, Dict[str, Any]], args: Dict[str, Any]) -> None:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as fh:
+        json.dump({"meta": meta(args), "results": results}, fh, indent=2, sort_keys=True)
+
+
+def load(path: str) -> Dict[str, Any]:
+    with open(path, encoding="utf-8") as fh:
+        return json.load(fh)
+
+
+def compare(baseline: Dict[str, Any], results: Dict[str, Dict[str, Any]], tolerance: float) -> List[str]:
+    """
+    Cases whose median time or peak memory grew by more than tolerance
+    (0.25 means 25%) over the baseline. Cases missing on either side are
+    skipped.
+    """
+    regressions = []
+    for case, cur in sorted(results.items()):
+        base = baseline.get("results", {}).get(case)
+        if base is None:
+            continue
+        if cur["p50"] > base["p50"] * (1 + tolerance) and cur["p50"] - base["p50"] > MIN_TIME_DELTA_S:
+            regressions.append(
+                f"{case}: p50 {base['p50'] * 1000:,.2f} ms -> {cur['p50'] * 1000:,.2f} ms "
+                f"({cur['p50'] / base['p50']:.2f}x)"
+            )
+        b_mem, c_mem = base.get("peak_mb"), cur.get("peak_mb")
+        if b_mem and c_mem and c_mem > b_mem * (1 + tolerance) and c_mem - b_mem > MIN_MEMORY_DELTA_MB:
+            regressions.append(f"{case}: peak {b_mem:,.1f} MB -> {c_mem:,.1f} MB ({c_mem / b_mem:.2f}x)")
+    return regressions
+
+
+def print_row_header() -> None:
+    print(
+        f"{'case':<36} {'n':>4} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10} "
+        f"{'throughput':>18} {'peak MB':>9}"
+    )
+
+
+def print_row(case: str, r: Dict[str, Any]) -> None:
+    tp = f"{r['throughput']:,.1f} {r['unit']}/s" if r.get("throughput") else ""
+    peak = f"{r['peak_mb']:,.1f}" if r.get("peak_mb") is not None else ""
+    print(
+        f"{case:<36} {r['n']:>4} {r['p50'] * 1000:>10.2f} {r['p90'] * 1000:>10.2f} {r['p99'] * 1000:>10.2f} "
+        f"{tp:>18} {peak:>9}",
+        flush=True,
+    )
+
+
+def finish(args, results: Dict[str, Dict[str, Any]]) -> int:
+    """Save and compare as asked on the command line. Returns the exit code."""
+    if args.save:
+        save(args.save, results, vars(args))
+        print(f"saved {len(results)} results to {args.save}")
+    if args.compare:
+        regressions = compare(load(args.compare), results, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regression(s) against {args.compare}:")
+            for line in regressions:
+                print(f"  {line}")
+            return 1
+        print(f"no regressions against {args.compare} at {args.tolerance:.0%} tolerance")
+    return 0
+
+
+def add_baseline_args(parser) -> None:
+    parser.add_argument("--save", metavar="JSON", help="write results to this baseline file")
+    parser.add_argument("--compare", metavar="JSON", help="fail if slower or larger than this baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed growth over the baseline")
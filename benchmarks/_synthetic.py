@@ -0,0 +1,127 @@
+"""
+Deterministic synthetic trips and receipts for the benchmarks. The same
+arguments always give the same data, so runs are comparable.
+"""
+import random
+from datetime import date, timedelta
+from typing import List, Dict, Any, Tuple
+
+from fx_rates import FxRates
+from policy import Policy
+
+CATEGORIES = ["Airfare", "Airport Parking", "Taxi or Uber to Airport", "Hotel", "Rental Car", "Gas for Rental Car", "Other"]
+MB = 1024 * 1024
+# Receipts are split into files of at most this size, like phone scans
+MAX_RECEIPT_BYTES = 2 * MB
+
+
+class FakeUpload:
+    """Stands in for a Streamlit UploadedFile."""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.size = len(data)
+        self._data = data
+
+    def getvalue(self) -> bytes:
+        return self._data
+
+    def getbuffer(self) -> memoryview:
+        return memoryview(self._data)
+
+
+def receipts(total_mb: float, seed: int = 1) -> List[FakeUpload]:
+    """Incompressible PDF receipts adding up to total_mb."""
+    rnd = random.Random(seed)
+    remaining = int(total_mb * MB)
+    out = []
+    while remaining > 0:
+        size = min(remaining, MAX_RECEIPT_BYTES)
+        out.append(FakeUpload(f"receipt_{len(out):03d}.pdf", rnd.randbytes(size)))
+        remaining -= size
+    return out
+
+
+def trip(n_items: int, receipt_mb: float = 0, seed: int = 1) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """trip_info and expenses, receipts attached to the first lines."""
+    rnd = random.Random(seed)
+    start = date(2024, 1, 1)
+    files = receipts(receipt_mb, seed)
+    expenses = []
+    for i in range(n_items):
+        expenses.append(
+            {
+                "category": CATEGORIES[i % len(CATEGORIES)],
+                "expense_date": start + timedelta(days=i % 5),
+                "paid_by": "Performa" if i % 3 == 0 else "Employee",
+                "description": f"Line item {i}",
+                "amount": round(rnd.uniform(5, 900), 2),
+                "receipt_file": files[i] if i < len(files) else None,
+            }
+        )
+    total = sum(e["amount"] for e in expenses)
+    company = sum(e["amount"] for e in expenses if e["paid_by"] == "Performa")
+    trip_info = {
+        "employee_name": "Bench Employee",
+        "employee_email": "bench@example.com",
+        "location": "Austin, TX",
+        "purpose": "Benchmark",
+        "departure_date": start,
+        "return_date": start + timedelta(days=4),
+        "trip_days": 5,
+        "per_diem_rate": 100.0,
+        "per_diem_total": 500.0,
+        "total_spend": total,
+        "company_paid": company,
+        "employee_paid": total - company,
+        "reimbursement_due": 500.0 + total - company,
+    }
+    return trip_info, expenses
+
+
+def email_fields(trip_info: Dict[str, Any], expenses) -> Dict[str, Any]:
+    """build_email_html keyword arguments for a synthetic trip."""
+    return dict(
+        employee_name=trip_info["employee_name"],
+        employee_email=trip_info["employee_email"],
+        location=trip_info["location"],
+        purpose=trip_info["purpose"],
+        departure_date=trip_info["departure_date"],
+        return_date=trip_info["return_date"],
+        per_diem_total=trip_info["per_diem_total"],
+        total_spend=trip_info["total_spend"],
+        company_paid=trip_info["company_paid"],
+        employee_paid=trip_info["employee_paid"],
+        reimbursement_due=trip_info["reimbursement_due"],
+        expenses=expenses,
+    )
+
+
+def fx_rates(currencies=("EUR", "GBP", "JPY"), days: int = 730, seed: int = 1) -> FxRates:
+    """Daily rates for two years from 2023-01-01, weekdays only like a real feed."""
+    rnd = random.Random(seed)
+    start = date(2023, 1, 1)
+    rows = []
+    for c in currencies:
+        rate = rnd.uniform(0.005, 1.5)
+        for d in range(days):
+            day = start + timedelta(days=d)
+            if day.weekday() < 5:
+                rate *= 1 + rnd.uniform(-0.005, 0.005)
+                rows.append((c, day, rate))
+    return FxRates(rows)
+
+
+def policy(locations: int = 50, seed: int = 1) -> Policy:
+    """Quarterly per diem rates and a cap on every category for each location, plus defaults."""
+    rnd = random.Random(seed)
+    rows = [{"kind": "per_diem", "location": "*", "amount": 100}]
+    periods = ["item", "day", "night", "trip"]
+    for loc in ["*"] + [f"City {n}" for n in range(locations)]:
+        for q in range(8):
+            start = date(2023 + q // 4, 3 * (q % 4) + 1, 1)
+            rows.append({"kind": "per_diem", "location": loc, "start_date": start, "amount": rnd.randint(80, 250)})
+        for i, category in enumerate(CATEGORIES):
+            amount = rnd.randint(50, 400)
+            rows.append({"kind": "cap", "location": loc, "category": category, "amount": amount, "per": periods[i % 4]})
+    return Policy(rows, default_rate=100)
@@ -0,0 +1,139 @@
+"""
+Report archive at scale: bulk load, paged search and monthly rollups.
+
+Builds an archive of --items line items (10 per report by default) in a
+temporary file, then times each query as the best of --repeat runs:
+
+  page1       first page of an employee's reports
+  page_deep   the 20th page of the same search, by keyset cursor
+  location    reports for one location in a date range
+  category    line items in one category for one month
+  rollup      spend per category per month, precomputed table
+  full_scan   the same rollup computed from line_items, for comparison
+
+Run from the repo root:
+  python benchmarks/bench_archive.py --items 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from report_archive import ReportArchive  # noqa: E402
+
+CATEGORIES = ["Airfare", "Airport Parking", "Taxi or Uber to Airport", "Hotel", "Rental Car", "Gas for Rental Car", "Other"]
+LOCATIONS = ["Austin, TX", "Denver, CO", "Chicago, IL", "Boston, MA", "Seattle, WA", "Miami, FL"]
+START = date(2020, 1, 1)
+
+
+def reports(n_reports: int, items_per_report: int, employees: int):
+    rnd = random.Random(7)
+    for r in range(n_reports):
+        departure = START + timedelta(days=rnd.randrange(5 * 365))
+        email = f"employee{r % employees}@example.com"
+        trip_info = {
+            "employee_name": f"Employee {r % employees}",
+            "employee_email": email,
+            "location": LOCATIONS[r % len(LOCATIONS)],
+            "purpose": "Benchmark",
+            "departure_date": departure,
+            "return_date": departure + timedelta(days=3),
+            "trip_days": 4,
+            "per_diem_rate": 100.0,
+            "per_diem_total": 400.0,
+            "total_spend": 0.0,
+            "company_paid": 0.0,
+            "employee_paid": 0.0,
+            "reimbursement_due": 400.0,
+        }
+        expenses = [
+            {
+                "category": CATEGORIES[(r + i) % len(CATEGORIES)],
+                "expense_date": departure + timedelta(days=i % 4),
+                "paid_by": "Performa" if i % 3 == 0 else "Employee",
+                "description": f"Item {i}",
+                "amount": round(rnd.uniform(5, 900), 2),
+                "receipt_file": "r" if i % 2 else None,
+            }
+            for i in range(items_per_report)
+        ]
+        yield trip_info, expenses
+
+
+def best(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=1_000_000)
+    parser.add_argument("--items-per-report", type=int, default=10)
+    parser.add_argument("--employees", type=int, default=2000)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    n_reports = max(1, args.items // args.items_per_report)
+    with tempfile.TemporaryDirectory() as tmp:
+        archive = ReportArchive(os.path.join(tmp, "archive.sqlite3"))
+
+        t0 = time.perf_counter()
+        archive.archive_many(reports(n_reports, args.items_per_report, args.employees))
+        load_s = time.perf_counter() - t0
+        size_mb = os.path.getsize(archive.path) / 1024 / 1024
+        print(
+            f"loaded {n_reports:,} reports, {n_reports * args.items_per_report:,} line items "
+            f"in {load_s:.1f}s ({n_reports * args.items_per_report / load_s:,.0f} items/s), {size_mb:,.0f} MB"
+        )
+
+        employee = "employee42@example.com"
+
+        def deep():
+            cursor = None
+            for _ in range(20):
+                _rows, cursor = archive.search_reports(employee_email=employee, cursor=cursor, page_size=5)
+                if cursor is None:
+                    break
+
+        def full_scan():
+            with archive._lock:
+                archive._conn.execute(
+                    "SELECT substr(expense_date, 1, 7), category, SUM(amount), COUNT(*) FROM line_items GROUP BY 1, 2"
+                ).fetchall()
+
+        cases = [
+            ("page1", lambda: archive.search_reports(employee_email=employee)),
+            ("page_deep", deep),
+            (
+                "location",
+                lambda: archive.search_reports(
+                    location="Denver, CO", date_from=date(2022, 1, 1), date_to=date(2022, 12, 31)
+                ),
+            ),
+            (
+                "category",
+                lambda: archive.search_line_items(
+                    category="Hotel", date_from=date(2023, 3, 1), date_to=date(2023, 3, 31)
+                ),
+            ),
+            ("rollup", lambda: archive.monthly_rollup()),
+            ("full_scan", full_scan),
+        ]
+        print(f"{'query':>10} {'ms':>10}")
+        for name, fn in cases:
+            repeat = 1 if name == "full_scan" else args.repeat
+            print(f"{name:>10} {best(fn, repeat) * 1000:>10.2f}")
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Duplicate index: bulk build, reload and per-check latency.
+
+  build      bulk_add of --items rows, each with a receipt hash
+  reload     reopening the index, which mirrors it into memory
+  expense    find_expense, one (category, date, amount) lookup
+  exact      find_receipt on a known sha256
+  similar    find_receipt with a dHash a few bits off a known one
+  miss       find_receipt with an unknown digest and dHash
+  dhash      hashing one 3000x4000 JPEG photo
+
+Lookups report the mean over --lookups random queries.
+
+Run from the repo root:
+  python benchmarks/bench_duplicates.py --items 1000000
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image  # noqa: E402
+
+from duplicate_index import DuplicateIndex, dhash  # noqa: E402
+
+CATEGORIES = ["Airfare", "Airport Parking", "Taxi or Uber to Airport", "Hotel", "Rental Car", "Gas for Rental Car", "Other"]
+
+
+def rows(n: int, seed: int = 11):
+    rnd = random.Random(seed)
+    for i in range(n):
+        yield (
+            i // 10,
+            f"employee{i % 2000}@example.com",
+            {
+                "category": CATEGORIES[i % len(CATEGORIES)],
+                "expense_date": date(2020, 1, 1) + timedelta(days=rnd.randrange(5 * 365)),
+                "amount": round(rnd.uniform(5, 900), 2),
+                "receipt_digest": "%064x" % rnd.getrandbits(256),
+                "receipt_dhash": rnd.getrandbits(64),
+            },
+        )
+
+
+def mean_us(fn, queries) -> float:
+    t0 = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - t0) / len(queries) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, default=1_000_000)
+    parser.add_argument("--lookups", type=int, default=10000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "duplicates.sqlite3")
+        index = DuplicateIndex(path)
+        t0 = time.perf_counter()
+        chunk = []
+        for r in rows(args.items):
+            chunk.append(r)
+            if len(chunk) == 50000:
+                index.bulk_add(chunk)
+                chunk = []
+        if chunk:
+            index.bulk_add(chunk)
+        build_s = time.perf_counter() - t0
+        index.close()
+
+        t0 = time.perf_counter()
+        index = DuplicateIndex(path)
+        reload_s = time.perf_counter() - t0
+
+        rnd = random.Random(3)
+        sample = [e for _r, _emp, e in rows(min(args.items, args.lookups))]
+        rnd.shuffle(sample)
+
+        def flip(h: int) -> int:
+            for bit in rnd.sample(range(64), 2):
+                h ^= 1 << bit
+            return h
+
+        near = [(e["receipt_digest"][::-1], flip(e["receipt_dhash"])) for e in sample]
+        misses = [("%064x" % rnd.getrandbits(256), rnd.getrandbits(64)) for _ in sample]
+
+        t_expense = mean_us(lambda e: index.find_expense(e["category"], e["expense_date"], e["amount"]), sample)
+        t_exact = mean_us(lambda e: index.find_receipt(e["receipt_digest"], e["receipt_dhash"]), sample)
+        t_similar = mean_us(lambda q: index.find_receipt(*q), near)
+        t_miss = mean_us(lambda q: index.find_receipt(*q), misses)
+        found = sum(1 for q in near if index.find_receipt(*q))
+        index.close()
+
+    photo = BytesIO()
+    Image.effect_noise((3000, 4000), 40).convert("RGB").save(photo, format="JPEG", quality=85)
+    t0 = time.perf_counter()
+    dhash(photo.getvalue())
+    dhash_ms = (time.perf_counter() - t0) * 1000
+
+    print(f"build    {args.items:,} rows in {build_s:.1f}s ({args.items / build_s:,.0f} rows/s)")
+    print(f"reload   {reload_s:.1f}s")
+    print(f"expense  {t_expense:.1f} us")
+    print(f"exact    {t_exact:.1f} us")
+    print(f"similar  {t_similar:.1f} us, {found}/{len(near)} found")
+    print(f"miss     {t_miss:.1f} us")
+    print(f"dhash    {dhash_ms:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
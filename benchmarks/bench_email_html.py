@@ -0,0 +1,91 @@
+"""
+Email body rendering cost as the number of line items grows.
+
+  cold     row cache empty, every row rendered
+  rerun    same expenses again, all rows served from the row cache
+  edit     one row changed, only that row re-rendered
+  text     plain text alternative part
+
+Run from the repo root:
+  python benchmarks/bench_email_html.py --sizes 10 100 1000 10000
+"""
+import argparse
+import os
+import sys
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import email_templates  # noqa: E402
+from report_utils import build_email_html, build_email_text  # noqa: E402
+
+CATEGORIES = ["Airfare", "Hotel", "Rental Car", "Gas for Rental Car", "Other"]
+
+
+def fields(n: int):
+    expenses = [
+        {
+            "category": CATEGORIES[i % len(CATEGORIES)],
+            "expense_date": date(2024, 1, 1 + i % 28),
+            "description": f"Line item {i} <&>",
+            "paid_by": "Performa" if i % 3 == 0 else "Employee",
+            "amount": 10 + i * 0.37,
+            "receipt_file": "r" if i % 2 else None,
+        }
+        for i in range(n)
+    ]
+    return dict(
+        employee_name="Bench Employee",
+        employee_email="bench@example.com",
+        location="Austin, TX",
+        purpose="Benchmark",
+        departure_date=date(2024, 1, 1),
+        return_date=date(2024, 1, 5),
+        per_diem_total=500.0,
+        total_spend=1234.0,
+        company_paid=200.0,
+        employee_paid=1034.0,
+        reimbursement_due=1534.0,
+        expenses=expenses,
+    )
+
+
+def best(fn, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - t0)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'items':>8} {'cold ms':>10} {'rerun ms':>10} {'edit ms':>10} {'text ms':>10}")
+    for n in args.sizes:
+        f = fields(n)
+
+        def cold():
+            email_templates._row_cells.cache_clear()
+            build_email_html(**f)
+
+        t_cold = best(cold, args.repeat)
+        build_email_html(**f)
+        t_rerun = best(lambda: build_email_html(**f), args.repeat)
+
+        def edit():
+            f["expenses"][0]["amount"] += 1
+            build_email_html(**f)
+
+        t_edit = best(edit, args.repeat)
+        t_text = best(lambda: build_email_text(**f), args.repeat)
+        print(f"{n:>8} {t_cold * 1000:>10.2f} {t_rerun * 1000:>10.2f} {t_edit * 1000:>10.2f} {t_text * 1000:>10.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""
+Peak memory of building the outgoing mail payload, legacy vs streaming.
+
+Each mode runs in a fresh subprocess and reports how far peak RSS rises
+above the RSS measured once the attachments are loaded. Nothing is sent,
+the payload is consumed into a null sink.
+
+  legacy            base64 per attachment into the SendGrid SDK Mail
+                    object, then json.dumps the whole request (old path)
+  sendgrid_stream   iter_sendgrid_payload over in-memory attachments
+  sendgrid_path     iter_sendgrid_payload streaming attachments from disk
+  smtp_path         iter_mime_message streaming attachments from disk
+
+legacy needs the sendgrid SDK, which the app no longer depends on. It is
+skipped when the SDK is not installed.
+
+Run from the repo root:
+  python benchmarks/bench_email_memory.py --mb 18
+"""
+import argparse
+import importlib.util
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODES = ["legacy", "sendgrid_stream", "sendgrid_path", "smtp_path"]
+
+
+def _rss_mb() -> float:
+    with open("/proc/self/statm") as fh:
+        return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+
+def _peak_mb() -> float:
+    # ru_maxrss is KB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _child(mode: str, paths):
+    import base64
+
+    from mail_transport import iter_mime_message, iter_sendgrid_payload
+
+    if mode.endswith("_path"):
+        attachments = [{"filename": os.path.basename(p), "path": p, "mime_type": "application/pdf"} for p in paths]
+    else:
+        attachments = []
+        for p in paths:
+            with open(p, "rb") as fh:
+                attachments.append({"filename": os.path.basename(p), "content_bytes": fh.read(), "mime_type": "application/pdf"})
+
+    base = _rss_mb()
+    sent = 0
+    if mode == "legacy":
+        from sendgrid.helpers.mail import Attachment, Cc, Disposition, Email, FileContent, FileName, FileType, Mail, To
+
+        msg = Mail(from_email=Email("s@example.com"), to_emails=To("f@example.com"), subject="s", html_content="<p>x</p>")
+        msg.add_cc(Cc("a@example.com"))
+        for a in attachments:
+            encoded = base64.b64encode(a["content_bytes"]).decode("utf-8")
+            msg.add_attachment(
+                Attachment(FileContent(encoded), FileName(a["filename"]), FileType(a["mime_type"]), Disposition("attachment"))
+            )
+        # What SendGridAPIClient.send does before the HTTP call
+        body = json.dumps(msg.get()).encode("utf-8")
+        sent = len(body)
+    elif mode.startswith("sendgrid"):
+        for chunk in iter_sendgrid_payload("s@example.com", ["f@example.com"], ["a@example.com"], "s", "<p>x</p>", attachments):
+            sent += len(chunk)
+    else:
+        for chunk in iter_mime_message("s@example.com", ["f@example.com"], ["a@example.com"], "s", "<p>x</p>", attachments):
+            sent += len(chunk)
+
+    print(json.dumps({"mode": mode, "extra_peak_mb": max(0.0, _peak_mb() - base), "payload_mb": sent / 1024 / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mb", type=float, default=18.0, help="total attachment size")
+    parser.add_argument("--files", type=int, default=6)
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("paths", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        _child(args.child, args.paths)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        per_file = int(args.mb * 1024 * 1024 / args.files)
+        paths = []
+        for i in range(args.files):
+            p = os.path.join(tmp, f"receipt_{i}.pdf")
+            with open(p, "wb") as fh:
+                fh.write(os.urandom(per_file))
+            paths.append(p)
+
+        print(f"{args.files} attachments, {args.mb:.1f} MB total")
+        print(f"{'mode':>16} {'payload MB':>11} {'extra peak MB':>14}")
+        for mode in MODES:
+            if mode == "legacy" and importlib.util.find_spec("sendgrid") is None:
+                print(f"{mode:>16} skipped, sendgrid SDK not installed")
+                continue
+            out = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child", mode, *paths],
+                capture_output=True, text=True, check=True, cwd=ROOT,
+            )
+            r = json.loads(out.stdout.strip().splitlines()[-1])
+            print(f"{r['mode']:>16} {r['payload_mb']:>11.2f} {r['extra_peak_mb']:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
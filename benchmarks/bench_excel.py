@@ -0,0 +1,88 @@
+"""
+Compare the standard and streaming Excel engines.
+
+Run from the repo root:
+  python benchmarks/bench_excel.py
+  python benchmarks/bench_excel.py --sizes 10 1000 --repeat 5
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from datetime import date, timedelta
+from typing import List, Dict, Any
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from excel_generator import generate_excel  # noqa: E402
+
+CATEGORIES = ["Airfare", "Hotel", "Rental Car", "Gas for Rental Car", "Other"]
+
+
+def synthetic_trip(n_items: int):
+    start = date(2024, 1, 1)
+    trip_info = {
+        "employee_name": "Bench Employee",
+        "employee_email": "bench@example.com",
+        "location": "Austin, TX",
+        "purpose": "Quarter-end benchmark",
+        "departure_date": start,
+        "return_date": start + timedelta(days=4),
+        "trip_days": 5,
+        "per_diem_rate": 100.0,
+        "per_diem_total": 500.0,
+        "total_spend": 0.0,
+        "company_paid": 0.0,
+        "employee_paid": 0.0,
+        "reimbursement_due": 500.0,
+    }
+    expenses: List[Dict[str, Any]] = []
+    for i in range(n_items):
+        expenses.append(
+            {
+                "category": CATEGORIES[i % len(CATEGORIES)],
+                "expense_date": start + timedelta(days=i % 5),
+                "paid_by": "Performa" if i % 3 == 0 else "Employee",
+                "description": f"Line item {i} " + "x" * (i % 40),
+                "amount": round(10 + (i % 500) * 1.37, 2),
+                "receipt_file": None,
+            }
+        )
+    return trip_info, expenses
+
+
+def run(engine: str, n_items: int, repeat: int):
+    trip_info, expenses = synthetic_trip(n_items)
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        generate_excel(trip_info, expenses, engine=engine)
+        times.append(time.perf_counter() - t0)
+
+    tracemalloc.start()
+    generate_excel(trip_info, expenses, engine=engine)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'items':>8} {'engine':>10} {'best s':>10} {'peak MB':>10}")
+    for n in args.sizes:
+        repeat = 1 if n >= 100000 else args.repeat
+        results = {}
+        for engine in ("standard", "streaming"):
+            best, peak = run(engine, n, repeat)
+            results[engine] = best
+            print(f"{n:>8} {engine:>10} {best:>10.4f} {peak / 1024 / 1024:>10.2f}")
+        print(f"{'':>8} {'speedup':>10} {results['standard'] / results['streaming']:>10.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,186 @@
+"""
+Multi-session load driver for app.py.
+
+Replays concurrent Streamlit sessions with Streamlit's AppTest harness.
+Each session opens the app, fills in the trip, adds --items line items and
+submits, --iterations times. AppTest patches process-wide Streamlit state,
+so every session runs in its own process, like one replica of a scaled-out
+deployment: its own submission queue, shared draft, archive and duplicate
+databases, and one shared outbox. Mail goes to the file transport (a
+Maildir), so nothing leaves the machine. Everything lives in a temp folder
+that is removed afterwards.
+
+Reported per step, over every session:
+  first_render     opening the app
+  add_expense      one Add Expense rerun
+  submit           the Submit rerun, until the report is queued or sent
+  delivery         queued to sent, from the spooled job records (async only)
+plus overall submits per second and the largest session process peak RSS.
+
+Run from the repo root:
+  python benchmarks/load_test.py --sessions 8 --iterations 3 --items 5
+  python benchmarks/load_test.py --sync            send inside the submit rerun
+  python benchmarks/load_test.py --save benchmarks/load_baseline.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import _harness  # noqa: E402
+from streamlit.testing.v1 import AppTest  # noqa: E402
+
+APP = os.path.join(ROOT, "app.py")
+
+
+def secrets_for(tmp: str, session: int, sync: bool) -> Dict[str, object]:
+    return {
+        "MAIL_SINK_DIR": os.path.join(tmp, "outbox"),
+        "SUBMISSION_SPOOL_DIR": os.path.join(tmp, "spool", str(session)),
+        "DRAFT_DB_PATH": os.path.join(tmp, "drafts.sqlite3"),
+        "ARCHIVE_DB_PATH": os.path.join(tmp, "archive.sqlite3"),
+        "DUPLICATE_INDEX_PATH": os.path.join(tmp, "duplicates.sqlite3"),
+        "RECEIPT_STORE_DIR": os.path.join(tmp, "receipts"),
+        "RECEIPT_CACHE_DIR": os.path.join(tmp, "receipt_cache"),
+        "METRICS_FILE": os.path.join(tmp, "metrics.prom"),
+        "SENDER_EMAIL": "expenses@example.com",
+        "FINANCE_EMAIL": "finance@example.com",
+        "APPROVER_EMAIL": "approver@example.com",
+        "ASYNC_SUBMIT": not sync,
+    }
+
+
+def _button(at: AppTest, label: str):
+    return next(b for b in at.button if b.label == label)
+
+
+def run_session(session: int, iterations: int, items: int, secrets, timeout: float) -> Dict[str, Any]:
+    """One session process. Returns its step timings and delivery latencies."""
+    timings: Dict[str, List[float]] = {}
+    submitted = 0
+    for it in range(iterations):
+        at = AppTest.from_file(APP, default_timeout=300)
+        for k, v in secrets.items():
+            at.secrets[k] = v
+
+        steps = []
+        t0 = time.perf_counter()
+        at.run()
+        steps.append(("first_render", time.perf_counter() - t0))
+        if at.exception:
+            raise RuntimeError(f"session {session} failed to render: {at.exception[0].value}")
+
+        fields = {t.label: t for t in at.text_input}
+        fields["Employee Name"].set_value(f"Load Session {session}")
+        fields["Employee Email"].set_value(f"load{session}@example.com")
+        fields["Trip Location"].set_value("Austin, TX")
+        at.text_area[0].set_value("Load test")
+
+        for j in range(items):
+            # Unique amounts, so the duplicate check never blocks a submit
+            at.number_input[0].set_value(round(10 + session * 1000 + it * 50 + j + 0.01 * j, 2))
+            t0 = time.perf_counter()
+            _button(at, "Add Expense").click().run()
+            steps.append(("add_expense", time.perf_counter() - t0))
+
+        t0 = time.perf_counter()
+        _button(at, "Submit Expense Report").click().run()
+        steps.append(("submit", time.perf_counter() - t0))
+        if at.exception or not any("queued" in s.value or "Submitted" in s.value for s in at.success):
+            errors = [e.value for e in at.error] or [str(x) for x in at.exception]
+            raise RuntimeError(f"session {session} iteration {it} did not submit: {errors}")
+        submitted += 1
+        for name, elapsed in steps:
+            timings.setdefault(name, []).append(elapsed)
+
+    # The queue workers are daemon threads, wait for them before exiting
+    deadline = time.time() + timeout
+    latencies = delivery_latencies(secrets["SUBMISSION_SPOOL_DIR"])
+    while secrets["ASYNC_SUBMIT"] and len(latencies) < submitted and time.time() < deadline:
+        time.sleep(0.05)
+        latencies = delivery_latencies(secrets["SUBMISSION_SPOOL_DIR"])
+    return {"submitted": submitted, "timings": timings, "latencies": latencies, "peak_mb": _harness.rss_peak_mb()}
+
+
+def delivery_latencies(spool_dir: str) -> List[float]:
+    """Queued to sent time of every sent job in the submission spool."""
+    out = []
+    for name in os.listdir(spool_dir) if os.path.isdir(spool_dir) else []:
+        path = os.path.join(spool_dir, name, "job.json")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                job = json.load(fh)
+            if job["status"] == "sent":
+                out.append(job["updated_at"] - job["created_at"])
+    return out
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=8, help="concurrent sessions")
+    parser.add_argument("--iterations", type=int, default=3, help="reports per session")
+    parser.add_argument("--items", type=int, default=5, help="line items per report")
+    parser.add_argument("--sync", action="store_true", help="send inside the submit rerun, ASYNC_SUBMIT off")
+    parser.add_argument("--timeout", type=float, default=120.0, help="seconds to wait for deliveries")
+    parser.add_argument("--keep", action="store_true", help="keep the temp folder with the outbox")
+    _harness.add_baseline_args(parser)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp(prefix="performa-load-")
+    expected = args.sessions * args.iterations
+
+    t0 = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.sessions) as pool:
+        futures = [
+            pool.submit(
+                run_session, s, args.iterations, args.items, secrets_for(tmp, s, args.sync), args.timeout
+            )
+            for s in range(args.sessions)
+        ]
+        sessions = [f.result() for f in futures]
+    total_s = time.perf_counter() - t0
+
+    outbox = os.path.join(tmp, "outbox", "new")
+    delivered = len(os.listdir(outbox)) if os.path.isdir(outbox) else 0
+    submitted = sum(r["submitted"] for r in sessions)
+    peak = max(r["peak_mb"] for r in sessions)
+
+    results = {}
+    _harness.print_row_header()
+    for name in ("first_render", "add_expense", "submit"):
+        results[f"load/{name}"] = _harness.summarize([t for r in sessions for t in r["timings"][name]])
+    results["load/submit"]["throughput"] = submitted / total_s
+    results["load/submit"]["unit"] = "reports"
+    latencies = [t for r in sessions for t in r["latencies"]]
+    if latencies:
+        results["load/delivery"] = _harness.summarize(latencies)
+    for name, r in results.items():
+        r["peak_mb"] = peak
+        _harness.print_row(name, r)
+    print(
+        f"{args.sessions} sessions, {submitted} reports submitted and {delivered}/{expected} delivered "
+        f"in {total_s:.1f}s, peak RSS per session {peak:,.0f} MB"
+    )
+
+    if args.keep:
+        print(f"outbox kept in {outbox}")
+    else:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    code = _harness.finish(args, results)
+    if delivered < expected:
+        print(f"only {delivered} of {expected} reports were delivered")
+        code = 1
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,125 @@
+"""
+Cold start and rerun cost of app.py.
+
+Every sample is a fresh Python process, since imports are cached for the
+life of a process and a warm process would hide them. Each child process
+times:
+  streamlit_import   importing Streamlit and its test harness
+  first_render       the first script run, the app's own imports included
+  rerun              every later script run with no input (--reruns of them),
+                     with --items line items in the session
+and reports which of the submit-only dependencies (openpyxl, Pillow, the
+mail transports) the render pulled in. None of them should be loaded.
+
+Run from the repo root:
+  python benchmarks/startup.py --samples 10 --reruns 20
+  python benchmarks/startup.py --items 60          reruns on a long trip
+  python benchmarks/startup.py --save benchmarks/startup_baseline.json
+  python benchmarks/startup.py --compare benchmarks/startup_baseline.json
+"""
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Dict, Any
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import _harness  # noqa: E402
+import _synthetic  # noqa: E402
+
+APP = os.path.join(ROOT, "app.py")
+# Modules only a submit should need
+SUBMIT_ONLY = ["openpyxl", "PIL", "mail_transport", "submit_pipeline"]
+
+
+def child(reruns: int, items: int) -> Dict[str, Any]:
+    t0 = time.perf_counter()
+    from streamlit.testing.v1 import AppTest
+
+    streamlit_import = time.perf_counter() - t0
+
+    tmp = tempfile.mkdtemp(prefix="performa-startup-")
+    try:
+        at = AppTest.from_file(APP, default_timeout=120)
+        for name in ("DRAFT_DB_PATH", "ARCHIVE_DB_PATH", "DUPLICATE_INDEX_PATH", "METRICS_FILE"):
+            at.secrets[name] = os.path.join(tmp, name.lower())
+        at.secrets["RECEIPT_STORE_DIR"] = os.path.join(tmp, "receipts")
+
+        t0 = time.perf_counter()
+        at.run()
+        first_render = time.perf_counter() - t0
+        if at.exception:
+            raise RuntimeError(f"app failed to render: {at.exception[0].value}")
+        loaded = [m for m in SUBMIT_ONLY if m in sys.modules]
+
+        if items:
+            from expense_store import ExpenseStore
+
+            at.session_state["expenses"] = ExpenseStore(_synthetic.trip(items)[1])
+            at.run()
+
+        times = []
+        for _ in range(reruns):
+            t0 = time.perf_counter()
+            at.run()
+            times.append(time.perf_counter() - t0)
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    return {
+        "streamlit_import": streamlit_import,
+        "first_render": first_render,
+        "rerun": times,
+        "loaded": loaded,
+        "peak_mb": _harness.rss_peak_mb(),
+    }
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--samples", type=int, default=10, help="fresh processes to start")
+    parser.add_argument("--reruns", type=int, default=20, help="reruns timed in each process")
+    parser.add_argument("--items", type=int, default=0, help="line items in the session during the reruns")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    _harness.add_baseline_args(parser)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(child(args.reruns, args.items)))
+        return 0
+
+    samples = []
+    for _ in range(args.samples):
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", "--reruns", str(args.reruns), "--items", str(args.items)],
+            cwd=ROOT,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        samples.append(json.loads(out.stdout.strip().splitlines()[-1]))
+
+    peak = max(s["peak_mb"] for s in samples)
+    results = {
+        "startup/streamlit_import": _harness.summarize([s["streamlit_import"] for s in samples]),
+        "startup/first_render": _harness.summarize([s["first_render"] for s in samples]),
+        f"startup/rerun/items={args.items}": _harness.summarize([t for s in samples for t in s["rerun"]]),
+    }
+    _harness.print_row_header()
+    for name, r in results.items():
+        r["peak_mb"] = peak
+        _harness.print_row(name, r)
+
+    loaded = sorted({m for s in samples for m in s["loaded"]})
+    print(f"submit-only modules loaded by the first render: {', '.join(loaded) or 'none'}")
+    return _harness.finish(args, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,147 @@
+"""
+Headless benchmark suite for the report pipeline.
+
+Runs the pure pieces of a submit on synthetic trips and reports latency
+percentiles, throughput and traced peak memory per case:
+
+  calc_totals/list      totals over a plain list of expenses
+  calc_totals/store     totals from an ExpenseStore, O(1)
+  fx_convert            apply_fx over a report in four currencies
+  policy_audit          Policy.audit over reports of 20 lines, items in total
+  export_frames         columnar_export.frames, typed reports and line item
+                        DataFrames over reports of 20 lines
+  email_html            HTML body, row cache cleared every run
+  email_text            plain text body
+  excel_<engine>        generate_excel, standard, streaming and template
+  pack                  first_fit_decreasing over one attachment per line item
+  attachments           assemble_attachments, workbook plus receipts
+  package               build_package, workbook, receipts and email bodies
+                        built concurrently
+  payload_sendgrid      SendGrid JSON request body, streamed and drained
+  payload_mime          SMTP MIME message, streamed and drained
+
+Line item cases run for each --items size, receipt cases for each
+--receipt-mb total. Each case runs up to --repeat times within --budget
+seconds.
+
+Run from the repo root:
+  python benchmarks/suite.py                          full grid
+  python benchmarks/suite.py --quick                  small sizes only
+  python benchmarks/suite.py --save benchmarks/baseline.json
+  python benchmarks/suite.py --compare benchmarks/baseline.json
+The compare run exits with status 1 when any case regressed.
+"""
+import argparse
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import _harness  # noqa: E402
+import _synthetic  # noqa: E402
+import email_templates  # noqa: E402
+from bin_packing import first_fit_decreasing  # noqa: E402
+from columnar_export import frames  # noqa: E402
+from attachments import assemble_attachments  # noqa: E402
+from excel_generator import generate_excel  # noqa: E402
+from expense_store import ExpenseStore  # noqa: E402
+from fx_rates import apply_fx  # noqa: E402
+from mail_transport import iter_mime_message, iter_sendgrid_payload  # noqa: E402
+from report_utils import build_email_html, build_email_text, calc_totals  # noqa: E402
+from submit_pipeline import build_package  # noqa: E402
+
+ITEM_SIZES = [1, 100, 1000, 10000, 100000]
+RECEIPT_MB = [0, 1, 6, 18]
+QUICK_ITEM_SIZES = [1, 100, 1000]
+QUICK_RECEIPT_MB = [0, 1]
+ENGINES = ["standard", "streaming", "template"]
+
+
+def drain(chunks) -> int:
+    return sum(len(c) for c in chunks)
+
+
+def item_cases(n: int):
+    trip_info, expenses = _synthetic.trip(n)
+    store = ExpenseStore(expenses)
+    fields = _synthetic.email_fields(trip_info, expenses)
+
+    fx_lines = [dict(e, currency=("USD", "EUR", "GBP", "JPY")[i % 4]) for i, e in enumerate(expenses)]
+    rates = _synthetic.fx_rates()
+    policy = _synthetic.policy()
+    audit_reports = [
+        (dict(trip_info, location=f"City {r % 50}"), expenses[r * 20 : (r + 1) * 20]) for r in range(max(1, n // 20))
+    ]
+    # Attachment sizes of 50 KB to 4 MB, packed into 18 MB emails
+    sizes = [50_000 + (i * 7_919_993) % 4_000_000 for i in range(n)]
+
+    def email_html():
+        email_templates._row_cells.cache_clear()
+        build_email_html(**fields)
+
+    yield f"calc_totals/list/items={n}", lambda: calc_totals(expenses), n
+    yield f"calc_totals/store/items={n}", lambda: calc_totals(store), n
+    yield f"fx_convert/items={n}", lambda: apply_fx(fx_lines, rates), n
+    yield f"policy_audit/items={n}", lambda: policy.audit(audit_reports), n
+    yield f"export_frames/items={n}", lambda: frames(audit_reports), n
+    yield f"email_html/items={n}", email_html, n
+    yield f"pack/items={n}", lambda: first_fit_decreasing(sizes, 18 * _synthetic.MB, first=0), n
+    yield f"email_text/items={n}", lambda: build_email_text(**fields), n
+    for engine in ENGINES:
+        yield f"excel_{engine}/items={n}", lambda engine=engine: generate_excel(trip_info, expenses, engine=engine), n
+
+
+def receipt_cases(mb: float):
+    n_files = len(_synthetic.receipts(mb))
+    trip_info, expenses = _synthetic.trip(max(10, n_files), receipt_mb=mb)
+    excel_bytes = generate_excel(trip_info, expenses, engine="streaming")
+    attachments, _stats = assemble_attachments(trip_info["employee_name"], excel_bytes, expenses, optimize=True)
+    total_mb = sum(len(a["content_bytes"]) for a in attachments) / _synthetic.MB
+    message = ("s@example.com", ["f@example.com"], ["a@example.com"], "Subject", "<p>Body</p>", attachments)
+
+    yield (
+        f"attachments/mb={mb:g}",
+        lambda: assemble_attachments(trip_info["employee_name"], excel_bytes, expenses, optimize=True),
+        total_mb,
+    )
+    yield f"package/mb={mb:g}", lambda: build_package(trip_info, expenses, optimize=True), total_mb
+    yield f"payload_sendgrid/mb={mb:g}", lambda: drain(iter_sendgrid_payload(*message)), total_mb
+    yield f"payload_mime/mb={mb:g}", lambda: drain(iter_mime_message(*message)), total_mb
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--items", type=int, nargs="*", help=f"line item counts, default {ITEM_SIZES}")
+    parser.add_argument("--receipt-mb", type=float, nargs="*", help=f"receipt totals in MB, default {RECEIPT_MB}")
+    parser.add_argument("--quick", action="store_true", help="small sizes only")
+    parser.add_argument("--only", help="run only cases whose name contains this")
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--budget", type=float, default=5.0, help="seconds of timed runs per case")
+    parser.add_argument("--no-memory", action="store_true", help="skip the traced peak memory run")
+    _harness.add_baseline_args(parser)
+    args = parser.parse_args()
+
+    items = args.items if args.items is not None else (QUICK_ITEM_SIZES if args.quick else ITEM_SIZES)
+    receipt_mb = args.receipt_mb if args.receipt_mb is not None else (QUICK_RECEIPT_MB if args.quick else RECEIPT_MB)
+
+    def cases():
+        for n in items:
+            yield from (c + ("items",) for c in item_cases(n))
+        for mb in receipt_mb:
+            yield from (c + ("MB",) for c in receipt_cases(mb))
+
+    results = {}
+    _harness.print_row_header()
+    for name, fn, units, unit in cases():
+        if args.only and args.only not in name:
+            continue
+        r = _harness.summarize(_harness.measure(fn, args.repeat, args.budget), units, unit)
+        r["peak_mb"] = None if args.no_memory else _harness.traced_peak_mb(fn)
+        results[name] = r
+        _harness.print_row(name, r)
+
+    return _harness.finish(args, results)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
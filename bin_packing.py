@@ -0,0 +1,62 @@
+"""
+First-fit decreasing bin packing, used to split a report's attachments
+over the fewest emails that each stay under the size limit.
+
+Plain first fit scans every open bin for each item, O(n * bins). Here the
+bins' free space sits in a max segment tree, so finding the first bin an
+item fits in is a walk from the root, and packing n items is O(n log n)
+including the sort.
+"""
+from typing import List, Optional, Sequence
+
+
+class _FirstFit:
+    """Free space of up to n bins, all starting empty, in a max segment tree."""
+
+    def __init__(self, n: int, capacity: int):
+        self.size = 1
+        while self.size < max(1, n):
+            self.size *= 2
+        self.capacity = capacity
+        self.tree = [capacity] * (2 * self.size)
+
+    def place(self, nbytes: int) -> int:
+        """Index of the first bin with room for nbytes, which is then taken."""
+        i = 1
+        while i < self.size:
+            i = 2 * i if self.tree[2 * i] >= nbytes else 2 * i + 1
+        self.tree[i] -= nbytes
+        b = i - self.size
+        i //= 2
+        while i:
+            self.tree[i] = max(self.tree[2 * i], self.tree[2 * i + 1])
+            i //= 2
+        return b
+
+
+def first_fit_decreasing(sizes: Sequence[int], capacity: int, first: Optional[int] = None) -> List[List[int]]:
+    """
+    Indices of sizes grouped into bins of at most capacity, in bin order,
+    each bin's indices ascending. The item at index first, when given, is
+    placed before the others so it lands in the first bin. Raises
+    ValueError if an item is larger than capacity.
+    """
+    too_big = [s for s in sizes if s > capacity]
+    if too_big:
+        raise ValueError(f"item of {max(too_big)} bytes does not fit in {capacity}")
+
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+    if first is not None:
+        order.remove(first)
+        order.insert(0, first)
+
+    bins = _FirstFit(len(sizes), capacity)
+    packed: List[List[int]] = []
+    for i in order:
+        b = bins.place(sizes[i])
+        if b == len(packed):
+            packed.append([])
+        packed[b].append(i)
+    for p in packed:
+        p.sort()
+    return packed
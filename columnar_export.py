@@ -0,0 +1,343 @@
+"""
+Columnar export of submitted reports for BI tools, as month partitioned
+Parquet or CSV datasets:
+
+  <root>/reports/month=2024-05/part-<written_at>-<id>.parquet
+  <root>/line_items/month=2024-05/part-<written_at>-<id>.parquet
+
+Reports are partitioned by departure month, line items by expense month
+(the departure month where a line has no date). The month=YYYY-MM folders
+are Hive style, so Spark, DuckDB and pyarrow.dataset read the tree as is.
+
+Every append writes new part files next to the old ones, through a temp
+file and a rename, and never opens an existing part again. A reader sees
+a part whole or not at all, and an append costs the same on the first
+day of a month as on the last.
+
+Frames are built column by column: each field is pulled out of the line
+items once, the report fields are repeated onto their lines with
+numpy.repeat and the dtypes are set on whole columns, so there is no dict
+per row. Parquet needs pyarrow, CSV works with pandas alone.
+"""
+import os
+import threading
+import time
+import uuid
+from itertools import chain
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+try:
+    import pyarrow  # noqa: F401
+except ImportError:  # optional, only needed for Parquet
+    pyarrow = None
+
+PARQUET = "parquet"
+CSV = "csv"
+FORMATS = (PARQUET, CSV)
+REPORTS = "reports"
+LINE_ITEMS = "line_items"
+TABLES = (REPORTS, LINE_ITEMS)
+
+# Column dtypes of each table, also used to restore them when reading CSV
+REPORT_DTYPES = {
+    "report_id": "string",
+    "submitted_at": "datetime64[ns, UTC]",
+    "employee": "string",
+    "employee_name": "string",
+    "employee_email": "string",
+    "location": "string",
+    "purpose": "string",
+    "departure_date": "datetime64[ns]",
+    "return_date": "datetime64[ns]",
+    "trip_days": "float64",
+    "per_diem_rate": "float64",
+    "per_diem_total": "float64",
+    "total_spend": "float64",
+    "company_paid": "float64",
+    "employee_paid": "float64",
+    "reimbursement_due": "float64",
+    "line_items": "int32",
+}
+LINE_ITEM_DTYPES = {
+    "report_id": "string",
+    "line": "int32",
+    "employee": "string",
+    "category": "category",
+    "expense_date": "datetime64[ns]",
+    "paid_by": "category",
+    "description": "string",
+    "amount": "float64",
+    "currency": "category",
+    "original_amount": "float64",
+    "fx_rate": "float64",
+    "has_receipt": "bool",
+    "receipt_name": "string",
+}
+DTYPES = {REPORTS: REPORT_DTYPES, LINE_ITEMS: LINE_ITEM_DTYPES}
+
+Report = Tuple[Dict[str, Any], Iterable[Dict[str, Any]]]
+
+
+def default_format() -> str:
+    return PARQUET if pyarrow is not None else CSV
+
+
+def _receipt_name(receipt) -> Optional[str]:
+    # An uploaded or stored receipt has .name, the batch CLI passes a path
+    if not receipt:
+        return None
+    if isinstance(receipt, str):
+        return os.path.basename(receipt)
+    return getattr(receipt, "name", None)
+
+
+def _dates(values) -> pd.Series:
+    # date objects, ISO strings and blanks alike, blanks become NaT
+    return pd.Series(pd.to_datetime(pd.Series(values, dtype=object), errors="coerce").astype("datetime64[ns]"))
+
+
+def _months(dates: pd.Series) -> np.ndarray:
+    """"YYYY-MM" of each date, "unknown" for NaT. Formats each distinct month once."""
+    months, inverse = np.unique(dates.to_numpy().astype("datetime64[M]"), return_inverse=True)
+    labels = np.array(["unknown" if np.isnat(m) else str(m) for m in months], dtype=object)
+    return labels[inverse.reshape(-1)]
+
+
+def _numbers(values) -> np.ndarray:
+    return pd.to_numeric(pd.Series(values, dtype=object), errors="coerce").to_numpy(dtype=float)
+
+
+def frames(
+    reports: Iterable[Report],
+    report_ids: Optional[List[str]] = None,
+    submitted_at: Optional[float] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    (reports, line_items) DataFrames of (trip_info, expenses) pairs, typed
+    as in REPORT_DTYPES and LINE_ITEM_DTYPES plus a "month" column, the
+    partition. report_ids, one per report, link the two tables, random
+    ids are used without them.
+    """
+    trips: List[Dict[str, Any]] = []
+    items: List[List[Dict[str, Any]]] = []
+    for trip_info, expenses in reports:
+        trips.append(trip_info)
+        items.append(list(expenses))
+    if report_ids is None:
+        report_ids = [uuid.uuid4().hex[:16] for _ in trips]
+    counts = np.fromiter((len(e) for e in items), dtype=np.int64, count=len(items))
+
+    def trip_col(key):
+        return [t.get(key) for t in trips]
+
+    employee = pd.Series(trip_col("employee_email"), dtype="string").str.strip().str.lower()
+    departure = _dates(trip_col("departure_date"))
+    report_frame = pd.DataFrame(
+        {
+            "report_id": pd.Series(report_ids, dtype="string"),
+            "submitted_at": pd.Series(
+                pd.to_datetime(np.full(len(trips), submitted_at or time.time()), unit="s", utc=True)
+            ),
+            "employee": employee,
+            "employee_name": pd.Series(trip_col("employee_name"), dtype="string"),
+            "employee_email": pd.Series(trip_col("employee_email"), dtype="string"),
+            "location": pd.Series(trip_col("location"), dtype="string"),
+            "purpose": pd.Series(trip_col("purpose"), dtype="string"),
+            "departure_date": departure,
+            "return_date": _dates(trip_col("return_date")),
+            **{
+                k: _numbers(trip_col(k))
+                for k in (
+                    "trip_days",
+                    "per_diem_rate",
+                    "per_diem_total",
+                    "total_spend",
+                    "company_paid",
+                    "employee_paid",
+                    "reimbursement_due",
+                )
+            },
+            "line_items": counts.astype(np.int32),
+        }
+    )
+    report_frame["month"] = _months(departure)
+
+    flat = list(chain.from_iterable(items))
+
+    def item_col(key):
+        return [e.get(key) for e in flat]
+
+    # Report level values repeated onto each of their lines
+    owner = np.repeat(np.arange(len(trips)), counts)
+    expense_date = _dates(item_col("expense_date"))
+    expense_date = expense_date.fillna(pd.Series(departure.to_numpy()[owner]))
+    amount = _numbers(item_col("amount"))
+    currency = pd.Series(item_col("currency"), dtype=object).fillna("USD")
+    original = _numbers(item_col("original_amount"))
+    receipts = item_col("receipt_file")
+    line_frame = pd.DataFrame(
+        {
+            "report_id": pd.Series(np.asarray(report_ids, dtype=object)[owner], dtype="string"),
+            "line": (np.arange(len(flat)) - np.repeat(np.cumsum(counts) - counts, counts) + 1).astype(np.int32),
+            "employee": pd.Series(employee.to_numpy()[owner], dtype="string"),
+            "category": pd.Series(item_col("category"), dtype="category"),
+            "expense_date": expense_date,
+            "paid_by": pd.Series(item_col("paid_by"), dtype="category"),
+            "description": pd.Series(item_col("description"), dtype="string"),
+            "amount": np.nan_to_num(amount),
+            "currency": currency.astype("category"),
+            "original_amount": np.where(np.isnan(original), amount, original),
+            "fx_rate": np.nan_to_num(_numbers(item_col("fx_rate")), nan=1.0),
+            "has_receipt": np.fromiter((bool(r) for r in receipts), dtype=bool, count=len(receipts)),
+            "receipt_name": pd.Series([_receipt_name(r) for r in receipts], dtype="string"),
+        }
+    )
+    line_frame["month"] = _months(expense_date)
+    return report_frame, line_frame
+
+
+class ColumnarExport:
+    """Append only, month partitioned reports and line_items datasets. See the module docstring."""
+
+    def __init__(self, root: str, fmt: Optional[str] = None):
+        fmt = fmt or default_format()
+        if fmt not in FORMATS:
+            raise ValueError(f"Export format must be one of {', '.join(FORMATS)}, not {fmt!r}")
+        if fmt == PARQUET and pyarrow is None:
+            raise ValueError("Parquet export needs pyarrow, install it or use the csv format")
+        self.root = root
+        self.fmt = fmt
+        self._lock = threading.Lock()
+        for table in TABLES:
+            os.makedirs(os.path.join(root, table), exist_ok=True)
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def append(
+        self,
+        trip_info: Dict[str, Any],
+        expenses: Iterable[Dict[str, Any]],
+        report_id=None,
+        submitted_at: Optional[float] = None,
+    ) -> List[str]:
+        """Adds one report. Returns the paths of the new part files."""
+        ids = [str(report_id)] if report_id is not None else None
+        return self.append_many([(trip_info, expenses)], report_ids=ids, submitted_at=submitted_at)
+
+    def append_many(
+        self,
+        reports: Iterable[Report],
+        report_ids: Optional[List[str]] = None,
+        submitted_at: Optional[float] = None,
+    ) -> List[str]:
+        """
+        Adds many reports with one part file per table and month, the way
+        to load a batch. Returns the paths of the new part files.
+        """
+        report_frame, line_frame = frames(reports, report_ids, submitted_at)
+        written = []
+        with self._lock:
+            for table, frame in ((REPORTS, report_frame), (LINE_ITEMS, line_frame)):
+                for month, part in frame.groupby("month", sort=True, observed=True):
+                    written.append(self._write_part(table, month, part.drop(columns="month")))
+        return written
+
+    def _write_part(self, table: str, month: str, frame: pd.DataFrame) -> str:
+        part_dir = os.path.join(self.root, table, f"month={month}")
+        os.makedirs(part_dir, exist_ok=True)
+        name = f"part-{time.time():017.6f}-{uuid.uuid4().hex[:8]}.{self.fmt}"
+        path = os.path.join(part_dir, name)
+        tmp = os.path.join(part_dir, f".{name}.tmp")
+        if self.fmt == PARQUET:
+            frame.to_parquet(tmp, index=False)
+        else:
+            # Date columns as plain dates, UTC timestamps with their time of day
+            frame = frame.assign(
+                **{
+                    c: frame[c].dt.strftime("%Y-%m-%d" if dtype == "datetime64[ns]" else "%Y-%m-%dT%H:%M:%S.%fZ")
+                    for c, dtype in DTYPES[table].items()
+                    if c in frame and dtype.startswith("datetime64")
+                }
+            )
+            frame.to_csv(tmp, index=False)
+        # Readers skip dot files, the rename publishes the part whole
+        os.replace(tmp, path)
+        return path
+
+    # -------------------------
+    # Reads
+    # -------------------------
+    def read(self, table: str = LINE_ITEMS, months: Optional[Iterable[str]] = None, columns=None) -> pd.DataFrame:
+        return read_dataset(self.root, table, months, columns)
+
+
+def part_files(root: str, table: str = LINE_ITEMS, months: Optional[Iterable[str]] = None) -> List[Tuple[str, str]]:
+    """(month, path) of every part of a table, oldest month and part first."""
+    if table not in TABLES:
+        raise ValueError(f"Table must be one of {', '.join(TABLES)}, not {table!r}")
+    wanted = set(months) if months is not None else None
+    base = os.path.join(root, table)
+    if not os.path.isdir(base):
+        return []
+    out = []
+    for folder in sorted(os.listdir(base)):
+        if not folder.startswith("month="):
+            continue
+        month = folder[len("month=") :]
+        if wanted is not None and month not in wanted:
+            continue
+        for name in sorted(os.listdir(os.path.join(base, folder))):
+            if name.startswith("part-") and name.rsplit(".", 1)[-1] in FORMATS:
+                out.append((month, os.path.join(base, folder, name)))
+    return out
+
+
+def read_dataset(
+    root: str,
+    table: str = LINE_ITEMS,
+    months: Optional[Iterable[str]] = None,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """
+    One DataFrame of a table's parts, all months or just the given
+    "YYYY-MM" ones, with a "month" column and the dtypes of DTYPES.
+    columns limits what is read, Parquet reads only those columns.
+    Parquet and CSV parts can be mixed in one tree.
+    """
+    dtypes = DTYPES[table] if table in DTYPES else {}
+    wanted = [c for c in (columns or dtypes) if c != "month"]
+    parts = part_files(root, table, months)
+
+    frames_read = []
+    for month, path in parts:
+        if path.endswith("." + PARQUET):
+            frame = pd.read_parquet(path, columns=wanted)
+        else:
+            frame = pd.read_csv(path, usecols=wanted, dtype=str, keep_default_na=False, na_values=[""])
+        frame["month"] = month
+        frames_read.append(frame)
+    if not frames_read:
+        out = pd.DataFrame({c: pd.Series(dtype=dtypes.get(c, object)) for c in wanted})
+        out["month"] = pd.Series(dtype="string")
+        return out
+
+    out = pd.concat(frames_read, ignore_index=True)
+    # Categories differ between parts and CSV comes back as text, so the
+    # dtypes are set once on the combined columns
+    for c in wanted:
+        dtype = dtypes.get(c)
+        if dtype is None:
+            continue
+        if dtype.startswith("datetime64"):
+            out[c] = pd.to_datetime(out[c], utc=dtype.endswith("UTC]"), format="mixed").astype(dtype)
+        elif dtype == "bool":
+            if out[c].dtype != bool:
+                out[c] = out[c].astype(str).eq("True")
+        else:
+            out[c] = out[c].astype(dtype)
+    out["month"] = out["month"].astype("string")
+    return out
@@ -0,0 +1,207 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import date
+from typing import List, Dict, Any, Optional
+
+from receipt_store import ReceiptRef, ReceiptStore
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS draft_items (
+    item_id        TEXT PRIMARY KEY,
+    employee       TEXT NOT NULL,
+    seq            INTEGER NOT NULL,
+    category       TEXT,
+    expense_date   TEXT,
+    paid_by        TEXT,
+    description    TEXT,
+    amount         REAL,
+    receipt_digest TEXT,
+    receipt_name   TEXT,
+    receipt_size   INTEGER,
+    added_at       REAL,
+    currency       TEXT,
+    original_amount REAL
+);
+CREATE INDEX IF NOT EXISTS draft_items_employee ON draft_items (employee, seq);
+CREATE INDEX IF NOT EXISTS draft_items_receipt ON draft_items (receipt_digest);
+"""
+
+
+def new_item_id() -> str:
+    return uuid.uuid4().hex
+
+
+def draft_owner(employee_email: str, token: str) -> str:
+    """
+    Key of a draft: the employee email together with a token only the
+    user's browser holds, hashed. Knowing someone's email is not enough to
+    open their draft.
+    """
+    email = (employee_email or "").strip().lower()
+    return hashlib.sha256(f"{token}\0{email}".encode("utf-8")).hexdigest()
+
+
+class DraftStore:
+    """
+    In-progress reports persisted in SQLite, keyed by draft_owner().
+
+    Every Add Expense and Remove is one INSERT or DELETE of a single line
+    item, never a rewrite of the whole list, and restoring a draft is one
+    indexed range query. Receipts are kept as a content hash pointing into
+    the ReceiptStore, so nothing is uploaded or copied twice. has_receipt()
+    lets the ReceiptStore keep the blobs a draft still points to.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        cols = {r[1] for r in self._conn.execute("PRAGMA table_info(draft_items)")}
+        for name, kind in (("currency", "TEXT"), ("original_amount", "REAL")):
+            if name not in cols:
+                self._conn.execute(f"ALTER TABLE draft_items ADD COLUMN {name} {kind}")
+
+    def add(self, owner: str, expense: Dict[str, Any]) -> str:
+        """Persist one line item. Sets and returns expense["draft_id"]."""
+        item_id = expense.get("draft_id") or new_item_id()
+        expense["draft_id"] = item_id
+        receipt = expense.get("receipt_file")
+        expense_date = expense.get("expense_date")
+        with self._lock:
+            self._conn.execute(
+                """
+                INSERT OR REPLACE INTO draft_items
+                (item_id, employee, seq, category, expense_date, paid_by, description, amount,
+                 receipt_digest, receipt_name, receipt_size, added_at, currency, original_amount)
+                VALUES (?, ?, (SELECT COALESCE(MAX(seq), 0) + 1 FROM draft_items WHERE employee = ?),
+                        ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                """,
+                (
+                    item_id,
+                    owner,
+                    owner,
+                    expense.get("category"),
+                    expense_date.isoformat() if isinstance(expense_date, date) else expense_date,
+                    expense.get("paid_by"),
+                    expense.get("description"),
+                    float(expense.get("amount") or 0),
+                    getattr(receipt, "digest", None),
+                    getattr(receipt, "name", None),
+                    getattr(receipt, "size", None),
+                    time.time(),
+                    expense.get("currency"),
+                    expense.get("original_amount"),
+                ),
+            )
+        return item_id
+
+    def remove(self, owner: str, item_id: Optional[str]) -> None:
+        if not item_id:
+            return
+        with self._lock:
+            self._conn.execute(
+                "DELETE FROM draft_items WHERE employee = ? AND item_id = ?",
+                (owner, item_id),
+            )
+
+    def remove_many(self, owner: str, item_ids: List[Optional[str]]) -> None:
+        ids = [(owner, i) for i in item_ids if i]
+        with self._lock:
+            self._conn.executemany("DELETE FROM draft_items WHERE employee = ? AND item_id = ?", ids)
+
+    def update(self, owner: str, expense: Dict[str, Any]) -> None:
+        """Rewrite an edited line item in place, keeping its position."""
+        if not expense.get("draft_id"):
+            self.add(owner, expense)
+            return
+        expense_date = expense.get("expense_date")
+        with self._lock:
+            self._conn.execute(
+                """
+                UPDATE draft_items SET category = ?, expense_date = ?, paid_by = ?, description = ?, amount = ?,
+                                       currency = ?, original_amount = ?
+                WHERE employee = ? AND item_id = ?
+                """,
+                (
+                    expense.get("category"),
+                    expense_date.isoformat() if isinstance(expense_date, date) else expense_date,
+                    expense.get("paid_by"),
+                    expense.get("description"),
+                    float(expense.get("amount") or 0),
+                    expense.get("currency"),
+                    expense.get("original_amount"),
+                    owner,
+                    expense["draft_id"],
+                ),
+            )
+
+    def clear(self, owner: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM draft_items WHERE employee = ?", (owner,))
+
+    def count(self, owner: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM draft_items WHERE employee = ?", (owner,)
+            ).fetchone()
+        return int(row[0])
+
+    def load(self, owner: str, receipts: Optional[ReceiptStore] = None) -> List[Dict[str, Any]]:
+        """
+        Line items of the owner's draft, in the order they were added.
+        A receipt whose blob is no longer in the store comes back as None.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT item_id, category, expense_date, paid_by, description, amount,
+                       receipt_digest, receipt_name, receipt_size, currency, original_amount
+                FROM draft_items WHERE employee = ? ORDER BY seq
+                """,
+                (owner,),
+            ).fetchall()
+
+        expenses = []
+        for (
+            item_id, category, expense_date, paid_by, description, amount, digest, name, size, currency, original
+        ) in rows:
+            receipt = None
+            if digest and receipts is not None and receipts.exists(digest):
+                receipt = ReceiptRef(receipts, digest, int(size or 0), name or "")
+            expenses.append(
+                {
+                    "category": category,
+                    "expense_date": date.fromisoformat(expense_date) if expense_date else expense_date,
+                    "paid_by": paid_by,
+                    "description": description,
+                    "amount": float(amount or 0),
+                    "receipt_file": receipt,
+                    "draft_id": item_id,
+                    "currency": currency,
+                    "original_amount": original,
+                }
+            )
+        return expenses
+
+    def has_receipt(self, digest: str) -> bool:
+        """Whether any draft points to the receipt blob."""
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM draft_items WHERE receipt_digest = ? LIMIT 1", (digest,)).fetchone()
+        return row is not None
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
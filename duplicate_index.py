@@ -0,0 +1,345 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from datetime import date
+from io import BytesIO
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+from receipt_store import IMAGE_EXTS
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS receipt_hashes (
+    digest     TEXT NOT NULL,
+    dhash      INTEGER,
+    band0      INTEGER,
+    band1      INTEGER,
+    band2      INTEGER,
+    band3      INTEGER,
+    report_id  INTEGER,
+    employee   TEXT,
+    added_at   REAL
+);
+CREATE INDEX IF NOT EXISTS receipt_hashes_digest ON receipt_hashes (digest);
+CREATE INDEX IF NOT EXISTS receipt_hashes_band0 ON receipt_hashes (band0, dhash);
+CREATE INDEX IF NOT EXISTS receipt_hashes_band1 ON receipt_hashes (band1, dhash);
+CREATE INDEX IF NOT EXISTS receipt_hashes_band2 ON receipt_hashes (band2, dhash);
+CREATE INDEX IF NOT EXISTS receipt_hashes_band3 ON receipt_hashes (band3, dhash);
+
+CREATE TABLE IF NOT EXISTS expense_fingerprints (
+    category     TEXT NOT NULL,
+    expense_date TEXT NOT NULL,
+    amount_cents INTEGER NOT NULL,
+    report_id    INTEGER,
+    employee     TEXT,
+    added_at     REAL
+);
+CREATE INDEX IF NOT EXISTS expense_fingerprints_key
+    ON expense_fingerprints (expense_date, amount_cents, category);
+"""
+
+# The dHash is stored as four 16 bit bands. Two hashes within 3 bits of
+# each other agree on at least one band, so a near match is a covering
+# index lookup per band, an exact bit count on the few candidate hashes,
+# and a table read only for the ones that are close enough.
+BANDS = 4
+BAND_BITS = 16
+MAX_DISTANCE_LIMIT = BANDS - 1
+DEFAULT_MAX_DISTANCE = 3
+
+# (category, expense_date, amount in cents)
+Fingerprint = Tuple[str, str, int]
+# (report_id, employee)
+Entry = Tuple[Optional[int], str]
+
+_DHASH_MEMO_MAX = 4096
+
+
+# -------------------------
+# Hashing
+# -------------------------
+def sha256_hex(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def dhash(data, hash_size: int = 8) -> Optional[int]:
+    """
+    64 bit difference hash of an image, None if it cannot be decoded.
+    Resized and recompressed copies of a receipt land a few bits apart.
+    """
+    # Pillow is only needed once an image receipt is checked, not on every rerun
+    from PIL import Image, ImageOps
+
+    try:
+        img = Image.open(BytesIO(data))
+        # JPEG decodes straight to a small size, far cheaper than a full decode
+        img.draft("L", (hash_size * 8, hash_size * 8))
+        img = ImageOps.exif_transpose(img).convert("L").resize((hash_size + 1, hash_size), Image.BILINEAR)
+    except Exception:
+        return None
+    px = img.tobytes()
+    bits = 0
+    for row in range(hash_size):
+        base = row * (hash_size + 1)
+        for col in range(hash_size):
+            bits = (bits << 1) | (px[base + col] > px[base + col + 1])
+    return bits
+
+
+def expense_fingerprint(category, expense_date, amount) -> Fingerprint:
+    if isinstance(expense_date, date):
+        expense_date = expense_date.isoformat()
+    return (str(category or "").strip().lower(), str(expense_date or "")[:10], int(round(float(amount or 0) * 100)))
+
+
+def _ext(name: str) -> str:
+    return (name.rsplit(".", 1)[-1] if "." in (name or "") else "").lower()
+
+
+# SQLite integers are signed 64 bit
+def _to_db(h: Optional[int]) -> Optional[int]:
+    return h - (1 << 64) if h is not None and h >= 1 << 63 else h
+
+
+def _from_db(h: Optional[int]) -> Optional[int]:
+    return h + (1 << 64) if h is not None and h < 0 else h
+
+
+def _bands(h: Optional[int]) -> Tuple[Optional[int], ...]:
+    if h is None:
+        return (None,) * BANDS
+    mask = (1 << BAND_BITS) - 1
+    return tuple((h >> (i * BAND_BITS)) & mask for i in range(BANDS))
+
+
+# -------------------------
+# Index
+# -------------------------
+def _earlier_report(match: Dict[str, Any]) -> str:
+    report_id = match.get("report_id")
+    return f"report #{report_id}" if report_id is not None else "an earlier report"
+
+
+class DuplicateIndex:
+    """
+    Receipts and expense lines already submitted, for flagging repeats.
+
+    Receipts are matched exactly on sha256 and approximately on a 64 bit
+    dHash, so a rescan or recompressed photo of the same receipt is caught
+    too. Expense lines are matched on (category, expense_date, amount).
+
+    Every check is one or two indexed SQLite lookups, well under a
+    millisecond at a million rows. Nothing is loaded up front, so opening
+    the index is instant and memory does not grow with history.
+    """
+
+    def __init__(self, path: str, max_distance: int = DEFAULT_MAX_DISTANCE):
+        if not 0 <= max_distance <= MAX_DISTANCE_LIMIT:
+            raise ValueError(f"max_distance must be between 0 and {MAX_DISTANCE_LIMIT}")
+        self.path = path
+        self.max_distance = max_distance
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Room for the band indexes, which bulk builds update at random
+        self._conn.execute("PRAGMA cache_size=-131072")
+        self._conn.executescript(_SCHEMA)
+        # dHash of receipts seen by this process, so reruns never decode twice
+        self._dhash_memo: Dict[str, Optional[int]] = {}
+        self._writes = 0
+
+    # -------------------------
+    # Checks
+    # -------------------------
+    def generation(self) -> Tuple[int, int]:
+        """
+        Changes whenever rows are added, by this process or another one on
+        the same file. Part of the key of anything cached from a scan.
+        """
+        with self._lock:
+            # data_version only moves for commits made on other connections
+            return self._writes, self._conn.execute("PRAGMA data_version").fetchone()[0]
+
+    def receipt_dhash(self, receipt) -> Optional[int]:
+        """dHash of a ReceiptRef or UploadedFile, memoized by content hash."""
+        digest = getattr(receipt, "digest", None)
+        if digest is not None and digest in self._dhash_memo:
+            return self._dhash_memo[digest]
+        if _ext(getattr(receipt, "name", "")) not in IMAGE_EXTS:
+            h = None
+        else:
+            view = getattr(receipt, "view", None)
+            h = dhash(view() if view is not None else receipt.getvalue())
+        if digest is not None:
+            if len(self._dhash_memo) >= _DHASH_MEMO_MAX:
+                self._dhash_memo.clear()
+            self._dhash_memo[digest] = h
+        return h
+
+    def find_receipt(self, digest: str, h: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Earlier submissions of this receipt, exact or within max_distance bits."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT report_id, employee FROM receipt_hashes WHERE digest = ?", (digest,)
+            ).fetchall()
+            similar = []
+            if h is not None:
+                candidates = self._conn.execute(
+                    " UNION ".join(f"SELECT dhash FROM receipt_hashes WHERE band{i} = ?" for i in range(BANDS)),
+                    _bands(h),
+                ).fetchall()
+                for (other,) in candidates:
+                    distance = bin(h ^ _from_db(other)).count("1")
+                    if distance > self.max_distance:
+                        continue
+                    similar.extend(
+                        (report_id, employee, distance)
+                        for report_id, employee in self._conn.execute(
+                            "SELECT report_id, employee FROM receipt_hashes WHERE band0 = ? AND dhash = ?",
+                            (_bands(_from_db(other))[0], other),
+                        )
+                    )
+
+        matches = [{"report_id": r, "employee": emp, "match": "exact", "distance": 0} for r, emp in rows]
+        exact_reports = {r for r, _emp in rows}
+        matches.extend(
+            {"report_id": r, "employee": emp, "match": "similar", "distance": distance}
+            for r, emp, distance in similar
+            if r not in exact_reports
+        )
+        return matches
+
+    def find_expense(self, category, expense_date, amount) -> List[Dict[str, Any]]:
+        return self._find_fingerprint(expense_fingerprint(category, expense_date, amount))
+
+    def _find_fingerprint(self, fp: Fingerprint) -> List[Dict[str, Any]]:
+        category, expense_date, cents = fp
+        with self._lock:
+            rows = self._conn.execute(
+                """
+                SELECT report_id, employee FROM expense_fingerprints
+                WHERE expense_date = ? AND amount_cents = ? AND category = ?
+                """,
+                (expense_date, cents, category),
+            ).fetchall()
+        return [{"report_id": r, "employee": emp} for r, emp in rows]
+
+    def scan(self, expenses: Iterable[Dict[str, Any]]) -> List[Tuple[int, str]]:
+        """
+        Possible duplicates in a report, against the index and within the
+        report itself. Returns (line number, reason) pairs. Reasons name the
+        earlier report only by id, never who submitted it, since they are
+        shown to the current user.
+        """
+        issues: List[Tuple[int, str]] = []
+        lines_by_fp: Dict[Fingerprint, int] = {}
+        lines_by_digest: Dict[str, int] = {}
+        for i, e in enumerate(expenses, start=1):
+            fp = expense_fingerprint(e.get("category"), e.get("expense_date"), e.get("amount"))
+            if fp in lines_by_fp:
+                issues.append((i, f"same category, date and amount as line {lines_by_fp[fp]}"))
+            else:
+                lines_by_fp[fp] = i
+            for m in self._find_fingerprint(fp):
+                issues.append((i, f"same category, date and amount as {_earlier_report(m)}"))
+
+            receipt = e.get("receipt_file")
+            digest = getattr(receipt, "digest", None)
+            if digest is None:
+                continue
+            if digest in lines_by_digest:
+                issues.append((i, f"same receipt as line {lines_by_digest[digest]}"))
+            else:
+                lines_by_digest[digest] = i
+            for m in self.find_receipt(digest, self.receipt_dhash(receipt)):
+                what = "receipt" if m["match"] == "exact" else "a very similar receipt"
+                issues.append((i, f"{what} already submitted in {_earlier_report(m)}"))
+        # Repeated lines in one earlier report would name it more than once
+        return list(dict.fromkeys(issues))
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def record(self, employee_email: str, expenses: Iterable[Dict[str, Any]], report_id: Optional[int] = None) -> None:
+        """Add a submitted report's lines and receipts to the index."""
+        self.bulk_add([(report_id, employee_email, e) for e in expenses])
+
+    def bulk_add(self, rows: Iterable[Tuple[Optional[int], str, Dict[str, Any]]]) -> int:
+        """
+        Index (report_id, employee_email, expense) rows in one transaction.
+        An expense may carry its receipt as receipt_file (ReceiptRef or
+        UploadedFile) or as receipt_digest plus an optional receipt_dhash.
+        Returns the number of rows.
+        """
+        now = time.time()
+        fps, receipts = [], []
+        for report_id, employee_email, e in rows:
+            entry = (report_id, (employee_email or "").strip().lower())
+            fps.append((expense_fingerprint(e.get("category"), e.get("expense_date"), e.get("amount")), entry))
+            receipt = e.get("receipt_file")
+            digest = e.get("receipt_digest") or getattr(receipt, "digest", None)
+            if digest is None and receipt is not None and hasattr(receipt, "getvalue"):
+                digest = sha256_hex(receipt.getvalue())
+            if digest is None:
+                continue
+            h = e.get("receipt_dhash")
+            if h is None and receipt is not None:
+                h = self.receipt_dhash(receipt)
+            receipts.append((digest, h, entry))
+
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.executemany(
+                    """
+                    INSERT INTO expense_fingerprints (category, expense_date, amount_cents, report_id, employee, added_at)
+                    VALUES (?, ?, ?, ?, ?, ?)
+                    """,
+                    [(*fp, *entry, now) for fp, entry in fps],
+                )
+                self._conn.executemany(
+                    """
+                    INSERT INTO receipt_hashes
+                    (digest, dhash, band0, band1, band2, band3, report_id, employee, added_at)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [(digest, _to_db(h), *_bands(h), *entry, now) for digest, h, entry in receipts],
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._writes += 1
+        return len(fps)
+
+    def build_from_archive(self, archive, receipts=None, batch_size: int = 50000) -> int:
+        """
+        Backfill from a ReportArchive, reading line items in batches. Receipt
+        dHashes are computed when the ReceiptStore still has the blob.
+        """
+        total = 0
+        batch = []
+        hashes: Dict[str, Optional[int]] = {}
+        for e in archive.iter_line_items():
+            digest = e.get("receipt_digest")
+            if digest:
+                if digest not in hashes:
+                    ok = receipts is not None and _ext(e.get("receipt_name") or "") in IMAGE_EXTS
+                    hashes[digest] = dhash(receipts.view(digest)) if ok and receipts.exists(digest) else None
+                e["receipt_dhash"] = hashes[digest]
+            batch.append((e["report_id"], e["employee"], e))
+            if len(batch) >= batch_size:
+                total += self.bulk_add(batch)
+                batch = []
+        if batch:
+            total += self.bulk_add(batch)
+        return total
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
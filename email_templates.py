@@ -0,0 +1,391 @@
+from functools import lru_cache
+from string import Template
+from typing import List, Dict, Any
+
+from fx_rates import BASE_CURRENCY, original_amount
+
+
+# Simple, clean HTML that reads well in Outlook and Gmail
+# No em dashes used
+
+# -----------------------------
+# Shared styles
+# -----------------------------
+FONT = "font-family:Arial, sans-serif;"
+TD_ITEM = 'style="padding:6px 8px;border-bottom:1px solid #eee;"'
+TD_ITEM_RIGHT = 'style="padding:6px 8px;border-bottom:1px solid #eee;text-align:right;"'
+TH_LEFT = 'style="text-align:left;padding:6px 8px;border-bottom:2px solid #ddd;"'
+TH_RIGHT = 'style="text-align:right;padding:6px 8px;border-bottom:2px solid #ddd;"'
+TD_LABEL = 'style="padding:4px 10px 4px 0;"'
+TD_VALUE = 'style="padding:4px 0;"'
+SPAN_ORIGINAL = 'style="color:#666;font-size:12px;"'
+
+_CLOSING = "Please let me know if any additional information is required."
+
+# One translate() pass instead of a chain of replace() calls
+_ESCAPES = str.maketrans({"&": "&amp;", "<": "&lt;", ">": "&gt;"})
+
+
+def esc(x) -> str:
+    if x is None:
+        return ""
+    return str(x).translate(_ESCAPES)
+
+
+# -----------------------------
+# Compiled templates
+# -----------------------------
+_DETAIL_ROW = Template(f"<tr><td {TD_LABEL}><strong>$label:</strong></td><td {TD_VALUE}>$value</td></tr>")
+
+_LINES_TABLE = Template(
+    f"""
+        <p><strong>Line items:</strong></p>
+        <table style="border-collapse:collapse;width:100%;{FONT}font-size:13px;">
+          <thead>
+            <tr>
+              <th {TH_LEFT}>#</th>
+              <th {TH_LEFT}>Category</th>
+              <th {TH_LEFT}>Date</th>
+              <th {TH_LEFT}>Description</th>
+              <th {TH_LEFT}>Paid By</th>
+              <th {TH_RIGHT}>Amount</th>
+              <th {TH_LEFT}>Receipt</th>
+            </tr>
+          </thead>
+          <tbody>
+$rows
+          </tbody>
+        </table>
+"""
+)
+
+_BODY = Template(
+    f"""
+    <div style="{FONT}font-size:14px;color:#111;">
+      <p>Dear Performa Finance,</p>
+
+      <p>Please find attached the submitted expense report for <strong>$employee_name</strong> and accompanying receipts.</p>
+
+      <p><strong>Details below:</strong></p>
+
+      <table style="border-collapse:collapse;{FONT}font-size:13px;">
+$details
+      </table>
+$lines
+      <p>{_CLOSING}</p>
+
+      <p>Best regards,<br>$employee_name</p>
+    </div>
+"""
+)
+
+
+# -----------------------------
+# Row fragments
+# -----------------------------
+def _row_key(e: Dict[str, Any]) -> tuple:
+    return (
+        str(e.get("category", "")),
+        str(e.get("expense_date", "")),
+        str(e.get("description", "")),
+        str(e.get("paid_by", "")),
+        float(e.get("amount") or 0),
+        bool(e.get("receipt_file")),
+        e.get("currency") or BASE_CURRENCY,
+        original_amount(e),
+        float(e.get("fx_rate") or 1.0),
+    )
+
+
+def _original_note(currency: str, original: float, fx_rate: float) -> str:
+    """Entered amount of a foreign currency line, empty for base currency lines."""
+    if currency == BASE_CURRENCY:
+        return ""
+    return f"{original:,.2f} {currency} at {fx_rate:.4f}"
+
+
+@lru_cache(maxsize=16384)
+def _row_cells(key: tuple) -> str:
+    """
+    Everything in a line item row after the # cell. Memoized on the row's
+    content, so a rerun only renders rows that are new or changed.
+    """
+    category, expense_date, description, paid_by, amount, has_receipt, currency, original, fx_rate = key
+    note = _original_note(currency, original, fx_rate)
+    if note:
+        note = f"<br><span {SPAN_ORIGINAL}>{esc(note)}</span>"
+    return (
+        f"<td {TD_ITEM}>{esc(category)}</td>"
+        f"<td {TD_ITEM}>{esc(expense_date)}</td>"
+        f"<td {TD_ITEM}>{esc(description)}</td>"
+        f"<td {TD_ITEM}>{esc(paid_by)}</td>"
+        f"<td {TD_ITEM_RIGHT}>${amount:,.2f}{note}</td>"
+        f"<td {TD_ITEM}>{'Yes' if has_receipt else 'No'}</td></tr>"
+    )
+
+
+def render_rows(expenses: List[Dict[str, Any]]) -> str:
+    return "\n".join(
+        f"            <tr><td {TD_ITEM}>{i}</td>{_row_cells(_row_key(e))}"
+        for i, e in enumerate(expenses, start=1)
+    )
+
+
+# -----------------------------
+# Public renderers
+# -----------------------------
+def _details(r: Dict[str, Any]) -> List[tuple]:
+    return [
+        ("Employee Name", esc(r["employee_name"])),
+        ("Employee Email", esc(r["employee_email"])),
+        ("Trip Location", esc(r["location"])),
+        ("Business Purpose", esc(r["purpose"])),
+        ("Departure Date", esc(r["departure_date"])),
+        ("Return Date", esc(r["return_date"])),
+        ("Per Diem Total", f"${r['per_diem_total']:,.2f}"),
+        ("Total Spend", f"${r['total_spend']:,.2f}"),
+        ("Company Paid", f"${r['company_paid']:,.2f}"),
+        ("Employee Paid", f"${r['employee_paid']:,.2f}"),
+        ("Reimbursement Due", f"${r['reimbursement_due']:,.2f}"),
+    ]
+
+
+def render_email_html(report: Dict[str, Any], expenses: List[Dict[str, Any]]) -> str:
+    """
+    report holds the build_email_html keyword arguments other than expenses.
+    """
+    details = "\n".join(
+        "        " + _DETAIL_ROW.substitute(label=label, value=value) for label, value in _details(report)
+    )
+    lines = _LINES_TABLE.substitute(rows=render_rows(expenses)) if expenses else ""
+    return _BODY.substitute(employee_name=esc(report["employee_name"]), details=details, lines=lines)
+
+
+def render_email_text(report: Dict[str, Any], expenses: List[Dict[str, Any]]) -> str:
+    """Plain text alternative part, same content as the HTML body."""
+    out = [
+        "Dear Performa Finance,",
+        "",
+        f"Please find attached the submitted expense report for {report['employee_name']} and accompanying receipts.",
+        "",
+        "Details below:",
+        "",
+    ]
+    details = [
+        ("Employee Name", report["employee_name"]),
+        ("Employee Email", report["employee_email"]),
+        ("Trip Location", report["location"]),
+        ("Business Purpose", report["purpose"]),
+        ("Departure Date", report["departure_date"]),
+        ("Return Date", report["return_date"]),
+        ("Per Diem Total", f"${report['per_diem_total']:,.2f}"),
+        ("Total Spend", f"${report['total_spend']:,.2f}"),
+        ("Company Paid", f"${report['company_paid']:,.2f}"),
+        ("Employee Paid", f"${report['employee_paid']:,.2f}"),
+        ("Reimbursement Due", f"${report['reimbursement_due']:,.2f}"),
+    ]
+    width = max(len(label) for label, _v in details) + 1
+    out.extend(f"{label + ':':<{width}} {'' if value is None else value}" for label, value in details)
+
+    if expenses:
+        out += ["", "Line items:", ""]
+        for i, e in enumerate(expenses, start=1):
+            category, expense_date, description, paid_by, amount, has_receipt, currency, original, fx_rate = _row_key(e)
+            line = f"{i}. {category}, {expense_date}, ${amount:,.2f}"
+            note = _original_note(currency, original, fx_rate)
+            if note:
+                line += f" ({note})"
+            line += f", paid by {paid_by}"
+            if description:
+                line += f", {description}"
+            line += ", receipt attached" if has_receipt else ", no receipt"
+            out.append(line)
+
+    out += [
+        "",
+        _CLOSING,
+        "",
+        "Best regards,",
+        str(report["employee_name"]),
+    ]
+    return "\n".join(out) + "\n"
+
+
+# -----------------------------
+# Split reports
+# -----------------------------
+_MANIFEST_TABLE = Template(
+    f"""
+      <p><strong>This report is sent in $n_parts emails with the same subject, numbered part 1 to $n_parts:</strong></p>
+      <table style="border-collapse:collapse;{FONT}font-size:13px;">
+        <thead>
+          <tr>
+            <th {TH_LEFT}>Part</th>
+            <th {TH_LEFT}>Attachment</th>
+            <th {TH_RIGHT}>Size</th>
+          </tr>
+        </thead>
+        <tbody>
+$rows
+        </tbody>
+      </table>
+"""
+)
+
+_PART_BODY = Template(
+    f"""
+    <div style="{FONT}font-size:14px;color:#111;">
+      <p>Dear Performa Finance,</p>
+
+      <p>This is part $part of $n_parts of the expense report for <strong>$employee_name</strong>.
+      The report details and the list of every part are in part 1.</p>
+
+      <p><strong>Attached in this part:</strong></p>
+      <ul>
+$items
+      </ul>
+
+      <p>Best regards,<br>$employee_name</p>
+    </div>
+"""
+)
+
+
+def _size(nbytes: int) -> str:
+    if nbytes >= 1024 * 1024:
+        return f"{nbytes / 1024 / 1024:,.2f} MB"
+    return f"{nbytes / 1024:,.0f} KB"
+
+
+def _manifest(parts: List[List[Dict[str, Any]]]) -> List[tuple]:
+    """(part number, filename, size) for every attachment of every part."""
+    return [
+        (n, a["filename"], _size(len(a["content_bytes"])))
+        for n, attachments in enumerate(parts, start=1)
+        for a in attachments
+    ]
+
+
+def add_manifest_html(html_body: str, parts: List[List[Dict[str, Any]]]) -> str:
+    """render_email_html output with the list of parts added above the closing lines."""
+    rows = "\n".join(
+        f"          <tr><td {TD_ITEM}>{n}</td><td {TD_ITEM}>{esc(name)}</td><td {TD_ITEM_RIGHT}>{size}</td></tr>"
+        for n, name, size in _manifest(parts)
+    )
+    head, sep, tail = html_body.rpartition(f"      <p>{_CLOSING}</p>")
+    if not sep:
+        head, tail = html_body, ""
+    return head + _MANIFEST_TABLE.substitute(n_parts=len(parts), rows=rows) + "\n" + sep + tail
+
+
+def add_manifest_text(text_body: str, parts: List[List[Dict[str, Any]]]) -> str:
+    """render_email_text output with the list of parts added above the closing lines."""
+    out = [f"This report is sent in {len(parts)} emails with the same subject, numbered part 1 to {len(parts)}:", ""]
+    out.extend(f"Part {n}: {name}, {size}" for n, name, size in _manifest(parts))
+    head, sep, tail = text_body.rpartition(_CLOSING)
+    if not sep:
+        return text_body + "\n" + "\n".join(out) + "\n"
+    return head + "\n".join(out) + "\n\n" + sep + tail
+
+
+def render_part_html(employee_name: str, part: int, n_parts: int, attachments: List[Dict[str, Any]]) -> str:
+    """Body of every part after the first, listing its attachments."""
+    items = "\n".join(
+        f"        <li>{esc(a['filename'])}, {_size(len(a['content_bytes']))}</li>" for a in attachments
+    )
+    return _PART_BODY.substitute(employee_name=esc(employee_name), part=part, n_parts=n_parts, items=items)
+
+
+def render_part_text(employee_name: str, part: int, n_parts: int, attachments: List[Dict[str, Any]]) -> str:
+    out = [
+        "Dear Performa Finance,",
+        "",
+        f"This is part {part} of {n_parts} of the expense report for {employee_name}.",
+        "The report details and the list of every part are in part 1.",
+        "",
+        "Attached in this part:",
+        "",
+    ]
+    out.extend(f"- {a['filename']}, {_size(len(a['content_bytes']))}" for a in attachments)
+    out += ["", "Best regards,", str(employee_name)]
+    return "\n".join(out) + "\n"
+
+
+# -----------------------------
+# Finance digest
+# -----------------------------
+_DIGEST_BODY = Template(
+    f"""
+    <div style="{FONT}font-size:14px;color:#111;">
+      <p>Dear Performa Finance,</p>
+
+      <p>Please find attached $n_reports expense report(s) submitted since the last digest, in one workbook.
+      The Rollup sheet has a row per report, numbered like the report sheets.
+      Receipts are named after the report number.</p>
+
+      <table style="border-collapse:collapse;width:100%;{FONT}font-size:13px;">
+        <thead>
+          <tr>
+            <th {TH_LEFT}>#</th>
+            <th {TH_LEFT}>Employee</th>
+            <th {TH_LEFT}>Location</th>
+            <th {TH_LEFT}>Dates</th>
+            <th {TH_RIGHT}>Total Spend</th>
+            <th {TH_RIGHT}>Reimbursement Due</th>
+          </tr>
+        </thead>
+        <tbody>
+$rows
+          <tr><td {TD_ITEM} colspan="4"><strong>Total</strong></td>
+            <td {TD_ITEM_RIGHT}><strong>$total_spend</strong></td>
+            <td {TD_ITEM_RIGHT}><strong>$reimbursement_due</strong></td></tr>
+        </tbody>
+      </table>
+
+      <p>Best regards,<br>Performa Expense Reports</p>
+    </div>
+"""
+)
+
+
+def render_digest_html(reports: List[Dict[str, Any]]) -> str:
+    """reports are the trip_info dicts of the digest, in workbook order."""
+    rows = "\n".join(
+        f"          <tr><td {TD_ITEM}>{i}</td><td {TD_ITEM}>{esc(r['employee_name'])}</td>"
+        f"<td {TD_ITEM}>{esc(r['location'])}</td>"
+        f"<td {TD_ITEM}>{esc(r['departure_date'])} to {esc(r['return_date'])}</td>"
+        f"<td {TD_ITEM_RIGHT}>${float(r['total_spend']):,.2f}</td>"
+        f"<td {TD_ITEM_RIGHT}>${float(r['reimbursement_due']):,.2f}</td></tr>"
+        for i, r in enumerate(reports, start=1)
+    )
+    return _DIGEST_BODY.substitute(
+        n_reports=len(reports),
+        rows=rows,
+        total_spend=f"${sum(float(r['total_spend']) for r in reports):,.2f}",
+        reimbursement_due=f"${sum(float(r['reimbursement_due']) for r in reports):,.2f}",
+    )
+
+
+def render_digest_text(reports: List[Dict[str, Any]]) -> str:
+    out = [
+        "Dear Performa Finance,",
+        "",
+        f"Please find attached {len(reports)} expense report(s) submitted since the last digest, in one workbook.",
+        "The Rollup sheet has a row per report, numbered like the report sheets. "
+        "Receipts are named after the report number.",
+        "",
+    ]
+    for i, r in enumerate(reports, start=1):
+        out.append(
+            f"{i}. {r['employee_name']}, {r['location']}, {r['departure_date']} to {r['return_date']}, "
+            f"total ${float(r['total_spend']):,.2f}, reimbursement due ${float(r['reimbursement_due']):,.2f}"
+        )
+    out += [
+        "",
+        f"Total spend ${sum(float(r['total_spend']) for r in reports):,.2f}, "
+        f"reimbursement due ${sum(float(r['reimbursement_due']) for r in reports):,.2f}",
+        "",
+        "Best regards,",
+        "Performa Expense Reports",
+    ]
+    return "\n".join(out) + "\n"
@@ -1,38 +1,115 @@
-from sendgrid import SendGridAPIClient
-from sendgrid.helpers.mail import Mail, Email, To, Cc, Attachment, FileContent, FileName, FileType, Disposition
-import base64
+from typing import List, Dict, Any, Optional, Tuple
+
 import streamlit as st
 
+from mail_transport import MailTransport, get_transport
+
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+
+def mail_transport() -> MailTransport:
+    """Process-wide transport configured from st.secrets, see mail_transport."""
+    return get_transport(st.secrets)
+
 
 def send_email(subject, body, attachment_bytes, attachment_filename, employee_email):
     try:
-        message = Mail(
-            from_email=Email(st.secrets["SENDER_EMAIL"]),
-            to_emails=To(st.secrets["FINANCE_EMAIL"]),
-            subject=subject,
-            html_content=body
+        message = build_report_message(
+            subject,
+            body,
+            employee_email,
+            [{"filename": attachment_filename, "content_bytes": attachment_bytes, "mime_type": XLSX_MIME}],
         )
+        return mail_transport().send(message)
 
-        # Add CC recipients
-        message.add_cc(Cc(st.secrets["APPROVER_EMAIL"]))
-        message.add_cc(Cc(employee_email))
+    except Exception as e:
+        return str(e)
 
-        # Attach file
-        encoded_file = base64.b64encode(attachment_bytes).decode()
 
-        attachment = Attachment(
-            FileContent(encoded_file),
-            FileName(attachment_filename),
-            FileType("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"),
-            Disposition("attachment")
-        )
+# -----------------------------
+# Report email
+# -----------------------------
+Recipients = Tuple[List[str], List[str]]
 
-        message.attachment = attachment
 
-        sg = SendGridAPIClient(st.secrets["SENDGRID_API_KEY"])
-        response = sg.send(message)
+def report_recipients(employee_email: str) -> Recipients:
+    to = [st.secrets["FINANCE_EMAIL"]]
+    # CC approver and employee (employee is dynamic from the form)
+    cc = [st.secrets["APPROVER_EMAIL"], employee_email]
+    return to, cc
 
-        return response.status_code
 
-    except Exception as e:
-        return str(e)
+def employee_recipients(employee_email: str) -> Recipients:
+    """The employee's own copy, when Finance gets the report in the digest."""
+    return [employee_email], []
+
+
+def finance_recipients() -> Recipients:
+    return [st.secrets["FINANCE_EMAIL"]], [st.secrets["APPROVER_EMAIL"]]
+
+
+def build_report_message(
+    subject: str,
+    html_body: str,
+    employee_email: str,
+    attachments: List[Dict[str, Any]],
+    text_body: Optional[str] = None,
+    recipients: Optional[Recipients] = None,
+) -> Dict[str, Any]:
+    to, cc = recipients or report_recipients(employee_email)
+    return {
+        "sender": st.secrets["SENDER_EMAIL"],
+        "to": to,
+        "cc": cc,
+        "subject": subject,
+        "html_body": html_body,
+        "text_body": text_body,
+        "attachments": attachments,
+    }
+
+
+def send_email_with_attachments(
+    subject: str,
+    html_body: str,
+    employee_email: str,
+    attachments: List[Dict[str, Any]],
+    text_body: Optional[str] = None,
+    recipients: Optional[Recipients] = None,
+) -> int:
+    """
+    attachments = [{ "filename": str, "content_bytes": bytes, "mime_type": str }]
+    "path": str may replace "content_bytes" to stream the file from disk.
+    text_body, when given, is sent as the plain text alternative.
+    recipients, (to, cc), replaces Finance, the approver and the employee.
+
+    Goes out through the shared transport picked by MAIL_TRANSPORT in
+    secrets: "sendgrid" (default), "smtp" or "file" (local Maildir sink,
+    also chosen when only MAIL_SINK_DIR is set).
+    """
+    return mail_transport().send(
+        build_report_message(subject, html_body, employee_email, attachments, text_body, recipients)
+    )
+
+
+def send_finance_digest(
+    subject: str,
+    html_body: str,
+    attachments: List[Dict[str, Any]],
+    text_body: Optional[str] = None,
+) -> int:
+    """A digest of many reports, to Finance and the approver only."""
+    message = build_report_message(subject, html_body, "", attachments, text_body, finance_recipients())
+    return mail_transport().send(message)
+
+
+def send_reports_bulk(reports: List[Dict[str, Any]]) -> List[int]:
+    """
+    Send many reports over one transport connection.
+    reports = [{ "subject", "html_body", "employee_email", "attachments", "text_body" (optional) }]
+    """
+    messages = [
+        build_report_message(r["subject"], r["html_body"], r["employee_email"], r["attachments"], r.get("text_body"))
+        for r in reports
+    ]
+    return mail_transport().send_many(messages)
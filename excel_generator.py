@@ -1,10 +1,30 @@
 from io import BytesIO
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple, Union
 
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.utils import get_column_letter
 from openpyxl.styles import Font, Alignment, PatternFill
 
+from fx_rates import BASE_CURRENCY, original_amount
+
+CURRENCY_FORMAT = '"$"#,##0.00'
+ORIGINAL_AMOUNT_FORMAT = "#,##0.00"
+FX_RATE_FORMAT = "0.0000##"
+MAX_COL_WIDTH = 60
+# Amount is in the base currency, the next three columns show what was entered
+LINE_ITEM_HEADERS = [
+    "Category",
+    "Expense Date",
+    "Description",
+    "Paid By",
+    "Amount",
+    "Currency",
+    "Original Amount",
+    "FX Rate",
+    "Receipt Attached",
+]
+
 
 def _auto_width(ws):
     for col in ws.columns:
@@ -16,18 +36,37 @@ def _auto_width(ws):
                 max_len = max(max_len, len(v))
             except Exception:
                 pass
-        ws.column_dimensions[col_letter].width = min(max_len + 2, 60)
+        ws.column_dimensions[col_letter].width = min(max_len + 2, MAX_COL_WIDTH)
 
 
-def generate_excel(trip_info: Dict[str, Any], expenses: List[Dict[str, Any]]) -> bytes:
+def generate_excel(
+    trip_info: Dict[str, Any],
+    expenses: List[Dict[str, Any]],
+    engine: str = "standard",
+    template_path: Optional[str] = None,
+) -> bytes:
     """
     Expected inputs:
       trip_info: dict built in app.py
       expenses: list of dicts with keys:
-        category, expense_date, paid_by, description, amount, receipt_file (optional)
+        category, expense_date, paid_by, description, amount, receipt_file (optional),
+        and currency, original_amount, fx_rate for lines converted by fx_rates.apply_fx
+      engine: "standard" builds an in-memory workbook, "streaming" uses
+        write-only worksheets (same output, much faster for large reports),
+        "template" fills a cached template workbook (see excel_templates)
+      template_path: template for the "template" engine, defaults to
+        templates/expense_report_template.xlsx
     Returns:
       Excel file as raw bytes
     """
+    if engine == "streaming":
+        return generate_excel_streaming(trip_info, expenses)
+    if engine == "template":
+        from excel_templates import DEFAULT_TEMPLATE, render_template
+
+        return render_template(trip_info, expenses, template_path or DEFAULT_TEMPLATE)
+    if engine != "standard":
+        raise ValueError(f"Unknown Excel engine: {engine}")
 
     wb = Workbook()
 
@@ -78,7 +117,7 @@ def generate_excel(trip_info: Dict[str, Any], expenses: List[Dict[str, Any]]) ->
 
     # Format currency fields
     for cell in ["B11", "B12", "B14", "B15", "B16", "B17"]:
-        ws[cell].number_format = '"$"#,##0.00'
+        ws[cell].number_format = CURRENCY_FORMAT
 
     ws["B6"].alignment = Alignment(wrap_text=True)
     ws.row_dimensions[6].height = 45
@@ -90,7 +129,7 @@ def generate_excel(trip_info: Dict[str, Any], expenses: List[Dict[str, Any]]) ->
     # -------------------------
     ws2 = wb.create_sheet("Line Items")
 
-    headers = ["Category", "Expense Date", "Description", "Paid By", "Amount", "Receipt Attached"]
+    headers = LINE_ITEM_HEADERS
     ws2.append(headers)
 
     for c in range(1, len(headers) + 1):
@@ -99,18 +138,13 @@ def generate_excel(trip_info: Dict[str, Any], expenses: List[Dict[str, Any]]) ->
         cell.fill = header_fill
 
     for e in expenses or []:
-        category = e.get("category", "")
-        expense_date = e.get("expense_date", "")
-        description = e.get("description", "")
-        paid_by = e.get("paid_by", "")
-        amount = float(e.get("amount", 0) or 0)
-        receipt_attached = "Yes" if e.get("receipt_file") else "No"
-
-        ws2.append([category, expense_date, description, paid_by, amount, receipt_attached])
+        ws2.append(_line_item_row(e))
 
     # Currency format for Amount column
     for row in range(2, ws2.max_row + 1):
-        ws2.cell(row=row, column=5).number_format = '"$"#,##0.00'
+        ws2.cell(row=row, column=5).number_format = CURRENCY_FORMAT
+        ws2.cell(row=row, column=7).number_format = ORIGINAL_AMOUNT_FORMAT
+        ws2.cell(row=row, column=8).number_format = FX_RATE_FORMAT
         ws2.cell(row=row, column=3).alignment = Alignment(wrap_text=True)
 
     _auto_width(ws2)
@@ -121,3 +155,277 @@ def generate_excel(trip_info: Dict[str, Any], expenses: List[Dict[str, Any]]) ->
     bio = BytesIO()
     wb.save(bio)
     return bio.getvalue()
+
+
+# -------------------------
+# Streaming (write-only) engine
+# -------------------------
+# Summary layout: (row, label, trip_info key, is_currency). Rows left out are blank.
+_SUMMARY_FIELDS = [
+    (3, "Employee Name", "employee_name", False),
+    (4, "Employee Email", "employee_email", False),
+    (5, "Trip Location", "location", False),
+    (6, "Business Purpose", "purpose", False),
+    (7, "Departure Date", "departure_date", False),
+    (8, "Return Date", "return_date", False),
+    (9, "Trip Days", "trip_days", False),
+    (11, "Per Diem Rate", "per_diem_rate", True),
+    (12, "Per Diem Total", "per_diem_total", True),
+    (14, "Total Spend", "total_spend", True),
+    (15, "Company Paid", "company_paid", True),
+    (16, "Employee Paid", "employee_paid", True),
+    (17, "Reimbursement Due", "reimbursement_due", True),
+]
+
+Report = Tuple[Dict[str, Any], Iterable[Dict[str, Any]]]
+
+
+def _text_len(v) -> int:
+    return 0 if v is None else len(str(v))
+
+
+def _summary_values(trip_info: Dict[str, Any]) -> Dict[int, Any]:
+    values = {}
+    for row, _label, key, is_currency in _SUMMARY_FIELDS:
+        if is_currency:
+            values[row] = float(trip_info.get(key, 0) or 0)
+        elif key == "trip_days":
+            values[row] = trip_info.get(key, 0)
+        else:
+            values[row] = trip_info.get(key, "")
+    return values
+
+
+def _write_summary_sheet(wb: Workbook, title: str, trip_info: Dict[str, Any]) -> None:
+    ws = wb.create_sheet(title)
+    values = _summary_values(trip_info)
+
+    # Column widths must be known before the first row is written
+    width_a = max(_text_len("Performa Expense Report"), *(_text_len(f[1]) for f in _SUMMARY_FIELDS))
+    width_b = max(_text_len(v) for v in values.values())
+    ws.column_dimensions["A"].width = min(width_a + 2, MAX_COL_WIDTH)
+    ws.column_dimensions["B"].width = min(width_b + 2, MAX_COL_WIDTH)
+    ws.row_dimensions[6].height = 45
+
+    title_cell = WriteOnlyCell(ws, value="Performa Expense Report")
+    title_cell.font = Font(bold=True, size=16)
+    title_cell.alignment = Alignment(horizontal="left")
+    ws.append([title_cell])
+    ws.append([])
+
+    labels = {row: label for row, label, _key, _cur in _SUMMARY_FIELDS}
+    currency_rows = {row for row, _label, _key, is_currency in _SUMMARY_FIELDS if is_currency}
+    bold = Font(bold=True)
+    for r in range(3, 18):
+        label = WriteOnlyCell(ws, value=labels.get(r))
+        label.font = bold
+        if r not in values:
+            ws.append([label])
+            continue
+        value = WriteOnlyCell(ws, value=values[r])
+        if r in currency_rows:
+            value.number_format = CURRENCY_FORMAT
+        if r == 6:
+            value.alignment = Alignment(wrap_text=True)
+        ws.append([label, value])
+
+
+def _line_item_row(e: Dict[str, Any]) -> list:
+    return [
+        e.get("category", ""),
+        e.get("expense_date", ""),
+        e.get("description", ""),
+        e.get("paid_by", ""),
+        float(e.get("amount", 0) or 0),
+        e.get("currency") or BASE_CURRENCY,
+        original_amount(e),
+        float(e.get("fx_rate") or 1.0),
+        "Yes" if e.get("receipt_file") else "No",
+    ]
+
+
+def _write_line_items_sheet(wb: Workbook, title: str, expenses: Iterable[Dict[str, Any]]) -> None:
+    ws = wb.create_sheet(title)
+
+    # One pass over the expenses builds the plain row values and the column
+    # widths together. Write-only sheets need widths before any row goes out.
+    widths = [len(h) for h in LINE_ITEM_HEADERS]
+    rows = []
+    for e in expenses or []:
+        row = _line_item_row(e)
+        for c, v in enumerate(row):
+            n = _text_len(v)
+            if n > widths[c]:
+                widths[c] = n
+        rows.append(row)
+    for c, w in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(c)].width = min(w + 2, MAX_COL_WIDTH)
+
+    header_fill = PatternFill("solid", fgColor="EEEEEE")
+    bold = Font(bold=True)
+    header = []
+    for h in LINE_ITEM_HEADERS:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.font = bold
+        cell.fill = header_fill
+        header.append(cell)
+    ws.append(header)
+
+    # Styled cells are reused: each row is serialized as soon as it is
+    # appended, so only the value changes and the style is looked up once.
+    desc_cell = WriteOnlyCell(ws)
+    desc_cell.alignment = Alignment(wrap_text=True)
+    amount_cell = WriteOnlyCell(ws)
+    amount_cell.number_format = CURRENCY_FORMAT
+    original_cell = WriteOnlyCell(ws)
+    original_cell.number_format = ORIGINAL_AMOUNT_FORMAT
+    rate_cell = WriteOnlyCell(ws)
+    rate_cell.number_format = FX_RATE_FORMAT
+    for row in rows:
+        desc_cell.value = row[2]
+        amount_cell.value = row[4]
+        original_cell.value = row[6]
+        rate_cell.value = row[7]
+        row[2] = desc_cell
+        row[4] = amount_cell
+        row[6] = original_cell
+        row[7] = rate_cell
+        ws.append(row)
+
+
+def _save_bytes(wb: Workbook) -> bytes:
+    bio = BytesIO()
+    wb.save(bio)
+    return bio.getvalue()
+
+
+def generate_excel_streaming(trip_info: Dict[str, Any], expenses: Iterable[Dict[str, Any]]) -> bytes:
+    """
+    Same workbook as generate_excel, built with write-only worksheets.
+    Rows are streamed to the sheet as they are produced, no cell objects
+    are kept around, and the cells are never walked a second time.
+    """
+    wb = Workbook(write_only=True)
+    _write_summary_sheet(wb, "Summary", trip_info)
+    _write_line_items_sheet(wb, "Line Items", expenses)
+    return _save_bytes(wb)
+
+
+def _batch_sheet_title(idx: int, trip_info: Dict[str, Any], suffix: str) -> str:
+    name = "".join(ch for ch in str(trip_info.get("employee_name", "")) if ch not in "[]:*?/\\")
+    prefix = f"{idx} "
+    room = 31 - len(prefix) - len(suffix) - 1
+    name = name[:room].strip()
+    return f"{prefix}{name} {suffix}" if name else f"{prefix}{suffix}"
+
+
+# Rollup layout: (header, trip_info key, is_currency), "line_items" is the line count
+_ROLLUP_FIELDS = [
+    ("Employee Name", "employee_name", False),
+    ("Employee Email", "employee_email", False),
+    ("Trip Location", "location", False),
+    ("Departure Date", "departure_date", False),
+    ("Return Date", "return_date", False),
+    ("Trip Days", "trip_days", False),
+    ("Line Items", "line_items", False),
+    ("Per Diem Total", "per_diem_total", True),
+    ("Total Spend", "total_spend", True),
+    ("Company Paid", "company_paid", True),
+    ("Employee Paid", "employee_paid", True),
+    ("Reimbursement Due", "reimbursement_due", True),
+]
+
+
+def _write_rollup_sheet(wb: Workbook, reports: List[Report]) -> None:
+    """One row per report, numbered like the report sheets, and a total row."""
+    ws = wb.create_sheet("Rollup")
+    rows = []
+    totals = [0.0] * len(_ROLLUP_FIELDS)
+    for idx, (trip_info, expenses) in enumerate(reports, start=1):
+        row = [idx]
+        for c, (_header, key, is_currency) in enumerate(_ROLLUP_FIELDS):
+            if key == "line_items":
+                value = len(expenses)
+            elif is_currency:
+                value = float(trip_info.get(key, 0) or 0)
+            else:
+                value = trip_info.get(key, "")
+            if is_currency or key == "line_items":
+                totals[c] += value
+            row.append(value)
+        rows.append(row)
+
+    headers = ["#"] + [h for h, _key, _cur in _ROLLUP_FIELDS]
+    widths = [len(h) for h in headers]
+    for row in rows:
+        for c, v in enumerate(row):
+            widths[c] = max(widths[c], _text_len(v))
+    for c, w in enumerate(widths, start=1):
+        ws.column_dimensions[get_column_letter(c)].width = min(w + 2, MAX_COL_WIDTH)
+
+    header_fill = PatternFill("solid", fgColor="EEEEEE")
+    bold = Font(bold=True)
+    header = []
+    for h in headers:
+        cell = WriteOnlyCell(ws, value=h)
+        cell.font = bold
+        cell.fill = header_fill
+        header.append(cell)
+    ws.append(header)
+
+    currency_cols = [c + 1 for c, (_h, _key, is_currency) in enumerate(_ROLLUP_FIELDS) if is_currency]
+    for row in rows:
+        for c in currency_cols:
+            cell = WriteOnlyCell(ws, value=row[c])
+            cell.number_format = CURRENCY_FORMAT
+            row[c] = cell
+        ws.append(row)
+
+    total_row: List[Any] = [WriteOnlyCell(ws, value="Total")] + [None] * len(_ROLLUP_FIELDS)
+    total_row[0].font = bold
+    for c, (_h, key, is_currency) in enumerate(_ROLLUP_FIELDS, start=1):
+        if is_currency or key == "line_items":
+            cell = WriteOnlyCell(ws, value=totals[c - 1])
+            cell.font = bold
+            if is_currency:
+                cell.number_format = CURRENCY_FORMAT
+            total_row[c] = cell
+    ws.append(total_row)
+
+
+def generate_excel_batch(
+    reports: Iterable[Report],
+    single_workbook: bool = True,
+    output=None,
+    rollup: bool = False,
+) -> Union[bytes, None, Iterator[bytes]]:
+    """
+    Render many reports with the streaming engine.
+
+    reports: iterable of (trip_info, expenses) pairs, consumed lazily
+    single_workbook:
+      True, all reports go into one workbook, a Summary and a Line Items
+        sheet per report. If output (path or binary file object) is given the
+        workbook is saved there and None is returned, otherwise bytes.
+      False, returns a generator yielding one workbook (bytes) per report.
+    rollup: with single_workbook, a first sheet with one row of totals per
+      report and a grand total. The reports are read into memory for it.
+
+    Memory stays flat either way: write-only sheets spool rows to temporary
+    files, and only one report's rows are held at a time.
+    """
+    if not single_workbook:
+        return (generate_excel_streaming(t, e) for t, e in reports)
+
+    wb = Workbook(write_only=True)
+    if rollup:
+        reports = [(t, list(e or [])) for t, e in reports]
+        _write_rollup_sheet(wb, reports)
+    for idx, (trip_info, expenses) in enumerate(reports, start=1):
+        _write_summary_sheet(wb, _batch_sheet_title(idx, trip_info, "Summary"), trip_info)
+        _write_line_items_sheet(wb, _batch_sheet_title(idx, trip_info, "Items"), expenses)
+
+    if output is not None:
+        wb.save(output)
+        return None
+    return _save_bytes(wb)
@@ -0,0 +1,263 @@
+import os
+import re
+import threading
+from copy import copy
+from io import BytesIO
+from typing import List, Dict, Any, Optional, Tuple
+
+from openpyxl import Workbook, load_workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles.cell_style import StyleArray
+
+from fx_rates import BASE_CURRENCY, original_amount
+
+
+TEMPLATES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+DEFAULT_TEMPLATE = os.path.join(TEMPLATES_DIR, "expense_report_template.xlsx")
+
+# Placeholders look like {{employee_name}}. A cell holding only a placeholder
+# receives the raw value (numbers and dates stay typed), otherwise the value
+# is substituted into the surrounding text.
+_PLACEHOLDER = re.compile(r"\{\{\s*(\w+)\s*\}\}")
+
+LINE_ITEM_FIELDS = [
+    "category",
+    "expense_date",
+    "description",
+    "paid_by",
+    "amount",
+    "currency",
+    "original_amount",
+    "fx_rate",
+    "receipt_attached",
+]
+CURRENCY_FIELDS = {
+    "per_diem_rate",
+    "per_diem_total",
+    "total_spend",
+    "company_paid",
+    "employee_paid",
+    "reimbursement_due",
+    "amount",
+}
+
+_STYLE_ATTRS = ("font", "fill", "border", "alignment", "number_format", "protection")
+
+
+# -------------------------
+# Parsed template cache
+# -------------------------
+class _ParsedTemplate:
+    __slots__ = ("styles", "sheets")
+
+    def __init__(self):
+        # Distinct cell styles, each a tuple of style objects in _STYLE_ATTRS order
+        self.styles: List[tuple] = []
+        self.sheets: List["_ParsedSheet"] = []
+
+
+class _ParsedSheet:
+    __slots__ = ("title", "col_widths", "row_heights", "merged", "head", "item_row", "tail")
+
+    def __init__(self, title: str):
+        self.title = title
+        self.col_widths: Dict[str, float] = {}
+        self.row_heights: Dict[int, float] = {}
+        self.merged: List[str] = []
+        # Each row is a list of (value, style index) per column, index may be None
+        self.head: List[list] = []
+        self.item_row: Optional[list] = None
+        self.tail: List[list] = []
+
+
+_cache: Dict[Tuple[str, float], _ParsedTemplate] = {}
+_cache_lock = threading.Lock()
+
+
+def _parse_template(path: str) -> _ParsedTemplate:
+    wb = load_workbook(path)
+    template = _ParsedTemplate()
+    style_ids: Dict[tuple, int] = {}
+
+    def style_index(cell) -> Optional[int]:
+        if not cell.has_style:
+            return None
+        style = tuple(copy(getattr(cell, attr)) for attr in _STYLE_ATTRS)
+        idx = style_ids.get(style)
+        if idx is None:
+            idx = style_ids[style] = len(template.styles)
+            template.styles.append(style)
+        return idx
+
+    for ws in wb.worksheets:
+        parsed = _ParsedSheet(ws.title)
+        for key, dim in ws.column_dimensions.items():
+            if dim.width:
+                parsed.col_widths[key] = dim.width
+        for idx, dim in ws.row_dimensions.items():
+            if dim.height:
+                parsed.row_heights[idx] = dim.height
+        parsed.merged = [str(r) for r in ws.merged_cells.ranges]
+
+        for row in ws.iter_rows():
+            cells = [(c.value, style_index(c)) for c in row]
+            is_item_row = any(
+                isinstance(v, str) and any(m in LINE_ITEM_FIELDS for m in _PLACEHOLDER.findall(v))
+                for v, _s in cells
+            )
+            if is_item_row and parsed.item_row is None:
+                parsed.item_row = cells
+            elif parsed.item_row is None:
+                parsed.head.append(cells)
+            else:
+                parsed.tail.append(cells)
+        template.sheets.append(parsed)
+    return template
+
+
+def load_template(path: str = DEFAULT_TEMPLATE) -> _ParsedTemplate:
+    """
+    Parse a template workbook, cached process-wide by (path, mtime).
+    Editing the template file invalidates the cache on the next render.
+    """
+    path = os.path.abspath(path)
+    key = (path, os.stat(path).st_mtime)
+    parsed = _cache.get(key)
+    if parsed is not None:
+        return parsed
+    with _cache_lock:
+        parsed = _cache.get(key)
+        if parsed is None:
+            parsed = _parse_template(path)
+            for stale in [k for k in _cache if k[0] == path]:
+                del _cache[stale]
+            _cache[key] = parsed
+    return parsed
+
+
+def preload_templates(paths: Optional[List[str]] = None) -> None:
+    for path in paths or [DEFAULT_TEMPLATE]:
+        if os.path.exists(path):
+            load_template(path)
+
+
+# -------------------------
+# Rendering
+# -------------------------
+def _field_value(data: Dict[str, Any], key: str):
+    if key in CURRENCY_FIELDS:
+        return float(data.get(key, 0) or 0)
+    if key == "trip_days":
+        return data.get(key, 0)
+    return data.get(key, "")
+
+
+def _fill(value, data: Dict[str, Any]):
+    if not isinstance(value, str) or "{{" not in value:
+        return value
+    m = _PLACEHOLDER.fullmatch(value.strip())
+    if m:
+        return _field_value(data, m.group(1))
+    return _PLACEHOLDER.sub(lambda mm: str(_field_value(data, mm.group(1))), value)
+
+
+class _StyleResolver:
+    """
+    Registers each distinct template style with the output workbook once.
+    Cells then get a copy of the resolved style array, skipping the per-cell
+    font/fill/format lookups openpyxl does on attribute assignment.
+    """
+
+    def __init__(self, styles: List[tuple]):
+        self.ws = None
+        self.styles = styles
+        self.arrays: Dict[int, StyleArray] = {}
+        self.defaults: Optional[tuple] = None
+
+    def cell(self, value, style_idx: Optional[int]) -> WriteOnlyCell:
+        cell = WriteOnlyCell(self.ws, value=value)
+        if style_idx is not None:
+            arr = self.arrays.get(style_idx)
+            if arr is None:
+                if self.defaults is None:
+                    blank = WriteOnlyCell(self.ws)
+                    self.defaults = tuple(getattr(blank, attr) for attr in _STYLE_ATTRS)
+                for attr, v, default in zip(_STYLE_ATTRS, self.styles[style_idx], self.defaults):
+                    if v != default:
+                        setattr(cell, attr, v)
+                arr = self.arrays[style_idx] = StyleArray(cell._style)
+            else:
+                cell._style = StyleArray(arr)
+        return cell
+
+
+def _emit_static(resolver: _StyleResolver, rows: List[list], data: Dict[str, Any]) -> None:
+    for cells in rows:
+        resolver.ws.append(
+            [None if v is None and s is None else resolver.cell(_fill(v, data), s) for v, s in cells]
+        )
+
+
+def _line_item_data(e: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "category": e.get("category", ""),
+        "expense_date": e.get("expense_date", ""),
+        "description": e.get("description", ""),
+        "paid_by": e.get("paid_by", ""),
+        "amount": float(e.get("amount", 0) or 0),
+        "currency": e.get("currency") or BASE_CURRENCY,
+        "original_amount": original_amount(e),
+        "fx_rate": float(e.get("fx_rate") or 1.0),
+        "receipt_attached": "Yes" if e.get("receipt_file") else "No",
+    }
+
+
+def render_template(
+    trip_info: Dict[str, Any],
+    expenses: List[Dict[str, Any]],
+    template_path: str = DEFAULT_TEMPLATE,
+) -> bytes:
+    """
+    Fill a cached template with one report and return the workbook bytes.
+    Only the data cells are computed per report, layout and styles come
+    from the parsed template.
+    """
+    template = load_template(template_path)
+    wb = Workbook(write_only=True)
+    resolver = _StyleResolver(template.styles)
+    for sheet in template.sheets:
+        ws = resolver.ws = wb.create_sheet(sheet.title)
+        for key, width in sheet.col_widths.items():
+            ws.column_dimensions[key].width = width
+
+        n_items = len(expenses or []) if sheet.item_row is not None else 0
+        first_item = len(sheet.head) + 1
+        for idx, height in sheet.row_heights.items():
+            # Rows after the line item block shift down by the number of items
+            if sheet.item_row is not None and idx > first_item:
+                idx += n_items - 1
+            ws.row_dimensions[idx].height = height
+        for ref in sheet.merged:
+            ws.merged_cells.add(ref)
+
+        _emit_static(resolver, sheet.head, trip_info)
+        if sheet.item_row is not None:
+            # One styled cell per column, reused for every line item
+            proto = [resolver.cell(None, s) if s is not None else None for _v, s in sheet.item_row]
+            data = dict(trip_info)
+            for e in expenses or []:
+                data.update(_line_item_data(e))
+                row = []
+                for (v, _s), cell in zip(sheet.item_row, proto):
+                    value = _fill(v, data)
+                    if cell is None:
+                        row.append(value)
+                    else:
+                        cell.value = value
+                        row.append(cell)
+                ws.append(row)
+        _emit_static(resolver, sheet.tail, trip_info)
+
+    bio = BytesIO()
+    wb.save(bio)
+    return bio.getvalue()
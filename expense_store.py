@@ -0,0 +1,193 @@
+from array import array
+from typing import List, Dict, Any, Iterator, Optional
+
+
+def receipt_size(uploaded_file) -> int:
+    """
+    Size of a receipt in bytes without copying its contents.
+    Streamlit's UploadedFile carries .size, anything else falls back to len().
+    """
+    if uploaded_file is None:
+        return 0
+    size = getattr(uploaded_file, "size", None)
+    if size is not None:
+        return int(size)
+    return len(uploaded_file.getvalue())
+
+
+class ExpenseStore:
+    """
+    List of expense dicts with columnar side arrays and running totals.
+
+    Iterates, indexes and pops like the plain list it replaces in
+    st.session_state, so existing code that walks expense dicts keeps
+    working. Amounts, paid_by flags and receipt sizes are kept in arrays and
+    the totals are updated on every append/pop, which makes the Summary
+    metrics and the attachment size check O(1) per rerun.
+    """
+
+    __slots__ = (
+        "_items",
+        "_amounts",
+        "_company_paid",
+        "_receipt_sizes",
+        "_total_spend",
+        "_company_total",
+        "_receipt_bytes",
+        "_by_category",
+        "_by_payer",
+        "version",
+        "_memo",
+        "__weakref__",
+    )
+
+    def __init__(self, expenses: Optional[List[Dict[str, Any]]] = None):
+        self._items: List[Dict[str, Any]] = []
+        self._amounts = array("d")
+        self._company_paid = array("b")
+        self._receipt_sizes = array("q")
+        self._total_spend = 0.0
+        self._company_total = 0.0
+        self._receipt_bytes = 0
+        self._by_category: Dict[str, float] = {}
+        self._by_payer: Dict[str, float] = {}
+        # Bumped on every change, lets callers cache anything derived
+        self.version = 0
+        self._memo: Dict[str, Any] = {}
+        for e in expenses or []:
+            self.append(e)
+
+    # -------------------------
+    # List protocol
+    # -------------------------
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        return iter(self._items)
+
+    def __getitem__(self, idx):
+        return self._items[idx]
+
+    def __bool__(self) -> bool:
+        return bool(self._items)
+
+    def append(self, expense: Dict[str, Any]) -> None:
+        amt = float(expense.get("amount") or 0)
+        is_company = expense.get("paid_by") == "Performa"
+        size = receipt_size(expense.get("receipt_file"))
+
+        self._items.append(expense)
+        self._amounts.append(amt)
+        self._company_paid.append(1 if is_company else 0)
+        self._receipt_sizes.append(size)
+
+        self._total_spend += amt
+        if is_company:
+            self._company_total += amt
+        self._receipt_bytes += size
+        self._bump(self._by_category, str(expense.get("category", "")), amt)
+        self._bump(self._by_payer, str(expense.get("paid_by", "")), amt)
+        self.version += 1
+
+    def pop(self, idx: int = -1) -> Dict[str, Any]:
+        expense = self._items.pop(idx)
+        amt = self._amounts.pop(idx)
+        is_company = self._company_paid.pop(idx)
+        size = self._receipt_sizes.pop(idx)
+
+        self._total_spend -= amt
+        if is_company:
+            self._company_total -= amt
+        self._receipt_bytes -= size
+        self._bump(self._by_category, str(expense.get("category", "")), -amt)
+        self._bump(self._by_payer, str(expense.get("paid_by", "")), -amt)
+        if not self._items:
+            # Drop accumulated float error once the report is empty again
+            self._total_spend = 0.0
+            self._company_total = 0.0
+        self.version += 1
+        return expense
+
+    def pop_many(self, indices) -> List[Dict[str, Any]]:
+        """Remove several lines at once. Returns them in their original order."""
+        removed = [self.pop(i) for i in sorted(set(indices), reverse=True)]
+        removed.reverse()
+        return removed
+
+    def replace(self, idx: int, expense: Dict[str, Any]) -> None:
+        """Swap in an edited line, keeping its position."""
+        old = self._items[idx]
+        amt = float(expense.get("amount") or 0)
+        is_company = expense.get("paid_by") == "Performa"
+        size = receipt_size(expense.get("receipt_file"))
+
+        self._total_spend += amt - self._amounts[idx]
+        self._company_total += (amt if is_company else 0.0) - (self._amounts[idx] if self._company_paid[idx] else 0.0)
+        self._receipt_bytes += size - self._receipt_sizes[idx]
+        self._bump(self._by_category, str(old.get("category", "")), -self._amounts[idx])
+        self._bump(self._by_payer, str(old.get("paid_by", "")), -self._amounts[idx])
+        self._bump(self._by_category, str(expense.get("category", "")), amt)
+        self._bump(self._by_payer, str(expense.get("paid_by", "")), amt)
+
+        self._items[idx] = expense
+        self._amounts[idx] = amt
+        self._company_paid[idx] = 1 if is_company else 0
+        self._receipt_sizes[idx] = size
+        self.version += 1
+
+    def clear(self) -> None:
+        """Remove every line. version moves on, so nothing keyed by it is reused."""
+        self._items = []
+        self._amounts = array("d")
+        self._company_paid = array("b")
+        self._receipt_sizes = array("q")
+        self._total_spend = 0.0
+        self._company_total = 0.0
+        self._receipt_bytes = 0
+        self._by_category = {}
+        self._by_payer = {}
+        self.version += 1
+
+    @staticmethod
+    def _bump(totals: Dict[str, float], key: str, amt: float) -> None:
+        total = totals.get(key, 0.0) + amt
+        if abs(total) < 1e-9:
+            totals.pop(key, None)
+        else:
+            totals[key] = total
+
+    def cached(self, key: str, compute):
+        """
+        compute() memoized until the next change to the list, for anything
+        derived from the line items that a rerun would otherwise rebuild.
+        """
+        hit = self._memo.get(key)
+        if hit is not None and hit[0] == self.version:
+            return hit[1]
+        value = compute()
+        self._memo[key] = (self.version, value)
+        return value
+
+    # -------------------------
+    # Aggregates
+    # -------------------------
+    def totals(self) -> Dict[str, float]:
+        return {
+            "total_spend": self._total_spend,
+            "company_paid": self._company_total,
+            "employee_paid": self._total_spend - self._company_total,
+        }
+
+    @property
+    def receipt_bytes(self) -> int:
+        return self._receipt_bytes
+
+    def receipt_sizes(self) -> List[int]:
+        return list(self._receipt_sizes)
+
+    def by_category(self) -> Dict[str, float]:
+        return dict(self._by_category)
+
+    def by_payer(self) -> Dict[str, float]:
+        return dict(self._by_payer)
@@ -0,0 +1,410 @@
+"""
+Finance digest: submitted reports collected on disk and sent to Finance
+and the approver as one email with one workbook, instead of an email per
+report. The employee's own copy still goes out at submit.
+
+add() spools a report and its receipts and returns straight away. A
+flusher thread sends a digest once the oldest waiting report is
+interval_s old, max_reports are waiting or the waiting receipts reach
+max_bytes. Each digest takes the oldest reports whose receipts fit in
+max_bytes, so one email stays under the attachment limit. A report that
+is over the limit on its own is sent alone, split into numbered parts.
+
+The workbook holds a Rollup sheet and a Summary and a Line Items sheet per
+report, see excel_generator.generate_excel_batch. A failed send is retried
+after retry_s and the reports stay spooled until a digest with them goes
+out, across restarts too. When a split digest fails part way, only the
+reports with receipts in the parts that did not go out are retried.
+
+Failed sends are counted per report. A report that failed
+SOLO_AFTER_ATTEMPTS times is retried in a digest of its own, so one bad
+report, say an unreadable receipt, cannot hold back the others. After
+max_attempts failures it is moved to <spool_dir>/dead and logged, and the
+digest carries on with the rest. A report.json that cannot be read at
+startup goes there straight away.
+
+Spool layout, one folder per report:
+  <spool_dir>/<added_at>_<id>/report.json   trip_info and line items
+  <spool_dir>/<added_at>_<id>/att_000.bin   receipts, in order
+  <spool_dir>/<added_at>_<id>/attempts      failed sends so far, once there is one
+  <spool_dir>/dead/<added_at>_<id>/         reports given up on
+"""
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from datetime import date, datetime
+from typing import List, Dict, Any, Callable, Optional
+
+import metrics
+from attachments import XLSX_MIME
+from email_templates import render_digest_html, render_digest_text
+from email_utils import send_finance_digest
+from excel_generator import generate_excel_batch
+from mail_transport import iter_attachment_bytes
+from submit_pipeline import split_parts
+
+log = logging.getLogger(__name__)
+
+DigestSender = Callable[..., int]
+
+DEAD_DIR = "dead"
+# Failed sends after which a report is only retried in a digest of its own
+SOLO_AFTER_ATTEMPTS = 2
+
+DATE_FIELDS = ("departure_date", "return_date", "expense_date")
+EXPENSE_FIELDS = (
+    "category",
+    "expense_date",
+    "description",
+    "paid_by",
+    "amount",
+    "currency",
+    "original_amount",
+    "fx_rate",
+)
+
+
+def _to_json(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+def _from_json(record: Dict[str, Any]) -> Dict[str, Any]:
+    for key in DATE_FIELDS:
+        value = record.get(key)
+        if isinstance(value, str) and len(value) == 10:
+            try:
+                record[key] = date.fromisoformat(value)
+            except ValueError:
+                pass
+    return record
+
+
+class FinanceDigest:
+    """Reports waiting for the next Finance digest, spooled to disk. See the module docstring."""
+
+    def __init__(
+        self,
+        spool_dir: str,
+        sender: Optional[DigestSender] = None,
+        interval_s: float = 3600.0,
+        max_reports: int = 50,
+        max_bytes: Optional[int] = None,
+        retry_s: float = 300.0,
+        max_attempts: int = 5,
+    ):
+        self.spool_dir = spool_dir
+        self.sender = sender or send_finance_digest
+        self.interval_s = interval_s
+        self.max_reports = max(1, max_reports)
+        self.max_bytes = max_bytes
+        self.retry_s = retry_s
+        self.max_attempts = max(1, max_attempts)
+        self.dead_dir = os.path.join(spool_dir, DEAD_DIR)
+
+        # Waiting reports, oldest first: { "dir", "added_at", "bytes", "attempts" }
+        self._entries: List[Dict[str, Any]] = []
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._retry_at = 0.0
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self._recover()
+
+        self._thread = threading.Thread(target=self._flusher, name="finance-digest", daemon=True)
+        self._thread.start()
+
+    # -------------------------
+    # Public API
+    # -------------------------
+    def add(self, trip_info: Dict[str, Any], expenses, attachments: List[Dict[str, Any]]) -> str:
+        """
+        Spools a report for the next digest. attachments are its receipts,
+        the digest builds its own workbook. Returns the report's spool id.
+        """
+        added_at = time.time()
+        report_id = f"{added_at:017.6f}_{uuid.uuid4().hex[:8]}"
+        entry_dir = os.path.join(self.spool_dir, report_id)
+        tmp_dir = entry_dir + ".tmp"
+        os.makedirs(tmp_dir)
+
+        nbytes = 0
+        att_meta = []
+        for n, a in enumerate(attachments):
+            with open(os.path.join(tmp_dir, f"att_{n:03d}.bin"), "wb") as fh:
+                for chunk in iter_attachment_bytes(a):
+                    fh.write(chunk)
+                    nbytes += len(chunk)
+            att_meta.append({"filename": a["filename"], "mime_type": a["mime_type"]})
+
+        lines = []
+        for e in expenses:
+            line = {k: _to_json(e.get(k)) for k in EXPENSE_FIELDS}
+            # The receipt itself is spooled above, the sheet only needs to know there is one
+            receipt = e.get("receipt_file")
+            line["receipt_file"] = (getattr(receipt, "name", None) or "receipt") if receipt else None
+            lines.append(line)
+        report = {
+            "added_at": added_at,
+            "trip_info": {k: _to_json(v) for k, v in trip_info.items()},
+            "expenses": lines,
+            "attachments": att_meta,
+            "bytes": nbytes,
+        }
+        with open(os.path.join(tmp_dir, "report.json"), "w", encoding="utf-8") as fh:
+            json.dump(report, fh)
+        # The rename makes the report visible to recovery only once complete
+        os.replace(tmp_dir, entry_dir)
+
+        with self._cond:
+            self._entries.append({"dir": entry_dir, "added_at": added_at, "bytes": nbytes, "attempts": 0})
+            self._cond.notify()
+        metrics.incr("digest_reports_total")
+        return report_id
+
+    def pending(self) -> Dict[str, Any]:
+        """Reports waiting for the next digest, their receipt bytes and the age of the oldest."""
+        with self._cond:
+            entries = list(self._entries)
+        return {
+            "reports": len(entries),
+            "bytes": sum(e["bytes"] for e in entries),
+            "oldest_age_s": time.time() - entries[0]["added_at"] if entries else 0.0,
+        }
+
+    def flush(self) -> List[int]:
+        """
+        Sends every waiting report now. Returns the status code of each
+        email sent, raises RuntimeError if a digest could not be sent.
+        """
+        statuses = []
+        while True:
+            batch = self._take(force=True)
+            if not batch:
+                return statuses
+            statuses.extend(self._send(batch))
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if wait:
+            self._thread.join()
+
+    # -------------------------
+    # Internals
+    # -------------------------
+    def _recover(self) -> None:
+        for name in sorted(os.listdir(self.spool_dir)):
+            path = os.path.join(self.spool_dir, name)
+            if name == DEAD_DIR:
+                continue
+            if name.endswith(".tmp"):
+                # Interrupted add(), never visible to a digest
+                shutil.rmtree(path, ignore_errors=True)
+                continue
+            try:
+                with open(os.path.join(path, "report.json"), encoding="utf-8") as fh:
+                    report = json.load(fh)
+                entry = {"dir": path, "added_at": float(report["added_at"]), "bytes": int(report["bytes"])}
+            except (OSError, ValueError, KeyError, TypeError) as ex:
+                self._dead_letter(path, f"unreadable report.json: {ex}")
+                continue
+            entry["attempts"] = self._read_attempts(path)
+            self._entries.append(entry)
+
+    def _read_attempts(self, path: str) -> int:
+        try:
+            with open(os.path.join(path, "attempts"), encoding="utf-8") as fh:
+                return int(fh.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _failed(self, entry: Dict[str, Any], error: str) -> bool:
+        """Counts a failed send of a report. True if it was moved to the dead folder."""
+        entry["attempts"] += 1
+        if entry["attempts"] >= self.max_attempts:
+            self._dead_letter(entry["dir"], f"{entry['attempts']} failed sends, last: {error}")
+            return True
+        try:
+            with open(os.path.join(entry["dir"], "attempts"), "w", encoding="utf-8") as fh:
+                fh.write(str(entry["attempts"]))
+        except OSError:
+            pass
+        return False
+
+    def _dead_letter(self, path: str, reason: str) -> None:
+        os.makedirs(self.dead_dir, exist_ok=True)
+        try:
+            os.replace(path, os.path.join(self.dead_dir, os.path.basename(path)))
+        except OSError as ex:
+            log.error("Finance digest report %s could not be moved to %s: %s", path, self.dead_dir, ex)
+        log.error("Finance digest gave up on report %s, %s", os.path.basename(path), reason)
+        metrics.incr("digest_reports_dead_total")
+
+    def _due_at(self) -> Optional[float]:
+        """When the waiting reports are due, None if there are none. Caller holds the lock."""
+        if not self._entries:
+            return None
+        if len(self._entries) >= self.max_reports:
+            due = 0.0
+        elif self.max_bytes is not None and sum(e["bytes"] for e in self._entries) >= self.max_bytes:
+            due = 0.0
+        else:
+            due = self._entries[0]["added_at"] + self.interval_s
+        return max(due, self._retry_at)
+
+    def _take(self, force: bool = False) -> List[Dict[str, Any]]:
+        """
+        The oldest reports that fit in one digest, removed from the waiting
+        list. Without force only when they are due. Caller does not hold the lock.
+        """
+        with self._cond:
+            if not self._entries:
+                return []
+            if not force:
+                due = self._due_at()
+                if due is None or due > time.time():
+                    return []
+            batch = [self._entries[0]]
+            if batch[0]["attempts"] >= SOLO_AFTER_ATTEMPTS:
+                del self._entries[0]
+                return batch
+            nbytes = batch[0]["bytes"]
+            for e in self._entries[1 : self.max_reports]:
+                if e["attempts"] >= SOLO_AFTER_ATTEMPTS:
+                    break
+                if self.max_bytes is not None and nbytes + e["bytes"] > self.max_bytes:
+                    break
+                batch.append(e)
+                nbytes += e["bytes"]
+            del self._entries[: len(batch)]
+            return batch
+
+    def _load(self, entry: Dict[str, Any]) -> Dict[str, Any]:
+        with open(os.path.join(entry["dir"], "report.json"), encoding="utf-8") as fh:
+            report = json.load(fh)
+        _from_json(report["trip_info"])
+        for e in report["expenses"]:
+            _from_json(e)
+        return report
+
+    def _package(self, batch: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """The digest email for a batch: subject, bodies, workbook and receipts."""
+        reports = [self._load(entry) for entry in batch]
+        trips = [r["trip_info"] for r in reports]
+        with metrics.span("digest.excel"):
+            workbook = generate_excel_batch(((r["trip_info"], r["expenses"]) for r in reports), rollup=True)
+
+        first = datetime.fromtimestamp(batch[0]["added_at"])
+        last = datetime.fromtimestamp(batch[-1]["added_at"])
+        attachments = [
+            {
+                "filename": f"Expense_Digest_{last:%Y-%m-%d_%H%M}.xlsx",
+                "content_bytes": workbook,
+                "mime_type": XLSX_MIME,
+            }
+        ]
+        # id() of each receipt -> position of its report in the batch
+        owners: Dict[int, int] = {}
+        for idx, (entry, report) in enumerate(zip(batch, reports), start=1):
+            for n, meta in enumerate(report["attachments"]):
+                attachment = {
+                    "filename": f"R{idx:02d}_{meta['filename']}",
+                    "path": os.path.join(entry["dir"], f"att_{n:03d}.bin"),
+                    "mime_type": meta["mime_type"],
+                }
+                attachments.append(attachment)
+                owners[id(attachment)] = idx - 1
+        return {
+            "subject": (
+                f"Expense Report Digest, {len(reports)} report(s), "
+                f"submitted {first:%Y-%m-%d %H:%M} to {last:%Y-%m-%d %H:%M}"
+            ),
+            "html_body": render_digest_html(trips),
+            "text_body": render_digest_text(trips),
+            "attachments": attachments,
+            "owners": owners,
+        }
+
+    def _send(self, batch: List[Dict[str, Any]]) -> List[int]:
+        statuses: List[int] = []
+        parts: List[Dict[str, Any]] = []
+        owners: Dict[int, int] = {}
+        sent = 0
+        error = None
+        try:
+            with metrics.span("digest.flush"):
+                package = self._package(batch)
+                owners = package["owners"]
+                parts = [package]
+                total = sum(e["bytes"] for e in batch) + len(package["attachments"][0]["content_bytes"])
+                if self.max_bytes is not None and total > self.max_bytes:
+                    # A report over the limit on its own, or the workbook tipped it over
+                    for a in package["attachments"][1:]:
+                        with open(a.pop("path"), "rb") as fh:
+                            a["content_bytes"] = fh.read()
+                    parts = split_parts(package, "Performa Expense Reports", self.max_bytes)
+                for part in parts:
+                    status = int(
+                        self.sender(
+                            part["subject"], part["html_body"], part["attachments"], text_body=part["text_body"]
+                        )
+                    )
+                    statuses.append(status)
+                    if not 200 <= status < 300:
+                        error = f"Mail backend returned status code: {status}"
+                        break
+                    sent += 1
+        except Exception as ex:
+            error = str(ex) or type(ex).__name__
+
+        if sent:
+            # Part 1 with the workbook is out, a report is delivered once
+            # none of its receipts is in a part that did not go out
+            undelivered = {owners[id(a)] for part in parts[sent:] for a in part["attachments"] if id(a) in owners}
+        else:
+            undelivered = set(range(len(batch)))
+        delivered = [e for i, e in enumerate(batch) if i not in undelivered]
+        for entry in delivered:
+            shutil.rmtree(entry["dir"], ignore_errors=True)
+        if delivered:
+            metrics.incr("digest_reports_sent_total", len(delivered))
+        if error is None:
+            metrics.incr("digests_total", result="sent")
+            return statuses
+
+        # Only the reports with parts still to go back to the front of the
+        # line, tried again after retry_s. Delivered ones are not sent twice,
+        # the ones out of attempts are moved out of the way
+        metrics.incr("digests_total", result="failed")
+        retry = [e for i, e in enumerate(batch) if i in undelivered and not self._failed(e, error)]
+        if retry:
+            with self._cond:
+                self._entries[:0] = retry
+                self._retry_at = time.time() + self.retry_s
+        raise RuntimeError(f"Finance digest not sent: {error}")
+
+    def _flusher(self) -> None:
+        while True:
+            with self._cond:
+                while not self._stopped:
+                    due = self._due_at()
+                    delay = None if due is None else due - time.time()
+                    if delay is not None and delay <= 0:
+                        break
+                    self._cond.wait(timeout=delay)
+                if self._stopped:
+                    return
+            try:
+                while True:
+                    batch = self._take()
+                    if not batch:
+                        break
+                    self._send(batch)
+            except RuntimeError as ex:
+                # The reports are back in the spool for the retry
+                log.warning("%s, retrying in %.0fs", ex, self.retry_s)
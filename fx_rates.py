@@ -0,0 +1,162 @@
+"""
+Offline FX rate tables.
+
+Rates come from a local CSV file with one rate per currency and day:
+
+  date,currency,rate
+  2024-03-01,EUR,1.0832
+  2024-03-01,GBP,1.2631
+
+rate is the value of one unit of the currency in the base currency (USD).
+A day without a rate (weekends, holidays) uses the latest earlier rate,
+up to max_age_days back.
+"""
+import csv
+import os
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import date
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+BASE_CURRENCY = "USD"
+DEFAULT_MAX_AGE_DAYS = 7
+
+
+class FxError(ValueError):
+    """No usable rate for a currency on a date."""
+
+
+def _as_date(value) -> date:
+    if isinstance(value, date):
+        return value
+    return date.fromisoformat(str(value)[:10])
+
+
+class FxRates:
+    """
+    Rate table indexed by currency, each holding day ordinals and rates in
+    parallel sorted arrays. rate() is LRU cached by (currency, date), and
+    convert() converts a whole report in one call.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Tuple[str, Any, float]] = (),
+        max_age_days: int = DEFAULT_MAX_AGE_DAYS,
+        cache_size: int = 4096,
+    ):
+        self.max_age_days = max_age_days
+        by_currency: Dict[str, Dict[int, float]] = {}
+        for currency, day, rate in rows:
+            by_currency.setdefault(currency.strip().upper(), {})[_as_date(day).toordinal()] = float(rate)
+
+        self._days: Dict[str, array] = {}
+        self._rates: Dict[str, array] = {}
+        for currency, series in by_currency.items():
+            days = sorted(series)
+            self._days[currency] = array("l", days)
+            self._rates[currency] = array("d", (series[d] for d in days))
+
+        self.rate = lru_cache(maxsize=cache_size)(self._rate)
+
+    @classmethod
+    def from_csv(cls, path: str, max_age_days: int = DEFAULT_MAX_AGE_DAYS) -> "FxRates":
+        with open(path, newline="", encoding="utf-8") as fh:
+            rows = [(r["currency"], r["date"], r["rate"]) for r in csv.DictReader(fh) if r.get("currency")]
+        return cls(rows, max_age_days=max_age_days)
+
+    def currencies(self) -> List[str]:
+        """Base currency first, then the table's currencies in order."""
+        return [BASE_CURRENCY] + sorted(c for c in self._days if c != BASE_CURRENCY)
+
+    def _rate(self, currency: str, on: date) -> float:
+        if currency == BASE_CURRENCY:
+            return 1.0
+        days = self._days.get(currency)
+        if days is None:
+            raise FxError(f"No exchange rates for {currency}")
+        day = on.toordinal()
+        i = bisect_right(days, day) - 1
+        if i < 0 or day - days[i] > self.max_age_days:
+            raise FxError(f"No {currency} rate within {self.max_age_days} days before {on.isoformat()}")
+        return self._rates[currency][i]
+
+    def convert(self, amounts: Iterable[float], currencies: Iterable[str], dates: Iterable[Any]) -> Tuple[array, array]:
+        """
+        Base currency amounts and the rates used, for parallel sequences of
+        amounts, currency codes and dates. Each distinct (currency, date)
+        is looked up once per call.
+        """
+        amounts = array("d", (float(a or 0) for a in amounts))
+        rates = array("d", bytes(8 * len(amounts)))
+        seen: Dict[Tuple[str, Any], float] = {}
+        for i, (currency, day) in enumerate(zip(currencies, dates)):
+            key = ((currency or BASE_CURRENCY).upper(), day)
+            rate = seen.get(key)
+            if rate is None:
+                rate = seen[key] = self.rate(key[0], _as_date(day))
+            rates[i] = rate
+        return array("d", (round(a * r, 2) for a, r in zip(amounts, rates))), rates
+
+
+# Empty table, only the base currency converts
+NO_RATES = FxRates()
+
+_cache: Dict[Tuple[str, float], FxRates] = {}
+_cache_lock = threading.Lock()
+
+
+def load_rates(path: Optional[str], max_age_days: int = DEFAULT_MAX_AGE_DAYS) -> FxRates:
+    """
+    Rate table from a CSV file, cached process-wide by (path, mtime) so a
+    replaced file is picked up on the next call. A missing file gives an
+    empty table.
+    """
+    if not path or not os.path.exists(path):
+        return NO_RATES
+    path = os.path.abspath(path)
+    key = (path, os.stat(path).st_mtime)
+    rates = _cache.get(key)
+    if rates is not None and rates.max_age_days == max_age_days:
+        return rates
+    with _cache_lock:
+        rates = _cache.get(key)
+        if rates is None or rates.max_age_days != max_age_days:
+            rates = FxRates.from_csv(path, max_age_days=max_age_days)
+            for stale in [k for k in _cache if k[0] == path]:
+                del _cache[stale]
+            _cache[key] = rates
+    return rates
+
+
+def original_amount(e: Dict[str, Any]) -> float:
+    """Amount as entered, in the line's own currency."""
+    value = e.get("original_amount")
+    return float(e.get("amount") or 0) if value is None else float(value)
+
+
+def apply_fx(expenses: List[Dict[str, Any]], rates: FxRates) -> None:
+    """
+    Convert every line to the base currency in one batch. Sets "amount"
+    (base currency) and "fx_rate", keeping the entered amount in
+    "original_amount" and its code in "currency". Raises FxError if a
+    rate is missing, leaving the lines untouched.
+    """
+    if not expenses:
+        return
+    converted, used = rates.convert(
+        [original_amount(e) for e in expenses],
+        [e.get("currency") or BASE_CURRENCY for e in expenses],
+        [e.get("expense_date") or date.today() for e in expenses],
+    )
+    for e, amount, rate in zip(expenses, converted, used):
+        e["original_amount"] = original_amount(e)
+        e["currency"] = (e.get("currency") or BASE_CURRENCY).upper()
+        e["amount"] = amount
+        e["fx_rate"] = rate
+
+
+def is_foreign(e: Dict[str, Any]) -> bool:
+    return (e.get("currency") or BASE_CURRENCY) != BASE_CURRENCY
@@ -0,0 +1,588 @@
+import base64
+import http.client
+import json
+import logging
+import os
+import queue
+import smtplib
+import ssl
+import threading
+import time
+import uuid
+from collections import deque
+from email.header import Header
+from email.utils import encode_rfc2231, formatdate, make_msgid
+from typing import List, Dict, Any, Callable, Iterator, Optional
+
+import metrics
+
+log = logging.getLogger(__name__)
+
+SENDGRID_HOST = "api.sendgrid.com"
+SENDGRID_PATH = "/v3/mail/send"
+
+# Raw bytes read per step. A multiple of 57 so every chunk encodes to whole
+# 76 character base64 lines, and of 3 so chunks concatenate without padding.
+CHUNK_SIZE = 57 * 1024
+
+
+# -----------------------------
+# Attachment sources
+# -----------------------------
+# An attachment is { "filename": str, "mime_type": str } plus either
+# "content_bytes" (bytes or a memoryview) or "path" (streamed from disk).
+def attachment_size(a: Dict[str, Any]) -> int:
+    if "content_bytes" in a:
+        return len(a["content_bytes"])
+    return os.path.getsize(a["path"])
+
+
+def iter_attachment_bytes(a: Dict[str, Any], chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    if "content_bytes" in a:
+        view = memoryview(a["content_bytes"])
+        for i in range(0, len(view), chunk_size):
+            yield view[i : i + chunk_size]
+        return
+    with open(a["path"], "rb") as fh:
+        while True:
+            chunk = fh.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+
+
+def iter_base64(a: Dict[str, Any], chunk_size: int = CHUNK_SIZE, line_sep: Optional[bytes] = None) -> Iterator[bytes]:
+    """
+    Base64 encode an attachment a chunk at a time. With line_sep set the
+    output is wrapped at 76 characters for MIME, otherwise it is one line.
+    Only one chunk of raw and encoded data is alive at a time.
+    """
+    encode_s = 0.0
+    for chunk in iter_attachment_bytes(a, chunk_size):
+        t0 = time.perf_counter()
+        if line_sep is None:
+            out = base64.b64encode(chunk)
+        else:
+            out = base64.encodebytes(chunk).replace(b"\n", line_sep)
+        encode_s += time.perf_counter() - t0
+        yield out
+    # Encoding is interleaved with the network writes, only its own time is counted
+    metrics.observe("mail.base64", encode_s)
+
+
+# -----------------------------
+# SendGrid, streamed JSON body
+# -----------------------------
+def iter_sendgrid_payload(
+    sender: str,
+    to: List[str],
+    cc: List[str],
+    subject: str,
+    html_body: str,
+    attachments: List[Dict[str, Any]],
+    text_body: Optional[str] = None,
+) -> Iterator[bytes]:
+    """
+    The /v3/mail/send JSON document, produced piece by piece so attachment
+    content is encoded while the request body is being sent.
+    """
+    content = []
+    if text_body is not None:
+        content.append({"type": "text/plain", "value": text_body})
+    content.append({"type": "text/html", "value": html_body})
+    personalization: Dict[str, Any] = {"to": [{"email": e} for e in to]}
+    if cc:
+        personalization["cc"] = [{"email": e} for e in cc]
+    head = {
+        "from": {"email": sender},
+        "subject": subject,
+        "personalizations": [personalization],
+        "content": content,
+    }
+    yield json.dumps(head)[:-1].encode("utf-8")
+    if not attachments:
+        yield b"}"
+        return
+    yield b', "attachments": ['
+    for n, a in enumerate(attachments):
+        if n:
+            yield b", "
+        yield b'{"content": "'
+        yield from iter_base64(a)
+        tail = {"filename": a["filename"], "type": a["mime_type"], "disposition": "attachment"}
+        yield b'", ' + json.dumps(tail)[1:].encode("utf-8")
+    yield b"]}"
+
+
+# -----------------------------
+# SMTP, streamed MIME message
+# -----------------------------
+def _header(value: str) -> str:
+    # Line breaks in a value would start a new header
+    value = " ".join(value.splitlines())
+    return Header(value, "utf-8").encode() if not value.isascii() else value
+
+
+def _filename_param(param: str, filename: str) -> str:
+    """A name or filename parameter, RFC 2231 encoded when not plain ASCII."""
+    filename = " ".join(filename.splitlines())
+    if filename.isascii():
+        return '%s="%s"' % (param, filename.replace("\\", "\\\\").replace('"', '\\"'))
+    return "%s*=%s" % (param, encode_rfc2231(filename, "utf-8"))
+
+
+def iter_mime_message(
+    sender: str,
+    to: List[str],
+    cc: List[str],
+    subject: str,
+    html_body: str,
+    attachments: List[Dict[str, Any]],
+    text_body: Optional[str] = None,
+) -> Iterator[bytes]:
+    """
+    multipart/mixed message with CRLF line endings, attachments encoded as
+    they are written. Base64 lines never start with a dot, so the output
+    can go straight into an SMTP DATA section.
+    """
+    crlf = b"\r\n"
+    boundary = f"==={uuid.uuid4().hex}==="
+    headers = [
+        f"From: {sender}",
+        f"To: {', '.join(to)}",
+        f"Subject: {_header(subject)}",
+        f"Date: {formatdate(localtime=True)}",
+        f"Message-ID: {make_msgid()}",
+        "MIME-Version: 1.0",
+        f'Content-Type: multipart/mixed; boundary="{boundary}"',
+    ]
+    if cc:
+        headers.insert(2, f"Cc: {', '.join(cc)}")
+    yield ("\r\n".join(headers) + "\r\n\r\n").encode("utf-8")
+
+    def text_part(subtype: str, body: str, bnd: str = boundary) -> bytes:
+        encoded = base64.encodebytes(body.encode("utf-8")).replace(b"\n", crlf)
+        return (
+            f"--{bnd}\r\n"
+            f"Content-Type: text/{subtype}; charset=utf-8\r\n"
+            "Content-Transfer-Encoding: base64\r\n\r\n"
+        ).encode("ascii") + encoded
+
+    if text_body is not None:
+        alt = f"==={uuid.uuid4().hex}==="
+        yield (
+            f"--{boundary}\r\nContent-Type: multipart/alternative; boundary=\"{alt}\"\r\n\r\n"
+        ).encode("ascii")
+        yield text_part("plain", text_body, alt)
+        yield text_part("html", html_body, alt)
+        yield f"--{alt}--\r\n".encode("ascii")
+    else:
+        yield text_part("html", html_body)
+
+    for a in attachments:
+        yield (
+            f"--{boundary}\r\n"
+            f'Content-Type: {a["mime_type"]}; {_filename_param("name", a["filename"])}\r\n'
+            "Content-Transfer-Encoding: base64\r\n"
+            f'Content-Disposition: attachment; {_filename_param("filename", a["filename"])}\r\n\r\n'
+        ).encode("utf-8")
+        yield from iter_base64(a, line_sep=crlf)
+    yield f"--{boundary}--\r\n".encode("ascii")
+
+
+def smtp_transmit(smtp: smtplib.SMTP, sender: str, recipients: List[str], message: Iterator[bytes]) -> int:
+    code, resp = smtp.mail(sender)
+    if code != 250:
+        raise smtplib.SMTPSenderRefused(code, resp, sender)
+    accepted = 0
+    for r in recipients:
+        code, _resp = smtp.rcpt(r)
+        if code in (250, 251):
+            accepted += 1
+    if not accepted:
+        raise smtplib.SMTPRecipientsRefused({r: (550, b"refused") for r in recipients})
+
+    # smtplib's data() wants the whole message, so drive DATA by hand
+    code, resp = smtp.docmd("data")
+    if code != 354:
+        raise smtplib.SMTPDataError(code, resp)
+    try:
+        for chunk in message:
+            smtp.send(chunk)
+        smtp.send(b".\r\n")
+        code, resp = smtp.getreply()
+    except BaseException:
+        # The server may still be reading the message, nothing can follow it
+        # on this connection
+        smtp.close()
+        raise
+    if code != 250:
+        raise smtplib.SMTPDataError(code, resp)
+    return code
+
+
+# -----------------------------
+# Transports
+# -----------------------------
+# A message is a dict:
+#   { "sender": str, "to": [str], "cc": [str], "subject": str,
+#     "html_body": str, "text_body": str (optional), "attachments": [...] }
+def message_recipients(message: Dict[str, Any]) -> List[str]:
+    return list(message["to"]) + list(message.get("cc") or [])
+
+
+class MailTransport:
+    """
+    Base class for mail backends. Subclasses implement _send(). send() and
+    send_many() wrap it with timing, the last LATENCY_WINDOW send latencies
+    are kept for latency_stats().
+    """
+
+    name = "base"
+    LATENCY_WINDOW = 1000
+
+    def __init__(self):
+        self._latencies = deque(maxlen=self.LATENCY_WINDOW)
+        # Guards the latencies and the sent and errors counts
+        self._lock = threading.Lock()
+        self.sent = 0
+        self.errors = 0
+
+    def send(self, message: Dict[str, Any]) -> int:
+        return self._timed(self._send, message)
+
+    def send_many(self, messages: List[Dict[str, Any]]) -> List[int]:
+        """Send a batch, over a single connection where the backend has one."""
+        return [self.send(m) for m in messages]
+
+    def close(self) -> None:
+        pass
+
+    def latency_stats(self) -> Dict[str, float]:
+        with self._lock:
+            values = sorted(self._latencies)
+            sent, errors = self.sent, self.errors
+        if not values:
+            return {"count": 0, "sent": sent, "errors": errors}
+
+        def pct(p: float) -> float:
+            return values[min(len(values) - 1, int(p * len(values)))]
+
+        return {
+            "count": len(values),
+            "sent": sent,
+            "errors": errors,
+            "mean_s": sum(values) / len(values),
+            "p50_s": pct(0.50),
+            "p95_s": pct(0.95),
+            "max_s": values[-1],
+        }
+
+    def _timed(self, fn: Callable, *args) -> int:
+        t0 = time.perf_counter()
+        try:
+            status = fn(*args)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            metrics.incr("mail_errors_total", transport=self.name)
+            raise
+        elapsed = time.perf_counter() - t0
+        with self._lock:
+            self._latencies.append(elapsed)
+            self.sent += 1
+        metrics.observe("mail.send", elapsed, transport=self.name)
+        metrics.incr("mail_sent_total", transport=self.name, status=status)
+        log.debug("mail sent via %s in %.3fs, status %s", self.name, elapsed, status)
+        return status
+
+    def _send(self, message: Dict[str, Any]) -> int:
+        raise NotImplementedError
+
+
+class SendGridTransport(MailTransport):
+    """
+    SendGrid v3 API over pooled keep-alive HTTPS connections. Request bodies
+    are streamed with chunked encoding. A send that fails on a reused
+    connection, typically one the server already closed, is retried once on
+    a fresh connection.
+    """
+
+    name = "sendgrid"
+
+    def __init__(self, api_key: str, pool_size: int = 4, timeout: float = 60.0, host: str = SENDGRID_HOST):
+        super().__init__()
+        self.api_key = api_key
+        self.host = host
+        self.timeout = timeout
+        self._pool: "queue.LifoQueue[http.client.HTTPSConnection]" = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self) -> http.client.HTTPSConnection:
+        return http.client.HTTPSConnection(self.host, timeout=self.timeout)
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, conn: http.client.HTTPSConnection) -> None:
+        try:
+            self._pool.put_nowait(conn)
+        except queue.Full:
+            conn.close()
+
+    def _post(self, conn: http.client.HTTPSConnection, message: Dict[str, Any]):
+        conn.request(
+            "POST",
+            SENDGRID_PATH,
+            body=iter_sendgrid_payload(
+                message["sender"],
+                message["to"],
+                message.get("cc") or [],
+                message["subject"],
+                message["html_body"],
+                message.get("attachments") or [],
+                text_body=message.get("text_body"),
+            ),
+            headers={
+                "Authorization": f"Bearer {self.api_key}",
+                "Content-Type": "application/json",
+                "User-Agent": "performa-expense-app",
+            },
+            encode_chunked=True,
+        )
+        resp = conn.getresponse()
+        # Drain the body so the connection can carry the next request
+        resp.read()
+        return resp
+
+    def _send(self, message: Dict[str, Any]) -> int:
+        conn, reused = self._acquire()
+        try:
+            resp = self._post(conn, message)
+        except (http.client.RemoteDisconnected, ConnectionError, BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            conn = self._connect()
+            try:
+                resp = self._post(conn, message)
+            except Exception:
+                conn.close()
+                raise
+        except Exception:
+            conn.close()
+            raise
+        if resp.will_close:
+            conn.close()
+        else:
+            self._release(conn)
+        return resp.status
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class SMTPTransport(MailTransport):
+    """
+    SMTP with pooled, logged-in connections. Messages stream into DATA.
+    Connections found dead on reuse are replaced once.
+    """
+
+    name = "smtp"
+
+    def __init__(
+        self,
+        host: str,
+        port: int = 587,
+        username: Optional[str] = None,
+        password: Optional[str] = None,
+        use_tls: bool = True,
+        pool_size: int = 2,
+        timeout: float = 60.0,
+    ):
+        super().__init__()
+        self.host = host
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.timeout = timeout
+        self._pool: "queue.LifoQueue[smtplib.SMTP]" = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self) -> smtplib.SMTP:
+        smtp = smtplib.SMTP(self.host, self.port, timeout=self.timeout)
+        smtp.ehlo()
+        if self.use_tls:
+            smtp.starttls(context=ssl.create_default_context())
+            smtp.ehlo()
+        if self.username:
+            smtp.login(self.username, self.password or "")
+        return smtp
+
+    def _acquire(self):
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._connect(), False
+
+    def _release(self, smtp: smtplib.SMTP) -> None:
+        try:
+            self._pool.put_nowait(smtp)
+        except queue.Full:
+            self._quit(smtp)
+
+    @staticmethod
+    def _quit(smtp: smtplib.SMTP) -> None:
+        try:
+            smtp.quit()
+        except Exception:
+            smtp.close()
+
+    @staticmethod
+    def _transmit(smtp: smtplib.SMTP, message: Dict[str, Any]) -> int:
+        return smtp_transmit(
+            smtp,
+            message["sender"],
+            message_recipients(message),
+            iter_mime_message(
+                message["sender"],
+                message["to"],
+                message.get("cc") or [],
+                message["subject"],
+                message["html_body"],
+                message.get("attachments") or [],
+                text_body=message.get("text_body"),
+            ),
+        )
+
+    def _send(self, message: Dict[str, Any]) -> int:
+        smtp, reused = self._acquire()
+        try:
+            status = self._transmit(smtp, message)
+        except smtplib.SMTPServerDisconnected:
+            smtp.close()
+            if not reused:
+                raise
+            smtp = self._connect()
+            try:
+                status = self._transmit(smtp, message)
+            except Exception:
+                smtp.close()
+                raise
+        except Exception:
+            if smtp.sock is None:
+                # Closed by smtp_transmit part way through DATA, not reusable
+                raise
+            # Failed before DATA, leave the session clean for the next message
+            try:
+                smtp.rset()
+            except Exception:
+                smtp.close()
+                raise
+            self._release(smtp)
+            raise
+        self._release(smtp)
+        return status
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._quit(self._pool.get_nowait())
+            except queue.Empty:
+                return
+
+
+class FileSinkTransport(MailTransport):
+    """
+    Local sink for testing and offline runs. Each message is written as a
+    complete .eml file into a Maildir layout (tmp/, new/, cur/) under
+    directory, so any mail client can open the output.
+    """
+
+    name = "file"
+
+    def __init__(self, directory: str):
+        super().__init__()
+        self.directory = directory
+        for sub in ("tmp", "new", "cur"):
+            os.makedirs(os.path.join(directory, sub), exist_ok=True)
+
+    def _send(self, message: Dict[str, Any]) -> int:
+        fname = f"{time.time():.6f}.{uuid.uuid4().hex[:12]}.eml"
+        tmp = os.path.join(self.directory, "tmp", fname)
+        with open(tmp, "wb") as fh:
+            for chunk in iter_mime_message(
+                message["sender"],
+                message["to"],
+                message.get("cc") or [],
+                message["subject"],
+                message["html_body"],
+                message.get("attachments") or [],
+                text_body=message.get("text_body"),
+            ):
+                fh.write(chunk)
+        os.replace(tmp, os.path.join(self.directory, "new", fname))
+        return 250
+
+
+# -----------------------------
+# Process-wide transport
+# -----------------------------
+_transports: Dict[tuple, MailTransport] = {}
+_transports_lock = threading.Lock()
+
+
+def build_transport(config: Dict[str, Any]) -> MailTransport:
+    kind = config.get("MAIL_TRANSPORT") or ("file" if config.get("MAIL_SINK_DIR") else "sendgrid")
+    if kind == "sendgrid":
+        return SendGridTransport(
+            config["SENDGRID_API_KEY"],
+            pool_size=int(config.get("MAIL_POOL_SIZE", 4)),
+        )
+    if kind == "smtp":
+        return SMTPTransport(
+            host=config["SMTP_HOST"],
+            port=int(config.get("SMTP_PORT", 587)),
+            username=config.get("SMTP_USERNAME"),
+            password=config.get("SMTP_PASSWORD"),
+            use_tls=bool(config.get("SMTP_STARTTLS", True)),
+            pool_size=int(config.get("MAIL_POOL_SIZE", 2)),
+        )
+    if kind == "file":
+        return FileSinkTransport(config.get("MAIL_SINK_DIR") or ".spool/mail_sink")
+    raise ValueError(f"Unknown MAIL_TRANSPORT: {kind}")
+
+
+_CONFIG_KEYS = (
+    "MAIL_TRANSPORT",
+    "MAIL_SINK_DIR",
+    "MAIL_POOL_SIZE",
+    "SENDGRID_API_KEY",
+    "SMTP_HOST",
+    "SMTP_PORT",
+    "SMTP_USERNAME",
+    "SMTP_PASSWORD",
+    "SMTP_STARTTLS",
+)
+
+
+def get_transport(config: Dict[str, Any]) -> MailTransport:
+    """
+    Shared transport for this process, one per distinct configuration, so
+    connections are reused across submits, sessions and worker threads.
+    """
+    values = {k: config.get(k) for k in _CONFIG_KEYS}
+    key = tuple(sorted((k, str(v)) for k, v in values.items()))
+    transport = _transports.get(key)
+    if transport is None:
+        with _transports_lock:
+            transport = _transports.get(key)
+            if transport is None:
+                transport = _transports[key] = build_transport(values)
+    return transport
@@ -0,0 +1,284 @@
+"""
+Memory governor: receipt bytes held by each browser session and in
+total, and admission control for submits.
+
+Sessions. Each rerun calls touch() with the session's ExpenseStore, which
+is held by weak reference, so a closed session drops out on its own.
+Receipts reach the ReceiptStore on disk when they are added, and the
+session holds a ReceiptRef that pins the blob. touch() counts those
+bytes per session. A sweep runs at most every sweep_s. While the receipts
+of all live sessions are over max_total_bytes, it evicts the longest idle
+sessions, idle for at least idle_s, whose line items are all saved as a
+draft. The sweep only marks a session evicted, it never changes another
+session's ExpenseStore. The session clears its own line items on its
+next touch(), in its own script thread, and touch() returns True so the
+app can point the user at the saved draft. Clearing unpins the receipts,
+so the ReceiptStore can evict them in turn. A session closed before it
+comes back releases them when its store is collected. Sessions already
+marked do not count towards max_total_bytes.
+
+Submits. A submit asks for a slot with request_submit(session_id,
+nbytes). nbytes is what the submit will hold in memory, see submit_cost.
+At most max_concurrent_submits run at once, admitted in arrival order. A submit also waits while the admitted ones already
+hold max_submit_bytes, unless it would run alone. The ticket reports its
+place in line for the UI.
+
+Levels are exported as gauges: memory_session_bytes, memory_sessions,
+submits{state=running|waiting}, submit_bytes and process_resident_bytes.
+"""
+import os
+import threading
+import time
+import weakref
+from collections import deque
+from typing import Dict, Any, Callable, Optional
+
+import metrics
+from expense_store import ExpenseStore
+
+# Copies of the receipts a submit holds at its peak: the bytes read from
+# the store, the optimized receipts and the encoded email payload
+SUBMIT_COPIES = 3
+# Workbook, email bodies and the rest of a submit, on top of the receipts
+SUBMIT_OVERHEAD_BYTES = 8 * 1024 * 1024
+
+
+def submit_cost(receipt_bytes: int) -> int:
+    """Bytes a submit of receipt_bytes of receipts is expected to hold at its peak."""
+    return receipt_bytes * SUBMIT_COPIES + SUBMIT_OVERHEAD_BYTES
+
+
+def process_resident_bytes() -> int:
+    """Resident set size of this process, the peak where the current one is not available."""
+    try:
+        with open("/proc/self/statm") as fh:
+            return int(fh.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        pass
+    try:
+        import resource
+
+        # KB on Linux, bytes on macOS
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss if os.uname().sysname == "Darwin" else rss * 1024
+    except (ImportError, OSError):
+        return 0
+
+
+class SubmitTicket:
+    """A submit's place in line, then its slot. Use as a context manager to always give it back."""
+
+    __slots__ = ("_governor", "session_id", "nbytes", "admitted", "released")
+
+    def __init__(self, governor: "MemoryGovernor", session_id: str, nbytes: int):
+        self._governor = governor
+        self.session_id = session_id
+        self.nbytes = nbytes
+        self.admitted = False
+        self.released = False
+
+    def position(self) -> int:
+        """1 for the next submit to run, 0 once admitted."""
+        return self._governor._position(self)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Blocks until admitted or timeout seconds pass. Returns whether it was admitted."""
+        return self._governor._wait(self, timeout)
+
+    def release(self) -> None:
+        self._governor._release(self)
+
+    def __enter__(self) -> "SubmitTicket":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+class MemoryGovernor:
+    """Session receipt accounting and submit admission. See the module docstring."""
+
+    def __init__(
+        self,
+        max_session_bytes: Optional[int] = None,
+        max_total_bytes: Optional[int] = None,
+        idle_s: float = 1800.0,
+        max_concurrent_submits: int = 2,
+        max_submit_bytes: Optional[int] = None,
+        can_evict: Optional[Callable[[str, int], bool]] = None,
+        sweep_s: float = 30.0,
+    ):
+        self.max_session_bytes = max_session_bytes
+        self.max_total_bytes = max_total_bytes
+        self.idle_s = idle_s
+        self.max_concurrent_submits = max(1, max_concurrent_submits)
+        self.max_submit_bytes = max_submit_bytes
+        # can_evict(owner, line_items), True when the owner's saved draft holds every line
+        self.can_evict = can_evict
+        self.sweep_s = sweep_s
+
+        self._lock = threading.Lock()
+        # session_id -> { "store": weakref, "owner", "seen", "bytes" }
+        self._sessions: Dict[str, Dict[str, Any]] = {}
+        self._evicted = set()
+        self._last_sweep = 0.0
+
+        self._cond = threading.Condition()
+        self._waiting: "deque[SubmitTicket]" = deque()
+        self._running = 0
+        self._submit_bytes = 0
+
+    # -------------------------
+    # Sessions
+    # -------------------------
+    def touch(self, session_id: str, store: ExpenseStore, owner: str = "") -> bool:
+        """
+        Records a rerun of a session and its line items. Once after the
+        sweep evicted the session, clears its line items and returns True.
+        Call it from the session's own script thread.
+        """
+        with self._lock:
+            evicted = session_id in self._evicted
+            self._evicted.discard(session_id)
+        if evicted:
+            store.clear()
+        now = time.monotonic()
+        with self._lock:
+            self._sessions[session_id] = {
+                "store": weakref.ref(store),
+                "owner": owner,
+                "seen": now,
+                "bytes": store.receipt_bytes,
+            }
+            sweep = now - self._last_sweep >= self.sweep_s
+            if sweep:
+                self._last_sweep = now
+        if sweep:
+            self.sweep()
+        else:
+            self._export()
+        return evicted
+
+    def fits_session(self, store: ExpenseStore, nbytes: int) -> bool:
+        """Whether a receipt of nbytes more stays within the per session limit."""
+        return self.max_session_bytes is None or store.receipt_bytes + nbytes <= self.max_session_bytes
+
+    def usage(self) -> Dict[str, int]:
+        """Receipt bytes of the live sessions and their count."""
+        with self._lock:
+            sessions = list(self._sessions.values())
+        return {"sessions": len(sessions), "bytes": sum(s["bytes"] for s in sessions)}
+
+    def sweep(self) -> None:
+        """Drops closed sessions and marks the idlest evicted while over max_total_bytes."""
+        now = time.monotonic()
+        idle = []
+        with self._lock:
+            for session_id, s in list(self._sessions.items()):
+                if s["store"]() is None:
+                    del self._sessions[session_id]
+                    self._evicted.discard(session_id)
+                elif session_id in self._evicted:
+                    continue
+                elif now - s["seen"] >= self.idle_s:
+                    idle.append((s["seen"], session_id, s))
+            # Marked sessions free their bytes when they come back or close
+            total = sum(s["bytes"] for sid, s in self._sessions.items() if sid not in self._evicted)
+        idle.sort(key=lambda r: r[0])
+
+        if self.max_total_bytes is not None:
+            for _seen, session_id, s in idle:
+                if total <= self.max_total_bytes:
+                    break
+                store = s["store"]()
+                held = s["bytes"]
+                if store is None or not held:
+                    continue
+                # Only reads the other session's store, its own thread clears it in touch()
+                if self.can_evict is None or not s["owner"] or not self.can_evict(s["owner"], len(store)):
+                    continue
+                with self._lock:
+                    if session_id not in self._sessions or self._sessions[session_id]["seen"] != s["seen"]:
+                        # Came back while being checked
+                        continue
+                    self._evicted.add(session_id)
+                total -= held
+                metrics.incr("sessions_evicted_total")
+                metrics.incr("session_bytes_evicted_total", held)
+        self._export()
+
+    # -------------------------
+    # Submit admission
+    # -------------------------
+    def request_submit(self, session_id: str, nbytes: int) -> SubmitTicket:
+        """A ticket in line for a submit slot, admitted straight away when one is free."""
+        ticket = SubmitTicket(self, session_id, nbytes)
+        with self._cond:
+            self._waiting.append(ticket)
+            self._admit_locked()
+        self._export()
+        return ticket
+
+    def _admit_locked(self) -> None:
+        # First come, first served: a large submit at the head is not overtaken
+        while self._waiting:
+            head = self._waiting[0]
+            if (
+                self._running
+                and self.max_submit_bytes is not None
+                and self._submit_bytes + head.nbytes > self.max_submit_bytes
+            ):
+                break
+            if self._running >= self.max_concurrent_submits:
+                break
+            self._waiting.popleft()
+            head.admitted = True
+            self._running += 1
+            self._submit_bytes += head.nbytes
+        self._cond.notify_all()
+
+    def _position(self, ticket: SubmitTicket) -> int:
+        with self._cond:
+            if ticket.admitted:
+                return 0
+            try:
+                return self._waiting.index(ticket) + 1
+            except ValueError:
+                return 0
+
+    def _wait(self, ticket: SubmitTicket, timeout: Optional[float]) -> bool:
+        with self._cond:
+            return self._cond.wait_for(lambda: ticket.admitted or ticket.released, timeout) and ticket.admitted
+
+    def _release(self, ticket: SubmitTicket) -> None:
+        with self._cond:
+            if ticket.released:
+                return
+            ticket.released = True
+            if ticket.admitted:
+                self._running -= 1
+                self._submit_bytes -= ticket.nbytes
+            else:
+                # Gave up waiting
+                self._waiting.remove(ticket)
+            self._admit_locked()
+        self._export()
+
+    def submits(self) -> Dict[str, int]:
+        with self._cond:
+            return {"running": self._running, "waiting": len(self._waiting), "bytes": self._submit_bytes}
+
+    # -------------------------
+    # Metrics
+    # -------------------------
+    def _export(self) -> None:
+        if not metrics.enabled():
+            return
+        usage = self.usage()
+        submits = self.submits()
+        metrics.gauge("memory_session_bytes", usage["bytes"])
+        metrics.gauge("memory_sessions", usage["sessions"])
+        metrics.gauge("submits", submits["running"], state="running")
+        metrics.gauge("submits", submits["waiting"], state="waiting")
+        metrics.gauge("submit_bytes", submits["bytes"])
+        metrics.gauge("process_resident_bytes", process_resident_bytes())
@@ -0,0 +1,307 @@
+"""
+Timing spans, counters and an optional sampling profiler for the app.
+
+  with metrics.span("submit.excel"):
+      ...
+  metrics.incr("attachment_bytes_total", n)
+
+Spans feed a latency histogram per name, counters are plain sums and
+gauges hold the last value set, all exported in Prometheus text format
+by write_prometheus(). With
+log_spans set each span is also logged as one JSON line.
+
+Everything is off until configure(enabled=True). Disabled, span() returns
+a shared no-op and incr()/observe() return at the first check, so the
+calls can stay in hot paths.
+"""
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Dict, Optional, Tuple
+
+log = logging.getLogger(__name__)
+
+# Latency histogram bucket bounds in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+PREFIX = "performa"
+
+_enabled = False
+_log_spans = False
+_prom_path: Optional[str] = None
+_flush_interval = 10.0
+_last_flush = 0.0
+
+_profile = False
+_profile_dir = ".spool/profiles"
+_profile_interval = 0.005
+
+_lock = threading.Lock()
+_LabelKey = Tuple[str, Tuple[Tuple[str, str], ...]]
+# (name, labels) -> [bucket counts..., +Inf count, sum]
+_histograms: Dict[_LabelKey, list] = {}
+_counters: Dict[_LabelKey, float] = {}
+_gauges: Dict[_LabelKey, float] = {}
+
+
+def configure(
+    enabled: bool = True,
+    prom_path: Optional[str] = None,
+    log_spans: bool = False,
+    flush_interval: float = 10.0,
+    profile: bool = False,
+    profile_dir: str = ".spool/profiles",
+    profile_interval: float = 0.005,
+) -> None:
+    global _enabled, _log_spans, _prom_path, _flush_interval, _profile, _profile_dir, _profile_interval
+    _enabled = enabled
+    _log_spans = log_spans
+    _prom_path = prom_path
+    _flush_interval = flush_interval
+    _profile = profile
+    _profile_dir = profile_dir
+    _profile_interval = profile_interval
+
+
+def enabled() -> bool:
+    return _enabled
+
+
+def _key(name: str, labels: Dict[str, object]) -> _LabelKey:
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+# -----------------------------
+# Recording
+# -----------------------------
+def observe(name: str, seconds: float, **labels) -> None:
+    """Record one duration in the named histogram."""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        h = _histograms.get(key)
+        if h is None:
+            h = _histograms[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                h[i] += 1
+                break
+        else:
+            h[len(BUCKETS)] += 1
+        h[-1] += seconds
+
+
+def incr(name: str, value: float = 1, **labels) -> None:
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def gauge(name: str, value: float, **labels) -> None:
+    """Set the named gauge, for levels such as bytes held right now."""
+    if not _enabled:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+class _Span:
+    __slots__ = ("name", "labels", "t0")
+
+    def __init__(self, name: str, labels: Dict[str, object]):
+        self.name = name
+        self.labels = labels
+        self.t0 = 0.0
+
+    def __enter__(self) -> "_Span":
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.stop(exc_type)
+
+    def stop(self, exc_type=None) -> float:
+        elapsed = time.perf_counter() - self.t0
+        observe(self.name, elapsed, **self.labels)
+        if _log_spans:
+            record = {"event": "span", "span": self.name, "ms": round(elapsed * 1000, 3), **self.labels}
+            if exc_type is not None:
+                record["error"] = exc_type.__name__
+            log.info(json.dumps(record, default=str))
+        return elapsed
+
+
+class _NoopSpan:
+    __slots__ = ()
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        return None
+
+    def stop(self, exc_type=None) -> float:
+        return 0.0
+
+
+_NOOP = _NoopSpan()
+
+
+def span(name: str, **labels):
+    """Context manager timing the block into the named histogram."""
+    if not _enabled:
+        return _NOOP
+    return _Span(name, labels)
+
+
+def timer(name: str, **labels):
+    """A span started now and ended by .stop(), for code that is not one block."""
+    s = span(name, **labels)
+    s.__enter__()
+    return s
+
+
+# -----------------------------
+# Export
+# -----------------------------
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(labels: Tuple[Tuple[str, str], ...], extra: str = "") -> str:
+    parts = [f'{k}="{_escape(v)}"' for k, v in labels]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def render_prometheus() -> str:
+    with _lock:
+        histograms = {k: list(v) for k, v in _histograms.items()}
+        counters = dict(_counters)
+        gauges = dict(_gauges)
+
+    out = []
+    if histograms:
+        out.append(f"# TYPE {PREFIX}_span_seconds histogram")
+    for (name, labels), h in sorted(histograms.items()):
+        labels = (("span", name),) + labels
+        cumulative = 0
+        for bound, count in zip(BUCKETS + ("+Inf",), h):
+            cumulative += count
+            le = 'le="%s"' % bound
+            out.append(f"{PREFIX}_span_seconds_bucket{_fmt_labels(labels, le)} {cumulative}")
+        out.append(f"{PREFIX}_span_seconds_sum{_fmt_labels(labels)} {h[-1]:.6f}")
+        out.append(f"{PREFIX}_span_seconds_count{_fmt_labels(labels)} {cumulative}")
+
+    seen = set()
+    for (name, labels), value in sorted(counters.items()):
+        if name not in seen:
+            out.append(f"# TYPE {PREFIX}_{name} counter")
+            seen.add(name)
+        out.append(f"{PREFIX}_{name}{_fmt_labels(labels)} {value:g}")
+
+    seen = set()
+    for (name, labels), value in sorted(gauges.items()):
+        if name not in seen:
+            out.append(f"# TYPE {PREFIX}_{name} gauge")
+            seen.add(name)
+        out.append(f"{PREFIX}_{name}{_fmt_labels(labels)} {value:g}")
+    return "\n".join(out) + "\n"
+
+
+def write_prometheus(path: Optional[str] = None) -> None:
+    """Write the text exposition atomically, for node_exporter's textfile collector."""
+    path = path or _prom_path
+    if not path:
+        return
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        fh.write(render_prometheus())
+    os.replace(tmp, path)
+
+
+def maybe_flush() -> None:
+    """write_prometheus() at most once per flush_interval."""
+    global _last_flush
+    if not _enabled or not _prom_path:
+        return
+    now = time.monotonic()
+    if now - _last_flush < _flush_interval:
+        return
+    _last_flush = now
+    try:
+        write_prometheus()
+    except OSError as ex:
+        log.warning("could not write metrics to %s: %s", _prom_path, ex)
+
+
+def reset() -> None:
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+
+
+# -----------------------------
+# Sampling profiler
+# -----------------------------
+class _Sampler:
+    """
+    Samples the calling thread's stack every interval from a helper thread
+    and writes the counts as collapsed stacks, one "a;b;c count" line per
+    stack, ready for flamegraph.pl or speedscope.
+    """
+
+    def __init__(self, name: str, interval: float, directory: str):
+        self.name = name
+        self.interval = interval
+        self.directory = directory
+        self.target = threading.get_ident()
+        self.stacks: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=f"profiler-{name}", daemon=True)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def __enter__(self) -> "_Sampler":
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._stop.set()
+        self._thread.join()
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}.folded")
+            with open(path, "w", encoding="utf-8") as fh:
+                for stack, count in self.stacks.most_common():
+                    fh.write(f"{stack} {count}\n")
+            log.info(json.dumps({"event": "profile", "name": self.name, "samples": sum(self.stacks.values()), "path": path}))
+        except OSError as ex:
+            log.warning("could not write profile %s: %s", self.name, ex)
+
+
+def profile(name: str):
+    """Sample the block when profiling is configured on, otherwise a no-op."""
+    if not _profile:
+        return _NOOP
+    return _Sampler(name, _profile_interval, _profile_dir)
@@ -0,0 +1,312 @@
+"""
+Travel policy: per diem rates by location and date range, and spending
+caps by category, from a local CSV rule file:
+
+  kind,location,category,start_date,end_date,amount,per
+  per_diem,*,,,,100,day
+  per_diem,New York,,2024-01-01,2024-12-31,150,day
+  cap,*,Hotel,,,250,night
+  cap,New York,Hotel,,,400,night
+  cap,*,Rental Car,,,90,day
+  cap,*,Taxi or Uber to Airport,,,80,item
+
+Locations match case-insensitively, "*" covers every location without
+rows of its own. Blank dates leave a range open, and where ranges overlap
+the one that started last wins. A cap's per is "item" (each line on its
+own), "day" or "night" (the category total against the cap times the
+trip's days or nights) or "trip" (the category total).
+"""
+import csv
+import os
+import threading
+from array import array
+from bisect import bisect_right
+from datetime import date, timedelta
+from functools import lru_cache
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+
+from report_utils import calc_trip_days, trip_day_weights
+
+ANY_LOCATION = "*"
+PER_ITEM = "item"
+PER_DAY = "day"
+PER_NIGHT = "night"
+PER_TRIP = "trip"
+CAP_PERIODS = (PER_ITEM, PER_DAY, PER_NIGHT, PER_TRIP)
+
+_OPEN_START = date.min.toordinal()
+_OPEN_END = date.max.toordinal()
+# Amounts within half a cent of a cap are within it
+_TOLERANCE = 0.005
+
+
+class PolicyError(ValueError):
+    """A rule file row that cannot be used."""
+
+
+def _location_key(location: Optional[str]) -> str:
+    return (location or "").strip().casefold()
+
+
+def _ordinal(value, default: int) -> int:
+    if value in (None, ""):
+        return default
+    if isinstance(value, date):
+        return value.toordinal()
+    return date.fromisoformat(str(value)[:10]).toordinal()
+
+
+class _Ranges:
+    """Date ranged values of one rule, by start day, for bisect lookups."""
+
+    def __init__(self, rows: List[Tuple[int, int, Any]]):
+        rows.sort(key=lambda r: (r[0], r[1]))
+        self.starts = array("l", (r[0] for r in rows))
+        self.ends = array("l", (r[1] for r in rows))
+        self.values = [r[2] for r in rows]
+
+    def at(self, day: int):
+        # Latest start on or before the day whose range still covers it
+        i = bisect_right(self.starts, day) - 1
+        while i >= 0:
+            if self.ends[i] >= day:
+                return self.values[i]
+            i -= 1
+        return None
+
+
+class Policy:
+    """
+    A compiled rule file. Per diem rates and caps are indexed by location
+    and date, rate() and caps() are LRU cached by (location, date), and
+    audit() checks the caps of any number of reports in one vectorized
+    pass over all of their line items.
+    """
+
+    def __init__(
+        self,
+        rows: Iterable[Dict[str, Any]] = (),
+        default_rate: float = 0.0,
+        cache_size: int = 4096,
+    ):
+        self.default_rate = float(default_rate)
+        per_diem: Dict[str, List[tuple]] = {}
+        caps: Dict[Tuple[str, str], List[tuple]] = {}
+        for n, row in enumerate(rows, start=1):
+            kind = (row.get("kind") or "").strip().lower()
+            try:
+                span = (_ordinal(row.get("start_date"), _OPEN_START), _ordinal(row.get("end_date"), _OPEN_END))
+                amount = float(row["amount"])
+            except (KeyError, TypeError, ValueError) as ex:
+                raise PolicyError(f"Rule {n}: {ex}") from None
+            location = _location_key(row.get("location")) or ANY_LOCATION
+            if kind == "per_diem":
+                per_diem.setdefault(location, []).append(span + (amount,))
+            elif kind == "cap":
+                category = (row.get("category") or "").strip()
+                per = (row.get("per") or PER_ITEM).strip().lower()
+                if not category or per not in CAP_PERIODS:
+                    raise PolicyError(f"Rule {n}: a cap needs a category and per in {', '.join(CAP_PERIODS)}")
+                caps.setdefault((location, category), []).append(span + ((amount, per),))
+            else:
+                raise PolicyError(f"Rule {n}: unknown kind {kind!r}")
+
+        self._per_diem = {loc: _Ranges(r) for loc, r in per_diem.items()}
+        self._caps = {key: _Ranges(r) for key, r in caps.items()}
+        self.categories = sorted({category for _loc, category in caps})
+        self._codes = {category: k for k, category in enumerate(self.categories)}
+        self._cap_locations = {loc for loc, _category in caps}
+
+        self.rate = lru_cache(maxsize=cache_size)(self._rate)
+        self.caps = lru_cache(maxsize=cache_size)(self._caps_on)
+
+    @classmethod
+    def from_csv(cls, path: str, default_rate: float = 0.0) -> "Policy":
+        """Rules from a CSV file. A file that cannot be read or decoded raises PolicyError."""
+        try:
+            with open(path, newline="", encoding="utf-8") as fh:
+                rows = [r for r in csv.DictReader(fh) if r.get("kind")]
+        except UnicodeDecodeError as ex:
+            raise PolicyError(f"{path} is not UTF-8: {ex.reason} at byte {ex.start}") from None
+        except (OSError, csv.Error) as ex:
+            raise PolicyError(f"{path} could not be read: {ex}") from None
+        return cls(rows, default_rate=default_rate)
+
+    # -------------------------
+    # Per diem
+    # -------------------------
+    def _rate(self, location: str, on: date) -> float:
+        day = on.toordinal()
+        for loc in (location, ANY_LOCATION):
+            ranges = self._per_diem.get(loc)
+            rate = ranges.at(day) if ranges is not None else None
+            if rate is not None:
+                return rate
+        return self.default_rate
+
+    def per_diem(
+        self,
+        location: str,
+        departure: date,
+        ret: date,
+        partial_day_factor: float = 1.0,
+    ) -> Dict[str, float]:
+        """
+        { "trip_days", "per_diem_rate", "per_diem_total" } for a trip, each
+        day at the rate in effect for the location on that day. The rate
+        is the daily average when it changes during the trip.
+        """
+        loc = _location_key(location)
+        weights = trip_day_weights(departure, ret, partial_day_factor)
+        rates = [self.rate(loc, departure + timedelta(days=i)) for i in range(len(weights))]
+        total = round(sum(w * r for w, r in zip(weights, rates)), 2)
+        trip_days = calc_trip_days(departure, ret, partial_day_factor)
+        if rates and len(set(rates)) == 1:
+            rate = rates[0]
+        elif trip_days:
+            rate = round(total / trip_days, 2)
+        else:
+            rate = self.rate(loc, departure or date.today())
+        return {"trip_days": trip_days, "per_diem_rate": rate, "per_diem_total": total}
+
+    # -------------------------
+    # Caps
+    # -------------------------
+    def _caps_on(self, location: str, on: date) -> Tuple[Tuple[float, str], ...]:
+        """(amount, per) of every category in self.categories, (inf, item) where uncapped."""
+        loc = location if location in self._cap_locations else ANY_LOCATION
+        day = on.toordinal()
+        out = []
+        for category in self.categories:
+            cap = None
+            for key in ((loc, category), (ANY_LOCATION, category)):
+                ranges = self._caps.get(key)
+                cap = ranges.at(day) if ranges is not None else None
+                if cap is not None:
+                    break
+            out.append(cap or (float("inf"), PER_ITEM))
+        return tuple(out)
+
+    def check(self, trip_info: Dict[str, Any], expenses) -> List[Dict[str, Any]]:
+        """Cap violations of one report, see audit."""
+        return self.audit([(trip_info, expenses)])[0]
+
+    def audit(self, reports: Iterable[Tuple[Dict[str, Any], Iterable[Dict[str, Any]]]]) -> List[List[Dict[str, Any]]]:
+        """
+        Cap violations of every (trip_info, expenses) report, in report
+        order, each as { "line", "category", "amount", "cap", "per",
+        "message" }. line is the 1-based line of a per item violation and
+        None for a category total. Caps come from the trip's location on
+        its departure date.
+        """
+        reports = list(reports)
+        if not self.categories:
+            return [[] for _ in reports]
+        import numpy as np
+
+        n_cat = len(self.categories)
+        report_idx: List[int] = []
+        line_no: List[int] = []
+        codes: List[int] = []
+        amounts: List[float] = []
+        cap_rows = []
+        days = []
+        for r, (trip_info, expenses) in enumerate(reports):
+            departure = trip_info.get("departure_date")
+            cap_rows.append(self.caps(_location_key(trip_info.get("location")), departure or date.today()))
+            days.append(max(1, calc_trip_days(departure, trip_info.get("return_date"))))
+            for i, e in enumerate(expenses, start=1):
+                k = self._codes.get(e.get("category"))
+                if k is not None:
+                    report_idx.append(r)
+                    line_no.append(i)
+                    codes.append(k)
+                    amounts.append(float(e.get("amount") or 0))
+
+        cap_amount = np.array([[c[0] for c in row] for row in cap_rows], dtype=float).reshape(len(reports), n_cat)
+        cap_per = np.array([[c[1] for c in row] for row in cap_rows], dtype=object).reshape(len(reports), n_cat)
+        report_idx = np.array(report_idx, dtype=np.int64)
+        codes = np.array(codes, dtype=np.int64)
+        amounts = np.array(amounts, dtype=float)
+        days = np.array(days, dtype=float)[:, None]
+
+        # Each line against its per item cap
+        per_item = cap_per == PER_ITEM
+        item_limit = np.where(per_item, cap_amount, np.inf)[report_idx, codes]
+        over_item = np.flatnonzero(amounts > item_limit + _TOLERANCE)
+
+        # Category totals against the per day, per night and per trip caps
+        totals = np.bincount(report_idx * n_cat + codes, weights=amounts, minlength=len(reports) * n_cat)
+        totals = totals.reshape(len(reports), n_cat)
+        periods = np.select(
+            [cap_per == PER_DAY, cap_per == PER_NIGHT, cap_per == PER_TRIP],
+            [days, np.maximum(days - 1, 1), np.ones_like(days)],
+            default=np.inf,
+        )
+        total_limit = np.where(per_item, np.inf, cap_amount * periods)
+        over_total = np.argwhere(totals > total_limit + _TOLERANCE)
+
+        out: List[List[Dict[str, Any]]] = [[] for _ in reports]
+        for j in over_item:
+            r, k = int(report_idx[j]), int(codes[j])
+            category, amount, cap = self.categories[k], float(amounts[j]), float(cap_amount[r, k])
+            out[r].append(
+                {
+                    "line": line_no[j],
+                    "category": category,
+                    "amount": amount,
+                    "cap": cap,
+                    "per": PER_ITEM,
+                    "message": f"Line {line_no[j]}: {category} ${amount:,.2f} is over the ${cap:,.2f} per item cap",
+                }
+            )
+        for r, k in over_total:
+            category, per = self.categories[k], cap_per[r, k]
+            amount, cap, limit = float(totals[r, k]), float(cap_amount[r, k]), float(total_limit[r, k])
+            basis = "" if per == PER_TRIP else f", ${cap:,.2f} per {per} for {periods[r, k]:g} {per}(s)"
+            out[int(r)].append(
+                {
+                    "line": None,
+                    "category": category,
+                    "amount": amount,
+                    "cap": limit,
+                    "per": per,
+                    "message": f"{category} total ${amount:,.2f} is over the ${limit:,.2f} cap{basis}",
+                }
+            )
+        return out
+
+
+# A file that fails to load caches its PolicyError, so it is not parsed again until replaced
+_cache: Dict[Tuple[str, float, float], Any] = {}
+_cache_lock = threading.Lock()
+
+
+def load_policy(path: Optional[str], default_rate: float = 0.0) -> Policy:
+    """
+    Compiled rule file, cached process-wide by (path, mtime) so a replaced
+    file is picked up on the next call. A missing file gives a policy with
+    default_rate everywhere and no caps. Raises PolicyError for a bad file,
+    the same one on every call until the file changes.
+    """
+    if path and os.path.exists(path):
+        path = os.path.abspath(path)
+        key = (path, os.stat(path).st_mtime, float(default_rate))
+    else:
+        path = ""
+        key = (path, 0.0, float(default_rate))
+    policy = _cache.get(key)
+    if policy is None:
+        with _cache_lock:
+            policy = _cache.get(key)
+            if policy is None:
+                try:
+                    policy = Policy.from_csv(path, default_rate) if path else Policy(default_rate=default_rate)
+                except PolicyError as ex:
+                    policy = ex
+                for stale in [k for k in _cache if k[0] == path]:
+                    del _cache[stale]
+                _cache[key] = policy
+    if isinstance(policy, PolicyError):
+        raise PolicyError(*policy.args)
+    return policy
@@ -0,0 +1,256 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from io import BytesIO
+from typing import List, Dict, Any, Callable, Optional, Tuple
+
+from PIL import Image, ImageOps
+
+try:
+    from pypdf import PdfReader, PdfWriter
+except ImportError:  # optional, only needed to merge PDF receipts
+    PdfReader = PdfWriter = None
+
+from receipt_store import IMAGE_EXTS
+
+
+MIME_TYPES = {
+    "jpg": "image/jpeg",
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "pdf": "application/pdf",
+}
+
+DEFAULT_MAX_DIM = 2000
+DEFAULT_JPEG_QUALITY = 80
+
+# Receipts are dispatched to the process pool only when there is enough work
+# to pay for the inter-process copies
+POOL_MIN_ITEMS = 2
+POOL_MIN_BYTES = 1024 * 1024
+
+
+def mime_for_ext(ext: str) -> str:
+    return MIME_TYPES.get(ext.lower(), "application/pdf")
+
+
+# -------------------------
+# Single receipt
+# -------------------------
+def optimize_image(
+    data: bytes,
+    ext: str,
+    max_dim: int = DEFAULT_MAX_DIM,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+) -> Tuple[bytes, str]:
+    """
+    Downscale an image so its long side is at most max_dim and recompress it.
+    PNGs without transparency are also tried as JPEG. Returns the smallest
+    candidate as (bytes, ext), never anything larger than the input.
+    """
+    ext = ext.lower()
+    try:
+        img = Image.open(BytesIO(data))
+        img = ImageOps.exif_transpose(img)
+    except Exception:
+        return data, ext
+
+    if max(img.size) > max_dim:
+        img.thumbnail((max_dim, max_dim), Image.LANCZOS)
+
+    has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+    candidates = [(data, ext)]
+
+    if ext == "png":
+        out = BytesIO()
+        img.save(out, format="PNG", optimize=True)
+        candidates.append((out.getvalue(), "png"))
+
+    if ext in ("jpg", "jpeg") or not has_alpha:
+        rgb = img if img.mode in ("RGB", "L") else img.convert("RGB")
+        out = BytesIO()
+        rgb.save(out, format="JPEG", quality=jpeg_quality, optimize=True, progressive=True)
+        candidates.append((out.getvalue(), "jpg"))
+
+    return min(candidates, key=lambda c: len(c[0]))
+
+
+def _optimize_job(args: Tuple[bytes, str, int, int]) -> Tuple[bytes, str]:
+    return optimize_image(*args)
+
+
+# -------------------------
+# Content-hash cache
+# -------------------------
+class ReceiptCache:
+    """
+    Optimized receipts on disk keyed by the hash of the original bytes and
+    the optimization settings, so re-submits skip the work.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(data: bytes, max_dim: int, jpeg_quality: int) -> str:
+        h = hashlib.sha256(data)
+        h.update(f"|{max_dim}|{jpeg_quality}".encode())
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[bytes, str]]:
+        for ext in ("jpg", "png", "jpeg"):
+            path = os.path.join(self.directory, f"{key}.{ext}")
+            if os.path.exists(path):
+                with open(path, "rb") as fh:
+                    return fh.read(), ext
+        return None
+
+    def put(self, key: str, data: bytes, ext: str) -> None:
+        path = os.path.join(self.directory, f"{key}.{ext}")
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as fh:
+            fh.write(data)
+        os.replace(tmp, path)
+
+
+# -------------------------
+# Batch
+# -------------------------
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn keeps the workers free of the server's threads and state
+            _pool = ProcessPoolExecutor(
+                max_workers=max(1, min(4, os.cpu_count() or 1)),
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+        return _pool
+
+
+def optimize_receipts(
+    receipts: List[Dict[str, Any]],
+    cache: Optional[ReceiptCache] = None,
+    max_dim: int = DEFAULT_MAX_DIM,
+    jpeg_quality: int = DEFAULT_JPEG_QUALITY,
+    on_result: Optional[Callable[[int, Dict[str, Any]], None]] = None,
+) -> Tuple[List[Dict[str, Any]], Dict[str, int]]:
+    """
+    Optimize a batch of receipts.
+
+    receipts: [{ "content_bytes": bytes, "ext": str }]
+    Returns (results, stats). Results line up with the input, each
+    { "content_bytes": bytes, "ext": str, "mime_type": str }. PDFs pass
+    through unchanged. stats has bytes_in, bytes_out, bytes_saved,
+    cache_hits and optimized.
+
+    on_result(index, result) is called as each receipt is final, in
+    completion order. An exception raised there cancels the receipts not
+    started yet and propagates.
+    """
+    results: List[Optional[Dict[str, Any]]] = [None] * len(receipts)
+    stats = {"bytes_in": 0, "bytes_out": 0, "bytes_saved": 0, "cache_hits": 0, "optimized": 0}
+
+    def done(i: int, result: Dict[str, Any]) -> None:
+        results[i] = result
+        if on_result is not None:
+            on_result(i, result)
+
+    todo = []  # (index, cache key)
+    for i, r in enumerate(receipts):
+        data, ext = r["content_bytes"], (r.get("ext") or "pdf").lower()
+        stats["bytes_in"] += len(data)
+        if ext not in IMAGE_EXTS:
+            done(i, {"content_bytes": data, "ext": ext, "mime_type": mime_for_ext(ext)})
+            continue
+        key = ReceiptCache.key(data, max_dim, jpeg_quality) if cache else None
+        hit = cache.get(key) if cache else None
+        if hit is not None:
+            stats["cache_hits"] += 1
+            done(i, {"content_bytes": hit[0], "ext": hit[1], "mime_type": mime_for_ext(hit[1])})
+        else:
+            todo.append((i, key))
+
+    def finish(i: int, key: Optional[str], data: bytes, ext: str) -> None:
+        stats["optimized"] += 1
+        if cache:
+            cache.put(key, data, ext)
+        done(i, {"content_bytes": data, "ext": ext, "mime_type": mime_for_ext(ext)})
+
+    jobs = [(receipts[i]["content_bytes"], receipts[i].get("ext") or "", max_dim, jpeg_quality) for i, _k in todo]
+    if len(jobs) >= POOL_MIN_ITEMS and sum(len(j[0]) for j in jobs) >= POOL_MIN_BYTES:
+        # Memory-mapped views cannot be pickled, workers get a bytes copy
+        pool = _get_pool()
+        futures = {pool.submit(_optimize_job, (bytes(data), *rest)): todo[n] for n, (data, *rest) in enumerate(jobs)}
+        try:
+            for f in as_completed(futures):
+                i, key = futures[f]
+                finish(i, key, *f.result())
+        finally:
+            for f in futures:
+                f.cancel()
+    else:
+        for (i, key), job in zip(todo, jobs):
+            finish(i, key, *_optimize_job(job))
+
+    stats["bytes_out"] = sum(len(r["content_bytes"]) for r in results)
+    stats["bytes_saved"] = stats["bytes_in"] - stats["bytes_out"]
+    return results, stats
+
+
+def merge_receipts_pdf(receipts: List[Dict[str, Any]]) -> Tuple[bytes, List[Dict[str, Any]]]:
+    """
+    Merge receipts into one PDF, one page per image, PDF receipts appended
+    page by page. PDF receipts are only merged when pypdf is installed.
+    Returns (pdf_bytes, leftovers), leftovers being receipts that could not
+    be merged, including images Pillow cannot read, and should be attached
+    on their own.
+    """
+    leftovers = []
+    if PdfWriter is None:
+        pages = []
+        for r in receipts:
+            if r["ext"] not in IMAGE_EXTS:
+                leftovers.append(r)
+                continue
+            try:
+                pages.append(Image.open(BytesIO(r["content_bytes"])).convert("RGB"))
+            except (OSError, Image.DecompressionBombError):
+                leftovers.append(r)
+        if not pages:
+            return b"", leftovers
+        out = BytesIO()
+        pages[0].save(out, format="PDF", save_all=True, append_images=pages[1:], resolution=150)
+        return out.getvalue(), leftovers
+
+    writer = PdfWriter()
+    for r in receipts:
+        if r["ext"] in IMAGE_EXTS:
+            page = BytesIO()
+            try:
+                Image.open(BytesIO(r["content_bytes"])).convert("RGB").save(page, format="PDF", resolution=150)
+            except (OSError, Image.DecompressionBombError):
+                leftovers.append(r)
+                continue
+            page.seek(0)
+            src = PdfReader(page)
+        else:
+            try:
+                src = PdfReader(BytesIO(r["content_bytes"]))
+            except Exception:
+                leftovers.append(r)
+                continue
+        for p in src.pages:
+            writer.add_page(p)
+    if not writer.pages:
+        return b"", leftovers
+    out = BytesIO()
+    writer.write(out)
+    return out.getvalue(), leftovers
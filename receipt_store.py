@@ -0,0 +1,192 @@
+import hashlib
+import mmap
+import os
+import threading
+import uuid
+import weakref
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Union
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+# Receipt types Pillow can decode, the rest (PDF) pass through untouched
+IMAGE_EXTS = {"jpg", "jpeg", "png"}
+
+
+class ReceiptRef:
+    """
+    Stand-in for a Streamlit UploadedFile once its bytes are in the store.
+    Keeps only the name, size and content hash. Exposes .name, .size and
+    getvalue() like UploadedFile, plus view() for a zero-copy read.
+    """
+
+    __slots__ = ("name", "size", "digest", "_store", "__weakref__")
+
+    def __init__(self, store: "ReceiptStore", digest: str, size: int, name: str):
+        self._store = store
+        self.digest = digest
+        self.size = size
+        self.name = name
+        store.pin(digest)
+        weakref.finalize(self, store.unpin, digest)
+
+    def __bool__(self) -> bool:
+        return True
+
+    def __repr__(self) -> str:
+        return f"ReceiptRef({self.name!r}, {self.size} bytes, {self.digest[:12]})"
+
+    def getvalue(self) -> bytes:
+        return self._store.read(self.digest)
+
+    def view(self) -> Buffer:
+        return self._store.view(self.digest)
+
+
+class ReceiptStore:
+    """
+    Content-addressed receipt blobs on local disk.
+
+    Blobs live at <root>/<first 2 hex>/<sha256>, so the same receipt uploaded
+    from any number of sessions is stored once. view() memory-maps the blob
+    when use_mmap is set, letting attachments be read without copying.
+
+    When max_bytes is set, least recently used blobs are evicted once the
+    store grows past it. Blobs pinned by a live ReceiptRef are never evicted,
+    nor blobs keep(digest) is True for, such as those a saved draft uses.
+    """
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: Optional[int] = None,
+        use_mmap: bool = True,
+        keep: Optional[Callable[[str], bool]] = None,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.use_mmap = use_mmap
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._lru: "OrderedDict[str, int]" = OrderedDict()  # digest -> size
+        self._pins: Dict[str, int] = {}
+        self.total_bytes = 0
+        os.makedirs(root, exist_ok=True)
+        self._scan()
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def put(self, data: Buffer, name: str = "") -> ReceiptRef:
+        digest = hashlib.sha256(data).hexdigest()
+        size = len(data)
+        path = self._path(digest)
+        with self._lock:
+            known = digest in self._lru
+        if not known and not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+            with open(tmp, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp, path)
+        ref = ReceiptRef(self, digest, size, name)
+        with self._lock:
+            if digest not in self._lru:
+                self.total_bytes += size
+            self._lru[digest] = size
+            self._lru.move_to_end(digest)
+            self._evict_locked()
+        return ref
+
+    def put_upload(self, uploaded_file) -> Optional[ReceiptRef]:
+        """Store a Streamlit UploadedFile, hashing its buffer in place."""
+        if uploaded_file is None:
+            return None
+        if isinstance(uploaded_file, ReceiptRef):
+            return uploaded_file
+        getbuffer = getattr(uploaded_file, "getbuffer", None)
+        data = getbuffer() if getbuffer is not None else uploaded_file.getvalue()
+        try:
+            return self.put(data, name=uploaded_file.name)
+        finally:
+            if isinstance(data, memoryview):
+                data.release()
+
+    # -------------------------
+    # Reads
+    # -------------------------
+    def read(self, digest: str) -> bytes:
+        self._touch(digest)
+        with open(self._path(digest), "rb") as fh:
+            return fh.read()
+
+    def view(self, digest: str) -> Buffer:
+        """Read-only buffer over the blob, memory-mapped when enabled."""
+        if not self.use_mmap:
+            return self.read(digest)
+        self._touch(digest)
+        with open(self._path(digest), "rb") as fh:
+            if os.fstat(fh.fileno()).st_size == 0:
+                return b""
+            # The mapping stays valid after the file is closed, and even if
+            # the blob is evicted, until the last view is released
+            return memoryview(mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def exists(self, digest: str) -> bool:
+        return os.path.exists(self._path(digest))
+
+    # -------------------------
+    # Pinning and eviction
+    # -------------------------
+    def pin(self, digest: str) -> None:
+        with self._lock:
+            self._pins[digest] = self._pins.get(digest, 0) + 1
+
+    def unpin(self, digest: str) -> None:
+        with self._lock:
+            n = self._pins.get(digest, 0) - 1
+            if n > 0:
+                self._pins[digest] = n
+            else:
+                self._pins.pop(digest, None)
+
+    def _touch(self, digest: str) -> None:
+        with self._lock:
+            if digest in self._lru:
+                self._lru.move_to_end(digest)
+
+    def _evict_locked(self) -> None:
+        if self.max_bytes is None or self.total_bytes <= self.max_bytes:
+            return
+        for digest in list(self._lru):
+            if self.total_bytes <= self.max_bytes:
+                break
+            if digest in self._pins or (self.keep is not None and self.keep(digest)):
+                continue
+            size = self._lru.pop(digest)
+            self.total_bytes -= size
+            try:
+                os.remove(self._path(digest))
+            except FileNotFoundError:
+                pass
+
+    def _path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _scan(self) -> None:
+        # Rebuild the LRU order from access times of blobs already on disk
+        found = []
+        for sub in os.listdir(self.root):
+            sub_dir = os.path.join(self.root, sub)
+            if not os.path.isdir(sub_dir):
+                continue
+            for name in os.listdir(sub_dir):
+                path = os.path.join(sub_dir, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                found.append((st.st_atime, name, st.st_size))
+        for _atime, digest, size in sorted(found):
+            self._lru[digest] = size
+            self.total_bytes += size
@@ -0,0 +1,392 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+from datetime import date
+from typing import List, Dict, Any, Iterable, Iterator, Optional, Tuple
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+    report_id         INTEGER PRIMARY KEY,
+    submitted_at      REAL NOT NULL,
+    job_id            TEXT,
+    employee          TEXT NOT NULL,
+    employee_name     TEXT,
+    employee_email    TEXT,
+    location          TEXT COLLATE NOCASE,
+    purpose           TEXT,
+    departure_date    TEXT,
+    return_date       TEXT,
+    trip_days         INTEGER,
+    per_diem_rate     REAL,
+    per_diem_total    REAL,
+    total_spend       REAL,
+    company_paid      REAL,
+    employee_paid     REAL,
+    reimbursement_due REAL,
+    line_items        INTEGER
+);
+CREATE INDEX IF NOT EXISTS reports_employee ON reports (employee, departure_date, report_id);
+CREATE INDEX IF NOT EXISTS reports_location ON reports (location, departure_date, report_id);
+CREATE INDEX IF NOT EXISTS reports_departure ON reports (departure_date, report_id);
+
+CREATE TABLE IF NOT EXISTS line_items (
+    item_id      INTEGER PRIMARY KEY,
+    report_id    INTEGER NOT NULL REFERENCES reports (report_id),
+    employee     TEXT NOT NULL,
+    category     TEXT,
+    expense_date TEXT,
+    paid_by      TEXT,
+    description  TEXT,
+    amount       REAL,
+    has_receipt  INTEGER,
+    receipt_digest TEXT,
+    receipt_name TEXT
+);
+CREATE INDEX IF NOT EXISTS line_items_report ON line_items (report_id);
+CREATE INDEX IF NOT EXISTS line_items_employee ON line_items (employee, expense_date, item_id);
+CREATE INDEX IF NOT EXISTS line_items_category ON line_items (category, expense_date, item_id);
+CREATE INDEX IF NOT EXISTS line_items_date ON line_items (expense_date, item_id);
+
+CREATE TABLE IF NOT EXISTS monthly_category (
+    month        TEXT NOT NULL,
+    category     TEXT NOT NULL,
+    total_spend  REAL NOT NULL,
+    company_paid REAL NOT NULL,
+    line_items   INTEGER NOT NULL,
+    PRIMARY KEY (month, category)
+) WITHOUT ROWID;
+"""
+
+_UPSERT_ROLLUP = """
+INSERT INTO monthly_category (month, category, total_spend, company_paid, line_items)
+VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (month, category) DO UPDATE SET
+    total_spend = total_spend + excluded.total_spend,
+    company_paid = company_paid + excluded.company_paid,
+    line_items = line_items + excluded.line_items
+"""
+
+REPORT_FIELDS = [
+    "employee_name",
+    "employee_email",
+    "location",
+    "purpose",
+    "departure_date",
+    "return_date",
+    "trip_days",
+    "per_diem_rate",
+    "per_diem_total",
+    "total_spend",
+    "company_paid",
+    "employee_paid",
+    "reimbursement_due",
+]
+
+DEFAULT_PAGE_SIZE = 50
+
+# A page cursor is the sort key of the last row of the previous page
+Cursor = Tuple[str, int]
+
+
+def _iso(v) -> str:
+    # Never NULL, so the date indexes can serve the ORDER BY of every page
+    if v is None or v == "":
+        return ""
+    if isinstance(v, date):
+        return v.isoformat()
+    return str(v)[:10]
+
+
+def _employee_key(email: str) -> str:
+    return (email or "").strip().lower()
+
+
+class ReportArchive:
+    """
+    Every submitted report and its line items in SQLite, for Finance to
+    search after the email is gone.
+
+    Reports and line items are indexed on employee, location, category and
+    date, and both are paged by keyset (the sort key of the last row seen),
+    so a deep page costs the same as the first one. Spend per category per
+    month is kept in monthly_category, updated in the same transaction as
+    each insert, so rollups read a few hundred rows instead of scanning
+    every line item.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(_SCHEMA)
+        self._migrate()
+
+    def _migrate(self) -> None:
+        cols = {r["name"] for r in self._conn.execute("PRAGMA table_info(line_items)")}
+        for name in ("receipt_digest", "receipt_name"):
+            if name not in cols:
+                self._conn.execute(f"ALTER TABLE line_items ADD COLUMN {name} TEXT")
+
+    # -------------------------
+    # Writes
+    # -------------------------
+    def archive(
+        self,
+        trip_info: Dict[str, Any],
+        expenses: Iterable[Dict[str, Any]],
+        job_id: Optional[str] = None,
+        submitted_at: Optional[float] = None,
+    ) -> int:
+        """Store one submitted report. Returns its report_id."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                report_id = self._insert(trip_info, expenses, job_id, submitted_at)
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return report_id
+
+    def archive_many(self, reports: Iterable[Tuple[Dict[str, Any], Iterable[Dict[str, Any]]]]) -> int:
+        """Bulk load (trip_info, expenses) pairs in one transaction. Returns the count."""
+        n = 0
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                for trip_info, expenses in reports:
+                    self._insert(trip_info, expenses, None, None)
+                    n += 1
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return n
+
+    def _insert(
+        self,
+        trip_info: Dict[str, Any],
+        expenses: Iterable[Dict[str, Any]],
+        job_id: Optional[str],
+        submitted_at: Optional[float],
+    ) -> int:
+        employee = _employee_key(trip_info.get("employee_email"))
+        departure = _iso(trip_info.get("departure_date"))
+        items = []
+        rollup: Dict[Tuple[str, str], List[float]] = defaultdict(lambda: [0.0, 0.0, 0])
+        for e in expenses:
+            expense_date = _iso(e.get("expense_date")) or departure
+            category = e.get("category") or "Other"
+            amount = float(e.get("amount") or 0)
+            receipt = e.get("receipt_file")
+            items.append(
+                (
+                    employee,
+                    category,
+                    expense_date,
+                    e.get("paid_by"),
+                    e.get("description"),
+                    amount,
+                    1 if receipt else 0,
+                    getattr(receipt, "digest", None),
+                    getattr(receipt, "name", None),
+                )
+            )
+            acc = rollup[(expense_date[:7], category)]
+            acc[0] += amount
+            if e.get("paid_by") == "Performa":
+                acc[1] += amount
+            acc[2] += 1
+
+        values = [trip_info.get(k) for k in REPORT_FIELDS]
+        values[REPORT_FIELDS.index("departure_date")] = departure
+        values[REPORT_FIELDS.index("return_date")] = _iso(trip_info.get("return_date"))
+        cur = self._conn.execute(
+            f"""
+            INSERT INTO reports (submitted_at, job_id, employee, {", ".join(REPORT_FIELDS)}, line_items)
+            VALUES (?, ?, ?, {", ".join("?" * len(REPORT_FIELDS))}, ?)
+            """,
+            (submitted_at or time.time(), job_id, employee, *values, len(items)),
+        )
+        report_id = cur.lastrowid
+        self._conn.executemany(
+            """
+            INSERT INTO line_items
+            (report_id, employee, category, expense_date, paid_by, description, amount, has_receipt,
+             receipt_digest, receipt_name)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            [(report_id, *item) for item in items],
+        )
+        self._conn.executemany(_UPSERT_ROLLUP, [(m, c, *acc) for (m, c), acc in rollup.items()])
+        return report_id
+
+    def rebuild_rollups(self) -> None:
+        """Recompute monthly_category from the line items, one full scan."""
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                self._conn.execute("DELETE FROM monthly_category")
+                self._conn.execute(
+                    """
+                    INSERT INTO monthly_category (month, category, total_spend, company_paid, line_items)
+                    SELECT substr(expense_date, 1, 7), category, SUM(amount),
+                           SUM(CASE WHEN paid_by = 'Performa' THEN amount ELSE 0 END), COUNT(*)
+                    FROM line_items GROUP BY 1, 2
+                    """
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    # -------------------------
+    # Queries
+    # -------------------------
+    def search_reports(
+        self,
+        employee_email: Optional[str] = None,
+        location: Optional[str] = None,
+        date_from=None,
+        date_to=None,
+        category: Optional[str] = None,
+        cursor: Optional[Cursor] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Cursor]]:
+        """
+        Reports newest departure first. Dates filter on departure_date,
+        category keeps reports with at least one line item in it. Returns
+        (rows, next_cursor), next_cursor is None on the last page.
+        """
+        where, params = [], []
+        if employee_email:
+            where.append("r.employee = ?")
+            params.append(_employee_key(employee_email))
+        if location:
+            where.append("r.location = ?")
+            params.append(location.strip())
+        if date_from:
+            where.append("r.departure_date >= ?")
+            params.append(_iso(date_from))
+        if date_to:
+            where.append("r.departure_date <= ?")
+            params.append(_iso(date_to))
+        if category:
+            where.append("EXISTS (SELECT 1 FROM line_items i WHERE i.report_id = r.report_id AND i.category = ?)")
+            params.append(category)
+        return self._page(
+            "SELECT r.* FROM reports r", "r.departure_date", "r.report_id", where, params, cursor, page_size
+        )
+
+    def search_line_items(
+        self,
+        employee_email: Optional[str] = None,
+        category: Optional[str] = None,
+        date_from=None,
+        date_to=None,
+        report_id: Optional[int] = None,
+        cursor: Optional[Cursor] = None,
+        page_size: int = DEFAULT_PAGE_SIZE,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Cursor]]:
+        """Line items newest expense_date first, paged like search_reports."""
+        where, params = [], []
+        if report_id is not None:
+            where.append("i.report_id = ?")
+            params.append(report_id)
+        if employee_email:
+            where.append("i.employee = ?")
+            params.append(_employee_key(employee_email))
+        if category:
+            where.append("i.category = ?")
+            params.append(category)
+        if date_from:
+            where.append("i.expense_date >= ?")
+            params.append(_iso(date_from))
+        if date_to:
+            where.append("i.expense_date <= ?")
+            params.append(_iso(date_to))
+        return self._page(
+            "SELECT i.* FROM line_items i", "i.expense_date", "i.item_id", where, params, cursor, page_size
+        )
+
+    def _page(
+        self,
+        select: str,
+        sort_col: str,
+        id_col: str,
+        where: List[str],
+        params: List[Any],
+        cursor: Optional[Cursor],
+        page_size: int,
+    ) -> Tuple[List[Dict[str, Any]], Optional[Cursor]]:
+        if cursor is not None:
+            where = where + [f"({sort_col}, {id_col}) < (?, ?)"]
+            params = params + [cursor[0], cursor[1]]
+        sql = select
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {sort_col} DESC, {id_col} DESC LIMIT ?"
+        with self._lock:
+            rows = [dict(r) for r in self._conn.execute(sql, (*params, page_size + 1))]
+        if len(rows) <= page_size:
+            return rows, None
+        rows = rows[:page_size]
+        last = rows[-1]
+        return rows, (last[sort_col.split(".")[1]], last[id_col.split(".")[1]])
+
+    def monthly_rollup(
+        self,
+        month_from: Optional[str] = None,
+        month_to: Optional[str] = None,
+        category: Optional[str] = None,
+    ) -> List[Dict[str, Any]]:
+        """
+        Spend per category per month, months as "YYYY-MM", from the
+        precomputed table.
+        """
+        where, params = [], []
+        if month_from:
+            where.append("month >= ?")
+            params.append(month_from)
+        if month_to:
+            where.append("month <= ?")
+            params.append(month_to)
+        if category:
+            where.append("category = ?")
+            params.append(category)
+        sql = "SELECT month, category, total_spend, company_paid, line_items FROM monthly_category"
+        if where:
+            sql += " WHERE " + " AND ".join(where)
+        sql += " ORDER BY month, category"
+        with self._lock:
+            return [dict(r) for r in self._conn.execute(sql, params)]
+
+    def iter_line_items(self, batch_size: int = 10000) -> Iterator[Dict[str, Any]]:
+        """Every line item in insert order, fetched in batches by item_id."""
+        last_id = 0
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT * FROM line_items WHERE item_id > ? ORDER BY item_id LIMIT ?", (last_id, batch_size)
+                ).fetchall()
+            if not rows:
+                return
+            for r in rows:
+                yield dict(r)
+            last_id = rows[-1]["item_id"]
+
+    def count_reports(self) -> int:
+        with self._lock:
+            return int(self._conn.execute("SELECT COUNT(*) FROM reports").fetchone()[0])
+
+    def close(self) -> None:
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,128 @@
+from datetime import date
+from typing import List, Dict, Any
+
+from email_templates import render_email_html, render_email_text
+from expense_store import ExpenseStore, receipt_size
+
+
+def bytes_from_uploaded_file(uploaded_file) -> bytes:
+    if uploaded_file is None:
+        return b""
+    # Stored receipts hand out a read-only, memory-mapped view, no copy
+    view = getattr(uploaded_file, "view", None)
+    if view is not None:
+        return view()
+    return uploaded_file.getvalue()
+
+
+def total_receipt_bytes(expenses: List[Dict[str, Any]]) -> int:
+    if isinstance(expenses, ExpenseStore):
+        return expenses.receipt_bytes
+    return sum(receipt_size(e.get("receipt_file")) for e in expenses)
+
+
+def trip_day_weights(departure: date, ret: date, partial_day_factor: float = 1.0) -> List[float]:
+    """
+    Per diem share of each calendar day of the trip. The departure and
+    return days are partial travel days and count partial_day_factor of a
+    full day, a same-day trip counts one partial day.
+    """
+    if not departure or not ret or ret < departure:
+        return []
+    weights = [1.0] * ((ret - departure).days + 1)
+    weights[0] = weights[-1] = partial_day_factor
+    return weights
+
+
+def calc_trip_days(departure: date, ret: date, partial_day_factor: float = 1.0) -> float:
+    """Calendar days of the trip, with the first and last day weighted as in trip_day_weights."""
+    if not departure or not ret or ret < departure:
+        return 0
+    if partial_day_factor == 1.0:
+        return (ret - departure).days + 1
+    return sum(trip_day_weights(departure, ret, partial_day_factor))
+
+
+def calc_totals(expenses: List[Dict[str, Any]]) -> Dict[str, float]:
+    """Totals of "amount", which is in the base currency once fx_rates.apply_fx has run."""
+    if isinstance(expenses, ExpenseStore):
+        return expenses.totals()
+
+    total_spend = 0.0
+    company_paid = 0.0
+    employee_paid = 0.0
+
+    for e in expenses:
+        amt = float(e.get("amount") or 0)
+        total_spend += amt
+        if e.get("paid_by") == "Performa":
+            company_paid += amt
+        else:
+            employee_paid += amt
+
+    return {
+        "total_spend": total_spend,
+        "company_paid": company_paid,
+        "employee_paid": employee_paid,
+    }
+
+
+def build_email_html(
+    employee_name: str,
+    employee_email: str,
+    location: str,
+    purpose: str,
+    departure_date: date,
+    return_date: date,
+    per_diem_total: float,
+    total_spend: float,
+    company_paid: float,
+    employee_paid: float,
+    reimbursement_due: float,
+    expenses: List[Dict[str, Any]],
+) -> str:
+    # Rendering lives in email_templates, line item rows are memoized there
+    report = dict(
+        employee_name=employee_name,
+        employee_email=employee_email,
+        location=location,
+        purpose=purpose,
+        departure_date=departure_date,
+        return_date=return_date,
+        per_diem_total=per_diem_total,
+        total_spend=total_spend,
+        company_paid=company_paid,
+        employee_paid=employee_paid,
+        reimbursement_due=reimbursement_due,
+    )
+    return render_email_html(report, expenses)
+
+
+def build_email_text(
+    employee_name: str,
+    employee_email: str,
+    location: str,
+    purpose: str,
+    departure_date: date,
+    return_date: date,
+    per_diem_total: float,
+    total_spend: float,
+    company_paid: float,
+    employee_paid: float,
+    reimbursement_due: float,
+    expenses: List[Dict[str, Any]],
+) -> str:
+    report = dict(
+        employee_name=employee_name,
+        employee_email=employee_email,
+        location=location,
+        purpose=purpose,
+        departure_date=departure_date,
+        return_date=return_date,
+        per_diem_total=per_diem_total,
+        total_spend=total_spend,
+        company_paid=company_paid,
+        employee_paid=employee_paid,
+        reimbursement_due=reimbursement_due,
+    )
+    return render_email_text(report, expenses)
@@ -0,0 +1,307 @@
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+from typing import List, Dict, Any, Callable, Optional, Tuple
+
+import metrics
+from email_utils import send_email_with_attachments
+from mail_transport import iter_attachment_bytes
+
+
+# Job states
+QUEUED = "queued"
+SENDING = "sending"
+RETRYING = "retrying"
+SENT = "sent"
+FAILED = "failed"
+
+PENDING_STATES = (QUEUED, SENDING, RETRYING)
+
+# sender(subject, html_body, employee_email, attachments, text_body=None) -> status code
+Sender = Callable[..., int]
+
+
+class SubmissionQueue:
+    """
+    Background delivery of submitted reports.
+
+    enqueue() spools the message and its attachments to disk and returns a
+    job id straight away. Worker threads send spooled jobs, retrying
+    failures with exponential backoff. Jobs left pending by a restart are
+    picked up again from the spool on startup. Sent jobs are purged from
+    the spool once retention_s old, at startup and every purge_interval_s
+    after. Failed jobs are kept until removed by hand.
+
+    Spool layout, one folder per job:
+      <spool_dir>/<job_id>/job.json      state, attempts, last error
+      <spool_dir>/<job_id>/body.html
+      <spool_dir>/<job_id>/body.txt      plain text part, when given
+      <spool_dir>/<job_id>/att_000.bin   attachment bytes, in order
+    """
+
+    def __init__(
+        self,
+        spool_dir: str,
+        sender: Optional[Sender] = None,
+        workers: int = 2,
+        max_attempts: int = 5,
+        backoff_base: float = 2.0,
+        backoff_max: float = 300.0,
+        retention_s: Optional[float] = 7 * 24 * 3600,
+        purge_interval_s: float = 3600.0,
+    ):
+        self.spool_dir = spool_dir
+        self.sender = sender or send_email_with_attachments
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.retention_s = retention_s
+        self.purge_interval_s = purge_interval_s
+
+        self._jobs: Dict[str, Dict[str, Any]] = {}
+        self._ready: List[tuple] = []  # heap of (run_at, job_id)
+        self._cond = threading.Condition()
+        self._stopped = False
+
+        os.makedirs(spool_dir, exist_ok=True)
+        self._recover()
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"submission-worker-{i}", daemon=True)
+            for i in range(max(1, workers))
+        ]
+        if retention_s is not None:
+            self._threads.append(threading.Thread(target=self._purger, name="submission-purge", daemon=True))
+        for t in self._threads:
+            t.start()
+
+    # -------------------------
+    # Public API
+    # -------------------------
+    def enqueue(
+        self,
+        subject: str,
+        html_body: str,
+        employee_email: str,
+        attachments: List[Dict[str, Any]],
+        text_body: Optional[str] = None,
+        recipients: Optional[Tuple[List[str], List[str]]] = None,
+    ) -> str:
+        """
+        Spools the message and returns its job id. recipients, (to, cc),
+        is passed on to the sender when given.
+        """
+        job_id = uuid.uuid4().hex
+        job_dir = self._job_dir(job_id)
+        tmp_dir = job_dir + ".tmp"
+        os.makedirs(tmp_dir)
+
+        with open(os.path.join(tmp_dir, "body.html"), "w", encoding="utf-8") as fh:
+            fh.write(html_body)
+        if text_body is not None:
+            with open(os.path.join(tmp_dir, "body.txt"), "w", encoding="utf-8") as fh:
+                fh.write(text_body)
+        att_meta = []
+        for n, a in enumerate(attachments):
+            with open(os.path.join(tmp_dir, f"att_{n:03d}.bin"), "wb") as fh:
+                for chunk in iter_attachment_bytes(a):
+                    fh.write(chunk)
+            att_meta.append({"filename": a["filename"], "mime_type": a["mime_type"]})
+
+        job = {
+            "job_id": job_id,
+            "status": QUEUED,
+            "subject": subject,
+            "employee_email": employee_email,
+            "attachments": att_meta,
+            "recipients": [list(r) for r in recipients] if recipients else None,
+            "attempts": 0,
+            "created_at": time.time(),
+            "updated_at": time.time(),
+            "next_attempt_at": 0.0,
+            "status_code": None,
+            "last_error": None,
+        }
+        self._write_job(tmp_dir, job)
+        # The rename makes the job visible to recovery only once complete
+        os.replace(tmp_dir, job_dir)
+
+        with self._cond:
+            self._jobs[job_id] = job
+            heapq.heappush(self._ready, (0.0, job_id))
+            self._cond.notify()
+        return job_id
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is not None:
+                return dict(job)
+        path = os.path.join(self._job_dir(job_id), "job.json")
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as fh:
+                return json.load(fh)
+        return None
+
+    def pending_count(self) -> int:
+        with self._cond:
+            return sum(1 for j in self._jobs.values() if j["status"] in PENDING_STATES)
+
+    def purge_finished(self, older_than_s: float = 7 * 24 * 3600) -> int:
+        """Remove spool folders of sent jobs older than the cutoff."""
+        cutoff = time.time() - older_than_s
+        removed = 0
+        with self._cond:
+            done = [
+                job_id
+                for job_id, j in self._jobs.items()
+                if j["status"] == SENT and j["updated_at"] < cutoff
+            ]
+            for job_id in done:
+                del self._jobs[job_id]
+        for job_id in done:
+            shutil.rmtree(self._job_dir(job_id), ignore_errors=True)
+            removed += 1
+        return removed
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    # -------------------------
+    # Internals
+    # -------------------------
+    def _job_dir(self, job_id: str) -> str:
+        return os.path.join(self.spool_dir, job_id)
+
+    @staticmethod
+    def _write_job(job_dir: str, job: Dict[str, Any]) -> None:
+        path = os.path.join(job_dir, "job.json")
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(job, fh)
+        os.replace(tmp, path)
+
+    def _recover(self) -> None:
+        for name in os.listdir(self.spool_dir):
+            job_dir = self._job_dir(name)
+            if name.endswith(".tmp"):
+                # Enqueue was interrupted before the job became visible
+                shutil.rmtree(job_dir, ignore_errors=True)
+                continue
+            path = os.path.join(job_dir, "job.json")
+            if not os.path.exists(path):
+                continue
+            with open(path, encoding="utf-8") as fh:
+                job = json.load(fh)
+            if job["status"] == SENDING:
+                job["status"] = RETRYING
+            self._jobs[job["job_id"]] = job
+            if job["status"] in PENDING_STATES:
+                heapq.heappush(self._ready, (job.get("next_attempt_at", 0.0), job["job_id"]))
+
+    def _purger(self) -> None:
+        while True:
+            try:
+                removed = self.purge_finished(self.retention_s)
+            except OSError:
+                removed = 0
+            if removed:
+                metrics.incr("submission_jobs_purged_total", removed)
+            with self._cond:
+                if self._cond.wait_for(lambda: self._stopped, timeout=self.purge_interval_s):
+                    return
+
+    def _next_job(self) -> Optional[str]:
+        with self._cond:
+            while not self._stopped:
+                if self._ready:
+                    run_at, job_id = self._ready[0]
+                    delay = run_at - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self._ready)
+                        job = self._jobs[job_id]
+                        job["status"] = SENDING
+                        job["updated_at"] = time.time()
+                        return job_id
+                    self._cond.wait(timeout=delay)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _load_attachments(self, job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # Path based, the sender streams the spooled files instead of loading them
+        job_dir = self._job_dir(job["job_id"])
+        return [
+            {
+                "filename": meta["filename"],
+                "path": os.path.join(job_dir, f"att_{n:03d}.bin"),
+                "mime_type": meta["mime_type"],
+            }
+            for n, meta in enumerate(job["attachments"])
+        ]
+
+    def _worker(self) -> None:
+        while True:
+            job_id = self._next_job()
+            if job_id is None:
+                return
+            job = self._jobs[job_id]
+            job_dir = self._job_dir(job_id)
+            self._write_job(job_dir, job)
+
+            error = None
+            status_code = None
+            try:
+                with open(os.path.join(job_dir, "body.html"), encoding="utf-8") as fh:
+                    html_body = fh.read()
+                text_path = os.path.join(job_dir, "body.txt")
+                text_body = None
+                if os.path.exists(text_path):
+                    with open(text_path, encoding="utf-8") as fh:
+                        text_body = fh.read()
+                # Jobs spooled before recipients existed have no such key
+                extra = {"recipients": tuple(job["recipients"])} if job.get("recipients") else {}
+                status_code = int(
+                    self.sender(
+                        job["subject"],
+                        html_body,
+                        job["employee_email"],
+                        self._load_attachments(job),
+                        text_body=text_body,
+                        **extra,
+                    )
+                )
+                if not 200 <= status_code < 300:
+                    error = f"Mail backend returned status code: {status_code}"
+            except Exception as ex:
+                error = str(ex) or type(ex).__name__
+
+            with self._cond:
+                job["attempts"] += 1
+                job["status_code"] = status_code
+                job["last_error"] = error
+                job["updated_at"] = time.time()
+                if error is None:
+                    job["status"] = SENT
+                elif job["attempts"] >= self.max_attempts:
+                    job["status"] = FAILED
+                else:
+                    delay = min(self.backoff_base ** job["attempts"], self.backoff_max)
+                    job["status"] = RETRYING
+                    job["next_attempt_at"] = time.time() + delay
+                    heapq.heappush(self._ready, (job["next_attempt_at"], job_id))
+                    self._cond.notify()
+                snapshot = dict(job)
+            self._write_job(job_dir, snapshot)
+            metrics.incr("submission_attempts_total", status=snapshot["status"])
+            if snapshot["status"] == SENT:
+                metrics.observe("queue.delivery", snapshot["updated_at"] - snapshot["created_at"])
@@ -0,0 +1,257 @@
+"""
+Everything a submit needs beyond the form: the workbook, receipts, email
+body and mail delivery. app.py imports this through load_pipeline() on the
+first submit, so openpyxl, Pillow and the mail transports stay out of the
+first render and of the reruns that never submit.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any, Optional, TYPE_CHECKING
+
+import metrics
+from attachments import (
+    AttachmentsTooLarge,
+    SizeBudget,
+    assemble_receipts,
+    fixed_receipt_sizes,
+    pack_attachments,
+    workbook_attachment,
+)
+from email_templates import add_manifest_html, add_manifest_text, render_part_html, render_part_text
+from email_utils import Recipients, employee_recipients, send_email_with_attachments
+from excel_generator import generate_excel
+from excel_templates import preload_templates
+from receipt_optimizer import ReceiptCache
+from report_utils import build_email_html, build_email_text
+from submission_queue import SubmissionQueue
+
+if TYPE_CHECKING:
+    from finance_digest import FinanceDigest
+
+
+# Workbook and email bodies run here while the calling thread assembles the
+# receipts. Shared by every session, so it stays small.
+_pool: Optional[ThreadPoolExecutor] = None
+_pool_lock = threading.Lock()
+
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix="submit")
+        return _pool
+
+
+def warm_up() -> None:
+    # Parsed once per process, later renders only fill in the data cells
+    preload_templates()
+
+
+def report_subject(trip_info: Dict[str, Any]) -> str:
+    return (
+        f"Expense Report Submitted, {trip_info['employee_name']}, {trip_info['location']}, "
+        f"{trip_info['departure_date']} to {trip_info['return_date']}"
+    )
+
+
+def _excel(trip_info: Dict[str, Any], expenses) -> bytes:
+    with metrics.span("submit.excel"):
+        return generate_excel(trip_info, expenses, engine="template")
+
+
+def _email_bodies(trip_info: Dict[str, Any], expenses):
+    email_fields = dict(
+        employee_name=trip_info["employee_name"],
+        employee_email=trip_info["employee_email"],
+        location=trip_info["location"],
+        purpose=trip_info["purpose"],
+        departure_date=trip_info["departure_date"],
+        return_date=trip_info["return_date"],
+        per_diem_total=trip_info["per_diem_total"],
+        total_spend=trip_info["total_spend"],
+        company_paid=trip_info["company_paid"],
+        employee_paid=trip_info["employee_paid"],
+        reimbursement_due=trip_info["reimbursement_due"],
+        expenses=expenses,
+    )
+    with metrics.span("submit.email_body"):
+        return build_email_html(**email_fields), build_email_text(**email_fields)
+
+
+def build_package(
+    trip_info: Dict[str, Any],
+    expenses,
+    optimize: bool = True,
+    cache: Optional[ReceiptCache] = None,
+    merge_pdf: bool = False,
+    max_bytes: Optional[int] = None,
+    split: bool = False,
+) -> Dict[str, Any]:
+    """
+    Workbook, attachments and email bodies for one report, as
+    { "subject", "html_body", "text_body", "attachments", "total_bytes",
+      "receipt_stats", "parts" }, parts being the emails to send, see
+    split_parts.
+
+    The workbook and the email bodies are built on the submit pool while
+    this thread reads and optimizes the receipts. With max_bytes the size
+    is checked as each attachment becomes final, and receipts that cannot
+    shrink are counted before anything is built, raising
+    AttachmentsTooLarge as soon as the report cannot fit. With split the
+    limit applies to each email instead and the attachments are spread
+    over as many as needed.
+    """
+    expenses = list(expenses)
+    # Split reports only need every single attachment to fit
+    budget = SizeBudget(None if split else max_bytes)
+    sizes = fixed_receipt_sizes(expenses, optimize)
+    fixed = max(sizes, default=0) if split else sum(sizes)
+    if max_bytes is not None and fixed > max_bytes:
+        raise AttachmentsTooLarge(fixed, max_bytes)
+
+    pool = _get_pool()
+    excel_future = pool.submit(_excel, trip_info, expenses)
+    bodies_future = pool.submit(_email_bodies, trip_info, expenses)
+    try:
+        receipts, receipt_stats = assemble_receipts(
+            trip_info["employee_name"],
+            expenses,
+            optimize=optimize,
+            cache=cache,
+            merge_pdf=merge_pdf,
+            budget=budget,
+        )
+        excel_bytes = excel_future.result()
+        budget.settle(0, len(excel_bytes))
+        html_body, text_body = bodies_future.result()
+    except BaseException:
+        excel_future.cancel()
+        bodies_future.cancel()
+        raise
+
+    package = {
+        "subject": report_subject(trip_info),
+        "html_body": html_body,
+        "text_body": text_body,
+        "attachments": [workbook_attachment(trip_info["employee_name"], excel_bytes)] + receipts,
+        "receipt_stats": receipt_stats,
+    }
+    package["total_bytes"] = sum(len(a["content_bytes"]) for a in package["attachments"])
+    if split and max_bytes is not None and package["total_bytes"] > max_bytes:
+        with metrics.span("submit.split"):
+            package["parts"] = split_parts(package, trip_info["employee_name"], max_bytes)
+    else:
+        package["parts"] = [_part(package, package["subject"], package["attachments"])]
+    return package
+
+
+def _part(
+    package: Dict[str, Any],
+    subject: str,
+    attachments: List[Dict[str, Any]],
+    html_body: Optional[str] = None,
+    text_body: Optional[str] = None,
+) -> Dict[str, Any]:
+    return {
+        "subject": subject,
+        "html_body": package["html_body"] if html_body is None else html_body,
+        "text_body": package["text_body"] if text_body is None else text_body,
+        "attachments": attachments,
+    }
+
+
+def split_parts(package: Dict[str, Any], employee_name: str, max_bytes: int) -> List[Dict[str, Any]]:
+    """
+    The package as the fewest emails whose attachments each fit in
+    max_bytes, subjects numbered "part 1 of n". Part 1 carries the
+    workbook, the full report body and a manifest of every part, the
+    others a short body listing their own attachments.
+    """
+    groups = pack_attachments(package["attachments"], max_bytes)
+    n = len(groups)
+    if n == 1:
+        return [_part(package, package["subject"], groups[0])]
+    parts = [
+        _part(
+            package,
+            f"{package['subject']}, part 1 of {n}",
+            groups[0],
+            add_manifest_html(package["html_body"], groups),
+            add_manifest_text(package["text_body"], groups),
+        )
+    ]
+    for k, group in enumerate(groups[1:], start=2):
+        parts.append(
+            _part(
+                package,
+                f"{package['subject']}, part {k} of {n}",
+                group,
+                render_part_html(employee_name, k, n, group),
+                render_part_text(employee_name, k, n, group),
+            )
+        )
+    return parts
+
+
+def _recipients(employee_email: str, employee_only: bool) -> Optional[Recipients]:
+    # None keeps the usual Finance, approver and employee recipients
+    return employee_recipients(employee_email) if employee_only else None
+
+
+def enqueue(
+    queue: SubmissionQueue,
+    package: Dict[str, Any],
+    employee_email: str,
+    employee_only: bool = False,
+) -> List[str]:
+    """
+    Hands every part of the package to the submission queue. Returns the
+    job ids, in part order. employee_only sends the employee's copy alone,
+    for reports Finance gets in the digest.
+    """
+    recipients = _recipients(employee_email, employee_only)
+    with metrics.span("submit.enqueue"):
+        return [
+            queue.enqueue(
+                subject=part["subject"],
+                html_body=part["html_body"],
+                employee_email=employee_email,
+                attachments=part["attachments"],
+                text_body=part["text_body"],
+                recipients=recipients,
+            )
+            for part in package["parts"]
+        ]
+
+
+def _send_part(part: Dict[str, Any], employee_email: str, recipients: Optional[Recipients]) -> int:
+    return send_email_with_attachments(
+        subject=part["subject"],
+        html_body=part["html_body"],
+        employee_email=employee_email,
+        attachments=part["attachments"],
+        text_body=part["text_body"],
+        recipients=recipients,
+    )
+
+
+def send(package: Dict[str, Any], employee_email: str, employee_only: bool = False) -> List[int]:
+    """
+    Sends every part of the package now, concurrently when there are
+    several. Returns the transport status codes, in part order.
+    employee_only as in enqueue.
+    """
+    recipients = _recipients(employee_email, employee_only)
+    parts = package["parts"]
+    with metrics.span("submit.send"):
+        if len(parts) == 1:
+            return [_send_part(parts[0], employee_email, recipients)]
+        futures = [_get_pool().submit(_send_part, part, employee_email, recipients) for part in parts]
+        return [f.result() for f in futures]
+
+
+def add_to_digest(digest: "FinanceDigest", trip_info: Dict[str, Any], expenses, package: Dict[str, Any]) -> str:
+    """Spools the report's receipts for the next Finance digest, which builds its own workbook."""
+    with metrics.span("submit.digest"):
+        return digest.add(trip_info, expenses, package["attachments"][1:])
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from bin_packing import first_fit_decreasing
+
+
+def reference_ffd(sizes, capacity, first=None):
+    # Plain first fit over the same order, O(n * bins)
+    order = sorted(range(len(sizes)), key=lambda i: sizes[i], reverse=True)
+    if first is not None:
+        order.remove(first)
+        order.insert(0, first)
+    free, packed = [], []
+    for i in order:
+        for b, room in enumerate(free):
+            if room >= sizes[i]:
+                free[b] -= sizes[i]
+                packed[b].append(i)
+                break
+        else:
+            free.append(capacity - sizes[i])
+            packed.append([i])
+    return [sorted(p) for p in packed]
+
+
+def test_packs_largest_first():
+    assert first_fit_decreasing([5, 4, 3, 2, 1], 7) == [[0, 3], [1, 2], [4]]
+
+
+def test_first_item_goes_in_the_first_bin():
+    assert first_fit_decreasing([1, 6, 3], 6, first=0) == [[0, 2], [1]]
+    assert first_fit_decreasing([1, 6, 3], 6) == [[1], [0, 2]]
+
+
+def test_exact_fit_fills_a_bin():
+    assert first_fit_decreasing([3, 3, 3, 3], 6) == [[0, 1], [2, 3]]
+
+
+def test_empty():
+    assert first_fit_decreasing([], 10) == []
+
+
+def test_item_over_capacity_raises():
+    with pytest.raises(ValueError, match="item of 11 bytes does not fit in 10"):
+        first_fit_decreasing([3, 11, 2], 10)
+
+
+def test_matches_plain_first_fit():
+    rng = random.Random(7)
+    for _ in range(200):
+        capacity = rng.randint(10, 1000)
+        sizes = [rng.randint(1, capacity) for _ in range(rng.randint(1, 60))]
+        first = rng.randrange(len(sizes)) if rng.random() < 0.5 else None
+        packed = first_fit_decreasing(sizes, capacity, first=first)
+        assert packed == reference_ffd(sizes, capacity, first=first)
+        assert sorted(i for p in packed for i in p) == list(range(len(sizes)))
+        assert all(sum(sizes[i] for i in p) <= capacity for p in packed)
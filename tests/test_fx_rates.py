@@ -0,0 +1,98 @@
+from datetime import date
+
+import pytest
+
+from fx_rates import NO_RATES, FxError, FxRates, apply_fx, load_rates
+
+ROWS = [
+    ("EUR", "2024-03-01", 1.0832),
+    ("EUR", "2024-03-04", 1.0850),
+    ("gbp", date(2024, 3, 1), 1.2631),
+]
+
+
+def test_rate_on_a_listed_day():
+    rates = FxRates(ROWS)
+    assert rates.rate("EUR", date(2024, 3, 1)) == 1.0832
+    assert rates.rate("EUR", date(2024, 3, 4)) == 1.0850
+    # Codes are upper cased when loaded
+    assert rates.rate("GBP", date(2024, 3, 1)) == 1.2631
+
+
+def test_weekend_uses_the_latest_earlier_rate():
+    rates = FxRates(ROWS)
+    assert rates.rate("EUR", date(2024, 3, 2)) == 1.0832
+    assert rates.rate("EUR", date(2024, 3, 3)) == 1.0832
+
+
+def test_rate_older_than_max_age_raises():
+    rates = FxRates(ROWS, max_age_days=3)
+    assert rates.rate("EUR", date(2024, 3, 7)) == 1.0850
+    with pytest.raises(FxError, match="No EUR rate within 3 days before 2024-03-08"):
+        rates.rate("EUR", date(2024, 3, 8))
+
+
+def test_day_before_the_first_rate_raises():
+    with pytest.raises(FxError):
+        FxRates(ROWS).rate("EUR", date(2024, 2, 29))
+
+
+def test_unknown_currency_raises():
+    with pytest.raises(FxError, match="No exchange rates for JPY"):
+        FxRates(ROWS).rate("JPY", date(2024, 3, 1))
+
+
+def test_base_currency_needs_no_table():
+    assert NO_RATES.rate("USD", date(2024, 3, 1)) == 1.0
+    assert NO_RATES.currencies() == ["USD"]
+    assert FxRates(ROWS).currencies() == ["USD", "EUR", "GBP"]
+
+
+def test_convert_rounds_to_cents():
+    amounts, used = FxRates(ROWS).convert(
+        [100, 19.99, 50], ["EUR", "gbp", None], ["2024-03-02", date(2024, 3, 1), "2024-03-02"]
+    )
+    assert list(amounts) == [108.32, 25.25, 50.0]
+    assert list(used) == [1.0832, 1.2631, 1.0]
+
+
+def test_apply_fx_keeps_the_entered_amount():
+    expenses = [
+        {"amount": 100.0, "currency": "eur", "expense_date": date(2024, 3, 4)},
+        {"amount": 12.5, "expense_date": date(2024, 3, 4)},
+    ]
+    apply_fx(expenses, FxRates(ROWS))
+    assert expenses[0] == {
+        "amount": 108.5,
+        "currency": "EUR",
+        "expense_date": date(2024, 3, 4),
+        "original_amount": 100.0,
+        "fx_rate": 1.085,
+    }
+    assert expenses[1]["amount"] == 12.5
+    assert expenses[1]["currency"] == "USD"
+    assert expenses[1]["fx_rate"] == 1.0
+
+    # Converting again starts from original_amount, not the converted amount
+    apply_fx(expenses, FxRates(ROWS))
+    assert expenses[0]["amount"] == 108.5
+
+
+def test_apply_fx_leaves_lines_untouched_on_error():
+    expenses = [
+        {"amount": 10.0, "currency": "EUR", "expense_date": date(2024, 3, 1)},
+        {"amount": 10.0, "currency": "JPY", "expense_date": date(2024, 3, 1)},
+    ]
+    with pytest.raises(FxError):
+        apply_fx(expenses, FxRates(ROWS))
+    assert expenses[0] == {"amount": 10.0, "currency": "EUR", "expense_date": date(2024, 3, 1)}
+
+
+def test_load_rates_from_csv_is_cached(tmp_path):
+    path = tmp_path / "rates.csv"
+    path.write_text("date,currency,rate\n2024-03-01,EUR,1.0832\n2024-03-01,GBP,1.2631\n", encoding="utf-8")
+    rates = load_rates(str(path))
+    assert rates.rate("GBP", date(2024, 3, 1)) == 1.2631
+    assert load_rates(str(path)) is rates
+    assert load_rates(str(tmp_path / "missing.csv")) is NO_RATES
+    assert load_rates(None) is NO_RATES
@@ -0,0 +1,98 @@
+import email
+import email.policy
+import os
+
+from mail_transport import CHUNK_SIZE, iter_mime_message
+
+
+def build(subject="Expense report", attachments=(), cc=(), text_body=None):
+    raw = b"".join(
+        iter_mime_message(
+            "sender@example.com",
+            ["finance@example.com"],
+            list(cc),
+            subject,
+            "<p>Report attached</p>",
+            list(attachments),
+            text_body=text_body,
+        )
+    )
+    return raw, email.message_from_bytes(raw, policy=email.policy.default)
+
+
+def test_headers_and_crlf_line_endings():
+    raw, msg = build(cc=["approver@example.com", "boss@example.com"])
+    assert msg["From"] == "sender@example.com"
+    assert msg["To"] == "finance@example.com"
+    assert msg["Cc"] == "approver@example.com, boss@example.com"
+    assert msg["Subject"] == "Expense report"
+    assert msg["Message-ID"]
+    assert msg.get_content_type() == "multipart/mixed"
+    assert b"\n" not in raw.replace(b"\r\n", b"")
+
+
+def test_html_body_alone_or_with_plain_text():
+    _raw, msg = build()
+    assert msg.get_body(("html",)).get_content() == "<p>Report attached</p>"
+    assert msg.get_body(("plain",)) is None
+
+    _raw, msg = build(text_body="Report attached")
+    alternative = next(p for p in msg.iter_parts() if p.get_content_type() == "multipart/alternative")
+    assert [p.get_content_type() for p in alternative.iter_parts()] == ["text/plain", "text/html"]
+    assert msg.get_body(("plain",)).get_content() == "Report attached"
+
+
+def test_non_ascii_subject_is_encoded():
+    raw, msg = build(subject="Reçu de voyage, München")
+    assert msg["Subject"] == "Reçu de voyage, München"
+    assert "München".encode("utf-8") not in raw
+
+
+def test_line_breaks_cannot_add_headers():
+    _raw, msg = build(
+        subject="Report\r\nBcc: someone@example.com",
+        attachments=[
+            {"filename": "a.pdf\r\nBcc: other@example.com", "mime_type": "application/pdf", "content_bytes": b"x"}
+        ],
+    )
+    assert msg["Bcc"] is None
+    assert msg["Subject"] == "Report Bcc: someone@example.com"
+    (part,) = msg.iter_attachments()
+    assert part["Bcc"] is None
+    assert part.get_filename() == "a.pdf Bcc: other@example.com"
+
+
+def test_attachments_from_memory_and_disk(tmp_path):
+    # Spans several read chunks and ends on a partial base64 group
+    big = os.urandom(CHUNK_SIZE * 2 + 5)
+    path = tmp_path / "scan.bin"
+    path.write_bytes(big)
+    _raw, msg = build(
+        attachments=[
+            {"filename": "Receipts.pdf", "mime_type": "application/pdf", "content_bytes": b"%PDF-1.4 small"},
+            {"filename": "scan.jpg", "mime_type": "image/jpeg", "path": str(path)},
+            {"filename": "empty.txt", "mime_type": "text/plain", "content_bytes": memoryview(b"")},
+        ]
+    )
+    parts = list(msg.iter_attachments())
+    assert [(p.get_filename(), p.get_content_type()) for p in parts] == [
+        ("Receipts.pdf", "application/pdf"),
+        ("scan.jpg", "image/jpeg"),
+        ("empty.txt", "text/plain"),
+    ]
+    assert parts[0].get_payload(decode=True) == b"%PDF-1.4 small"
+    assert parts[1].get_payload(decode=True) == big
+    assert parts[2].get_payload(decode=True) == b""
+
+
+def test_filenames_use_rfc_2231_when_not_ascii():
+    raw, msg = build(
+        attachments=[
+            {"filename": "Reçu 東京.pdf", "mime_type": "application/pdf", "content_bytes": b"1"},
+            {"filename": 'Hotel "Grand" \\ Spa.pdf', "mime_type": "application/pdf", "content_bytes": b"2"},
+        ]
+    )
+    assert b"filename*=utf-8''Re%C3%A7u%20%E6%9D%B1%E4%BA%AC.pdf" in raw
+    assert b"name*=utf-8''Re%C3%A7u%20%E6%9D%B1%E4%BA%AC.pdf" in raw
+    assert b'filename="Hotel \\"Grand\\" \\\\ Spa.pdf"' in raw
+    assert [p.get_filename() for p in msg.iter_attachments()] == ["Reçu 東京.pdf", 'Hotel "Grand" \\ Spa.pdf']
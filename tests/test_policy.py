@@ -0,0 +1,153 @@
+import os
+from datetime import date
+
+import pytest
+
+from policy import Policy, PolicyError, load_policy
+
+RULES = """kind,location,category,start_date,end_date,amount,per
+per_diem,*,,,,100,day
+per_diem,New York,,2024-01-01,2024-12-31,150,day
+per_diem,New York,,2024-07-01,2024-07-31,175,day
+cap,*,Hotel,,,250,night
+cap,New York,Hotel,,,400,night
+cap,*,Rental Car,,,90,day
+cap,*,Taxi or Uber to Airport,,,80,item
+cap,*,Conference,,,500,trip
+"""
+
+
+@pytest.fixture
+def rules(tmp_path):
+    path = tmp_path / "rules.csv"
+    path.write_text(RULES, encoding="utf-8")
+    return Policy.from_csv(str(path))
+
+
+def test_per_diem_by_location(rules):
+    assert rules.per_diem("new york ", date(2024, 6, 1), date(2024, 6, 3)) == {
+        "trip_days": 3,
+        "per_diem_rate": 150.0,
+        "per_diem_total": 450.0,
+    }
+    assert rules.per_diem("Austin", date(2024, 6, 1), date(2024, 6, 3))["per_diem_total"] == 300.0
+
+
+def test_later_range_wins_where_ranges_overlap(rules):
+    assert rules.rate("new york", date(2024, 7, 15)) == 175.0
+    assert rules.rate("new york", date(2024, 8, 1)) == 150.0
+    # Outside every New York range the "*" rate applies
+    assert rules.rate("new york", date(2025, 1, 1)) == 100.0
+
+
+def test_rate_change_during_a_trip_is_averaged(rules):
+    assert rules.per_diem("New York", date(2024, 12, 31), date(2025, 1, 1)) == {
+        "trip_days": 2,
+        "per_diem_rate": 125.0,
+        "per_diem_total": 250.0,
+    }
+
+
+def test_partial_travel_days(rules):
+    out = rules.per_diem("New York", date(2024, 6, 1), date(2024, 6, 3), partial_day_factor=0.75)
+    assert out == {"trip_days": 2.5, "per_diem_rate": 150.0, "per_diem_total": 375.0}
+
+
+def test_no_rules_uses_the_default_rate():
+    out = Policy(default_rate=60).per_diem("Austin", date(2024, 6, 1), date(2024, 6, 2))
+    assert out == {"trip_days": 2, "per_diem_rate": 60.0, "per_diem_total": 120.0}
+    assert Policy(default_rate=60).check({"location": "Austin"}, [{"category": "Hotel", "amount": 1e6}]) == []
+
+
+def trip(location, departure=date(2024, 6, 1), ret=date(2024, 6, 3)):
+    return {"location": location, "departure_date": departure, "return_date": ret}
+
+
+def test_per_night_cap_on_the_category_total(rules):
+    hotel = [{"category": "Hotel", "amount": 300.0}, {"category": "Hotel", "amount": 300.0}]
+    # 3 days is 2 nights, 2 x 250 elsewhere and 2 x 400 in New York
+    assert rules.check(trip("Austin"), hotel) == [
+        {
+            "line": None,
+            "category": "Hotel",
+            "amount": 600.0,
+            "cap": 500.0,
+            "per": "night",
+            "message": "Hotel total $600.00 is over the $500.00 cap, $250.00 per night for 2 night(s)",
+        }
+    ]
+    assert rules.check(trip("New York"), hotel) == []
+
+
+def test_per_item_cap_names_the_line(rules):
+    lines = [
+        {"category": "Meals", "amount": 20.0},
+        {"category": "Taxi or Uber to Airport", "amount": 80.004},
+        {"category": "Taxi or Uber to Airport", "amount": 95.5},
+    ]
+    issues = rules.check(trip("Austin"), lines)
+    assert [(v["line"], v["amount"], v["cap"]) for v in issues] == [(3, 95.5, 80.0)]
+    assert issues[0]["message"] == "Line 3: Taxi or Uber to Airport $95.50 is over the $80.00 per item cap"
+
+
+def test_per_day_and_per_trip_caps(rules):
+    lines = [{"category": "Rental Car", "amount": 271.0}, {"category": "Conference", "amount": 500.0}]
+    issues = rules.check(trip("Austin"), lines)
+    assert [(v["category"], v["cap"], v["per"]) for v in issues] == [("Rental Car", 270.0, "day")]
+
+
+def test_audit_checks_each_report_on_its_own(rules):
+    hotel = [{"category": "Hotel", "amount": 600.0}]
+    out = rules.audit([(trip("Austin"), hotel), (trip("New York"), hotel), (trip("Austin"), [])])
+    assert [len(issues) for issues in out] == [1, 0, 0]
+
+
+@pytest.mark.parametrize(
+    "row, message",
+    [
+        ("per_diem,*,,,,lots,day", "Rule 1: could not convert"),
+        ("per_diem,*,,2024-13-01,,100,day", "Rule 1: month must be in 1..12"),
+        ("cap,*,Hotel,,,100,week", "Rule 1: a cap needs a category and per in item, day, night, trip"),
+        ("cap,*,,,,100,day", "Rule 1: a cap needs a category"),
+        ("budget,*,,,,100,day", "Rule 1: unknown kind 'budget'"),
+    ],
+)
+def test_bad_rows_raise(tmp_path, row, message):
+    path = tmp_path / "rules.csv"
+    path.write_text("kind,location,category,start_date,end_date,amount,per\n" + row + "\n", encoding="utf-8")
+    with pytest.raises(PolicyError, match=message):
+        Policy.from_csv(str(path))
+
+
+def test_unreadable_files_raise_policy_error(tmp_path):
+    path = tmp_path / "rules.csv"
+    path.write_bytes("kind,location,category,start_date,end_date,amount,per\n# café\n".encode("latin-1"))
+    with pytest.raises(PolicyError, match="is not UTF-8"):
+        Policy.from_csv(str(path))
+    with pytest.raises(PolicyError, match="could not be read"):
+        Policy.from_csv(str(tmp_path))
+
+
+def test_load_policy_caches_by_mtime(tmp_path, monkeypatch):
+    path = tmp_path / "rules.csv"
+    path.write_text(RULES, encoding="utf-8")
+    first = load_policy(str(path), 50)
+    assert load_policy(str(path), 50) is first
+
+    parses = []
+    from_csv = Policy.from_csv.__func__
+    monkeypatch.setattr(Policy, "from_csv", classmethod(lambda cls, *a: parses.append(a) or from_csv(cls, *a)))
+    path.write_text(RULES + "budget,*,,,,1,day\n", encoding="utf-8")
+    stat = path.stat()
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    # A bad file is parsed once and its error raised again until it changes
+    for _ in range(3):
+        with pytest.raises(PolicyError, match="unknown kind 'budget'"):
+            load_policy(str(path), 50)
+    assert len(parses) == 1
+
+
+def test_missing_file_gives_the_default_rate(tmp_path):
+    out = load_policy(str(tmp_path / "missing.csv"), 80)
+    assert out.rate("anywhere", date(2024, 1, 1)) == 80.0
+    assert out.categories == []
@@ -0,0 +1,128 @@
+from datetime import date
+
+import pytest
+
+from report_archive import ReportArchive
+
+
+@pytest.fixture
+def archive(tmp_path):
+    archive = ReportArchive(str(tmp_path / "archive.sqlite3"))
+    yield archive
+    archive.close()
+
+
+def trip(email, departure, location="Austin"):
+    return {
+        "employee_name": email.split("@")[0],
+        "employee_email": email,
+        "location": location,
+        "purpose": "Visit",
+        "departure_date": departure,
+        "return_date": departure,
+        "trip_days": 1,
+        "total_spend": 0.0,
+    }
+
+
+def line(category, amount, expense_date=None, paid_by="Employee"):
+    return {"category": category, "amount": amount, "expense_date": expense_date, "paid_by": paid_by}
+
+
+def test_archive_and_read_back(archive):
+    report_id = archive.archive(
+        trip("Jane@Example.com ", date(2024, 3, 5)),
+        [line("Hotel", 300.0, date(2024, 3, 5), "Performa"), line("Meals", 42.5)],
+        job_id="job-1",
+        submitted_at=1700000000.0,
+    )
+    rows, cursor = archive.search_reports(employee_email="jane@example.com")
+    assert cursor is None
+    assert len(rows) == 1
+    report = rows[0]
+    assert report["report_id"] == report_id
+    assert report["employee"] == "jane@example.com"
+    assert report["departure_date"] == "2024-03-05"
+    assert report["job_id"] == "job-1"
+    assert report["submitted_at"] == 1700000000.0
+    assert report["line_items"] == 2
+
+    items, _ = archive.search_line_items(report_id=report_id)
+    # A line without a date is filed under the departure date
+    assert sorted((i["category"], i["expense_date"], i["amount"]) for i in items) == [
+        ("Hotel", "2024-03-05", 300.0),
+        ("Meals", "2024-03-05", 42.5),
+    ]
+
+
+def test_search_filters(archive):
+    archive.archive_many(
+        [
+            (trip("a@x.com", date(2024, 1, 10), "Austin"), [line("Hotel", 100.0)]),
+            (trip("a@x.com", date(2024, 2, 10), "new york"), [line("Meals", 20.0)]),
+            (trip("b@x.com", date(2024, 3, 10), "New York"), [line("Hotel", 200.0)]),
+        ]
+    )
+    assert archive.count_reports() == 3
+
+    def departures(**filters):
+        rows, _ = archive.search_reports(**filters)
+        return [r["departure_date"] for r in rows]
+
+    assert departures() == ["2024-03-10", "2024-02-10", "2024-01-10"]
+    assert departures(employee_email="A@X.com") == ["2024-02-10", "2024-01-10"]
+    # Locations compare case-insensitively
+    assert departures(location="New York") == ["2024-03-10", "2024-02-10"]
+    assert departures(date_from=date(2024, 2, 1), date_to="2024-02-29") == ["2024-02-10"]
+    assert departures(category="Hotel") == ["2024-03-10", "2024-01-10"]
+
+
+def test_keyset_pages_cover_every_row_once(archive):
+    # Several reports share a departure date, so pages split ties on report_id
+    archive.archive_many(
+        (trip("a@x.com", date(2024, 1, 1 + n // 3)), [line("Meals", float(n))]) for n in range(11)
+    )
+    seen, cursor, pages = [], None, 0
+    while True:
+        rows, cursor = archive.search_reports(cursor=cursor, page_size=4)
+        seen.extend((r["departure_date"], r["report_id"]) for r in rows)
+        pages += 1
+        if cursor is None:
+            break
+    assert pages == 3
+    assert len(seen) == len(set(seen)) == 11
+    assert seen == sorted(seen, reverse=True)
+
+    items, cursor = archive.search_line_items(page_size=10)
+    assert len(items) == 10
+    rest, cursor = archive.search_line_items(cursor=cursor, page_size=10)
+    assert len(rest) == 1 and cursor is None
+
+
+def test_monthly_rollup(archive):
+    archive.archive(
+        trip("a@x.com", date(2024, 1, 30)),
+        [
+            line("Hotel", 300.0, date(2024, 1, 30), "Performa"),
+            line("Hotel", 150.0, date(2024, 2, 1)),
+            line("Meals", 25.0, date(2024, 2, 1)),
+        ],
+    )
+    archive.archive(trip("b@x.com", date(2024, 2, 5)), [line("Hotel", 100.0, date(2024, 2, 5), "Performa")])
+
+    expected = [
+        {"month": "2024-01", "category": "Hotel", "total_spend": 300.0, "company_paid": 300.0, "line_items": 1},
+        {"month": "2024-02", "category": "Hotel", "total_spend": 250.0, "company_paid": 100.0, "line_items": 2},
+        {"month": "2024-02", "category": "Meals", "total_spend": 25.0, "company_paid": 0.0, "line_items": 1},
+    ]
+    assert archive.monthly_rollup() == expected
+    assert archive.monthly_rollup(month_from="2024-02", category="Hotel") == expected[1:2]
+
+    # The running totals match a rebuild from the line items
+    archive.rebuild_rollups()
+    assert archive.monthly_rollup() == expected
+
+
+def test_iter_line_items_in_insert_order(archive):
+    archive.archive(trip("a@x.com", date(2024, 1, 1)), [line("Meals", float(n)) for n in range(25)])
+    assert [i["amount"] for i in archive.iter_line_items(batch_size=7)] == [float(n) for n in range(25)]